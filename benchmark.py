@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib
+import log_helper
+import system_utils
+import registry_helper
+import registry_backend
+import random_utils
+import entropy
+import identity_data
+import system_fingerprint
+import hardware_fingerprint
+import generate_fingerprint
+import registry_verify
+import memory_report
+
+logger = log_helper.setup_logger(name="benchmark", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Benchmark suite for fingerprint generators, binary blob assembly and registry application.
+Runs on any platform: registry is replaced with the in-memory stand-in and the system pretends to be Windows 10 x64.
+Results are appended to the JSON history file and compared against the saved baseline, the run fails if any benchmark
+is slower than the baseline by more than the threshold. With --memory the peak traced memory of the standard run is
+measured instead and checked against the stored memory budget the same way
+"""
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_history.json")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_MEMORY_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_budget.json")
+
+# Relative slowdown against the baseline which is reported as regression
+DEFAULT_THRESHOLD = 0.25
+
+SETTINGS_REQUESTS_COUNT = 16
+
+
+def windows10_registry():
+    """
+    Build in-memory registry stand-in with the keys and values fingerprint sections expect on Windows 10 x64
+    :return: registry_backend.MemoryRegistry object
+    """
+    registry = registry_backend.MemoryRegistry()
+    hklm = registry_backend.HKEY_LOCAL_MACHINE
+    plans = (generate_fingerprint.build_network_plan("host", "user") +
+             generate_fingerprint.build_windows_plan(system_fingerprint.WindowsProfile.generate()) +
+             generate_fingerprint.build_hardware_plan(hardware_fingerprint.HardwareProfile.generate()))
+    key_paths = set(operation.key_path for operation in plans)
+    registry.create_keys(hklm, key_paths, registry_backend.KEY_WOW64_64KEY)
+    registry.create_keys(hklm, key_paths, registry_backend.KEY_WOW64_32KEY)
+
+    device_id = "{00000000-1111-2222-3333-444444444444}"
+    sqm_client = registry.CreateKeyEx(hklm, "SOFTWARE\\Microsoft\\SQMClient")
+    registry.SetValueEx(sqm_client, "MachineId", 0, registry_backend.REG_SZ, device_id)
+    query_path = "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Diagnostics\\DiagTrack\\SettingsRequests"
+    for request_num in range(SETTINGS_REQUESTS_COUNT):
+        request = registry.CreateKeyEx(hklm, "{0}\\{1:08X}".format(query_path, request_num))
+        registry.SetValueEx(request, "ETagQueryParameters", 0, registry_backend.REG_SZ,
+                            "deviceId=s:{0}&os=10.0.16299".format(device_id))
+    return registry
+
+
+def run_main(argv):
+    journal_dir = tempfile.mkdtemp(prefix="antios-bench-")
+    try:
+        return_code = generate_fingerprint.main(argv + ["--journal-dir", journal_dir])
+        if return_code:
+            raise RuntimeError("generate_fingerprint {0} returned {1}".format(" ".join(argv), return_code))
+    finally:
+        shutil.rmtree(journal_dir, ignore_errors=True)
+
+
+def benchmark_cases():
+    """
+    :return: list of (name, callable) tuples
+    """
+    digital_product_id4 = system_fingerprint.WinFingerprint().random_digital_product_id4()
+    guid = "3F2504E0-4F89-11D3-9A0C-0305E82C3301"
+    with open(identity_data.__file__, encoding="utf-8") as identity_file:
+        identity_source = identity_file.read()
+    profile_plan = generate_fingerprint.build_profile_plan()
+
+    return [
+        ("win_fingerprint", system_fingerprint.WinFingerprint),
+        ("hardware_fingerprint", hardware_fingerprint.HardwareFingerprint),
+        ("windows_profile", system_fingerprint.WindowsProfile.generate),
+        ("bytes_list_to_array", lambda: random_utils.bytes_list_to_array(digital_product_id4)),
+        ("disperse_string", lambda: random_utils.disperse_string(guid)),
+        ("entropy_guid", lambda: entropy.get_source().guid()),
+        ("identity_data_compile", lambda: compile(identity_source, identity_data.__file__, "exec")),
+        ("identity_data_load", lambda: importlib.reload(identity_data)),
+        ("identity_sampling", lambda: (random_utils.random_hostname(),
+                                       random_utils.random_username(),
+                                       random_utils.random_mac_address())),
+        ("verify_plan", lambda: registry_verify.verify_plan(profile_plan)),
+        ("main", lambda: run_main(["--no-journal"])),
+        ("main_telemetry", lambda: run_main(["--telemetry", "--no-journal"])),
+        ("main_journal", lambda: run_main([])),
+    ]
+
+
+def measure(function, repeat):
+    """
+    :return: dictionary with best and median time of a single call in seconds and number of calls per repeat
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    timings = sorted(total / number for total in timer.repeat(repeat=repeat, number=number))
+    return {"best": timings[0], "median": timings[len(timings) // 2], "number": number}
+
+
+def run_benchmarks(repeat, name_filter=None):
+    """
+    Run benchmarks against the in-memory registry stand-in
+    :param repeat: number of measurements of every benchmark
+    :param name_filter: optional substring of benchmark names to run
+    :return: dictionary benchmark name -> measure() result
+    """
+    previous_info = system_utils.set_system_info(system_utils.SystemInfo.windows(10))
+    previous_backend = registry_helper.set_backend(windows10_registry())
+    logging.disable(logging.WARNING)
+    try:
+        results = {}
+        for name, function in benchmark_cases():
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = measure(function, repeat)
+        return results
+    finally:
+        logging.disable(logging.NOTSET)
+        registry_helper.set_backend(previous_backend)
+        system_utils.set_system_info(previous_info)
+
+
+def measure_memory():
+    """
+    Measure memory of the standard run in a fresh interpreter, so imports of all modules are accounted
+    :return: memory_report.MemoryReport
+    """
+    output = subprocess.check_output([sys.executable, "-c",
+                                      "import memory_report; print(memory_report.standard_run_json())"],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return memory_report.MemoryReport.from_dict(json.loads(output.decode("utf-8").splitlines()[-1]))
+
+
+def check_memory(report, budget_path, threshold, save_budget):
+    """
+    :param report: memory_report.MemoryReport of the standard run
+    :param budget_path: JSON file with the stored peak budget
+    :param threshold: relative excess of the peak over the budget, e.g. 0.25 for 25%
+    :param save_budget: save the peak as the new budget instead of checking it
+    :return: Exec return code, 1 if the budget is exceeded
+    """
+    memory_report.log_report(report)
+    if save_budget:
+        save_json(budget_path, {"peak": report.peak, "python": platform.python_version()})
+        logger.info("Memory budget saved to {0}".format(budget_path))
+        return 0
+
+    budget = load_json(budget_path, None)
+    if budget is None:
+        logger.info("No memory budget found, run with --memory --save-baseline to create one")
+        return 0
+    if report.peak > budget["peak"] * (1.0 + threshold):
+        logger.error("Memory peak {0} exceeds the budget {1} (+{2:.0%})".format(
+            memory_report.format_size(report.peak), memory_report.format_size(budget["peak"]),
+            report.peak / float(budget["peak"]) - 1.0))
+        return 1
+    logger.info("Memory peak {0} is within the budget {1}".format(memory_report.format_size(report.peak),
+                                                                   memory_report.format_size(budget["peak"])))
+    return 0
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    :param results: run_benchmarks() result
+    :param baseline: saved run_benchmarks() result
+    :param threshold: relative slowdown, e.g. 0.25 for 25%
+    :return: list of (name, baseline seconds, current seconds) tuples of regressed benchmarks
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline and result["best"] > baseline[name]["best"] * (1.0 + threshold):
+            regressions.append((name, baseline[name]["best"], result["best"]))
+    return regressions
+
+
+def load_json(path, default):
+    try:
+        with open(path, encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def main(argv=None):
+    """
+    Run benchmark suite, record results and check them against the baseline
+    :return: Exec return code, 1 if regression found
+    """
+    parser = argparse.ArgumentParser(description='Benchmark suite')
+
+    parser.add_argument('--repeat',
+                        help='Number of measurements of every benchmark',
+                        type=int,
+                        required=False,
+                        default=5)
+
+    parser.add_argument('--filter',
+                        help='Run only benchmarks which names contain this substring',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--history',
+                        help='JSON file to append results to',
+                        required=False,
+                        default=DEFAULT_HISTORY)
+
+    parser.add_argument('--baseline',
+                        help='JSON file with baseline results',
+                        required=False,
+                        default=DEFAULT_BASELINE)
+
+    parser.add_argument('--save-baseline',
+                        help='Save results as the new baseline',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--threshold',
+                        help='Relative slowdown against the baseline reported as regression',
+                        type=float,
+                        required=False,
+                        default=DEFAULT_THRESHOLD)
+
+    parser.add_argument('--memory',
+                        help='Measure peak memory of the standard run and check it against the memory budget',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--memory-budget',
+                        help='JSON file with the stored memory budget',
+                        required=False,
+                        default=DEFAULT_MEMORY_BUDGET)
+
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        return check_memory(measure_memory(), args.memory_budget, args.threshold, args.save_baseline)
+
+    results = run_benchmarks(args.repeat, args.filter)
+    for name, result in sorted(results.items()):
+        logger.info("{0:<24} best {1:12.3f} us  median {2:12.3f} us".format(
+            name, result["best"] * 1e6, result["median"] * 1e6))
+
+    history = load_json(args.history, [])
+    history.append({"time": time.time(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": results})
+    save_json(args.history, history)
+
+    if args.save_baseline:
+        save_json(args.baseline, results)
+        logger.info("Baseline saved to {0}".format(args.baseline))
+        return 0
+
+    baseline = load_json(args.baseline, None)
+    if baseline is None:
+        logger.info("No baseline found, run with --save-baseline to create one")
+        return 0
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, baseline_time, current_time in regressions:
+        logger.error("Regression {0}: {1:.3f} us -> {2:.3f} us (+{3:.0%})".format(
+            name, baseline_time * 1e6, current_time * 1e6, current_time / baseline_time - 1.0))
+    return 1 if regressions else 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+import tempfile
+import compileall
+import py_compile
+import subprocess
+import collections
+import log_helper
+import identity_data
+import identity_store
+import bundle_resources
+
+logger = log_helper.setup_logger(name="build_bundle", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Build of the single-file bundle of generate_fingerprint.py for fast start on fresh machines.
+A plain source run compiles every module on its first start, and the large identity_data module takes most of that
+time. The bundle is a ZIP archive runnable with "python antios.pyz", which holds every module precompiled to bytecode
+of the building interpreter next to its source, and the identity tables as an uncompressed binary resource read in
+place by bundle_resources. Bytecode is stored uncompressed too, sources are compressed: they are read only by other
+Python versions, which fall back to compiling them, and for tracebacks.
+With --compare the cold start of the bundle is measured against the plain source run in fresh interpreters
+"""
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BUNDLE = os.path.join(SOURCE_DIR, "antios.pyz")
+
+# Modules which are not needed at run time: the build itself, the benchmarks and the source of the identity resource
+EXCLUDED_MODULES = ("build_bundle", "benchmark", "identity_data")
+
+MAIN_SOURCE = "import sys\nimport generate_fingerprint\n\nsys.exit(generate_fingerprint.main())\n"
+
+# Cold start probe: import the tool and load all identity tables, as every full run does
+COLD_START_PROBE = "import generate_fingerprint, identity_store\n" \
+                   "for name in identity_store.TABLES:\n" \
+                   "    identity_store.get_table(name)\n"
+
+DEFAULT_REPEAT = 5
+
+
+class ColdStart(collections.namedtuple("ColdStart", ["name", "best", "median"])):
+    """
+    Cold start measurement: best and median wall time of the fresh interpreter run, seconds
+    """
+    __slots__ = ()
+
+
+def bundle_modules(source_dir=SOURCE_DIR):
+    """
+    :return: sorted list of names of modules included into the bundle
+    """
+    return sorted(name[:-3] for name in os.listdir(source_dir)
+                  if name.endswith(".py") and name[:-3] not in EXCLUDED_MODULES)
+
+
+def compile_module(source_path, name, work_dir):
+    """
+    :param source_path: module source file
+    :param name: module name
+    :param work_dir: directory for the compiled file
+    :return: bytecode file contents
+    """
+    compiled_path = os.path.join(work_dir, name + ".pyc")
+    options = {}
+    if hasattr(py_compile, "PycInvalidationMode"):
+        # The bundle is immutable, so imports do not need to check the bytecode against its source
+        options["invalidation_mode"] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+    py_compile.compile(source_path, cfile=compiled_path, dfile=name + ".py", doraise=True, **options)
+    with open(compiled_path, "rb") as compiled_file:
+        return compiled_file.read()
+
+
+def build_bundle(output, source_dir=SOURCE_DIR):
+    """
+    Build the bundle, the existing file is replaced atomically
+    :param output: bundle file, its directory is created if missing
+    :param source_dir: directory of the source modules
+    :return: number of bundled modules
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="antios-bundle-")
+    temp_output = output + ".tmp"
+    try:
+        main_path = os.path.join(work_dir, "__main__.py")
+        with open(main_path, "w", encoding="utf-8") as main_file:
+            main_file.write(MAIN_SOURCE)
+        sources = [(name, os.path.join(source_dir, name + ".py")) for name in bundle_modules(source_dir)]
+        sources.append(("__main__", main_path))
+
+        with zipfile.ZipFile(temp_output, "w") as bundle:
+            for name, source_path in sources:
+                # Source timestamp matches the bytecode one for Python versions without hash-based bytecode
+                date_time = time.localtime(os.stat(source_path).st_mtime)[:6]
+                with open(source_path, "rb") as source_file:
+                    bundle.writestr(zipfile.ZipInfo(name + ".py", date_time), source_file.read(),
+                                    compress_type=zipfile.ZIP_DEFLATED)
+                bundle.writestr(zipfile.ZipInfo(name + ".pyc", date_time),
+                                compile_module(source_path, name, work_dir), compress_type=zipfile.ZIP_STORED)
+            resource = bundle_resources.build_resource((name, getattr(identity_data, name))
+                                                       for name in identity_store.TABLES)
+            bundle.writestr(zipfile.ZipInfo(bundle_resources.IDENTITY_RESOURCE, time.localtime()[:6]), resource,
+                            compress_type=zipfile.ZIP_STORED)
+        os.replace(temp_output, output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+    return len(sources) - 1
+
+
+def time_runs(command, repeat):
+    """
+    :param command: command line of the fresh interpreter run
+    :param repeat: number of runs
+    :return: sorted list of wall times, seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start_time)
+    return sorted(timings)
+
+
+def probe_command(path, write_bytecode=True):
+    """
+    :param path: directory of source modules or bundle file to import from
+    :param write_bytecode: False to compile modules on every run, as the first run on a fresh machine does
+    :return: command line of the cold start probe
+    """
+    return [sys.executable] + ([] if write_bytecode else ["-B"]) + \
+        ["-c", "import sys\nsys.path.insert(0, {0!r})\n{1}".format(path, COLD_START_PROBE)]
+
+
+def compare_cold_start(bundle, repeat=DEFAULT_REPEAT, source_dir=SOURCE_DIR):
+    """
+    Measure cold start of the bundle, of plain source modules without bytecode, as on the first run, and with it.
+    Source modules are copied to a temporary directory, so existing bytecode caches are not used
+    :param bundle: bundle file
+    :param repeat: number of runs of every variant
+    :return: list of ColdStart, the bare interpreter start first
+    """
+    work_dir = tempfile.mkdtemp(prefix="antios-coldstart-")
+    try:
+        for name in os.listdir(source_dir):
+            if name.endswith(".py"):
+                shutil.copy2(os.path.join(source_dir, name), work_dir)
+        variants = [("interpreter", [sys.executable, "-c", "pass"]),
+                    ("source", probe_command(work_dir, write_bytecode=False)),
+                    ("source+bytecode", None),
+                    ("bundle", probe_command(os.path.abspath(bundle)))]
+        results = []
+        for name, command in variants:
+            if command is None:
+                compileall.compile_dir(work_dir, maxlevels=0, quiet=1)
+                command = probe_command(work_dir)
+            timings = time_runs(command, repeat)
+            results.append(ColdStart(name, timings[0], timings[len(timings) // 2]))
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def log_cold_start(results):
+    by_name = dict((result.name, result) for result in results)
+    for result in results:
+        logger.info("Cold start {0:<16} best {1:8.1f} ms  median {2:8.1f} ms".format(
+            result.name, result.best * 1e3, result.median * 1e3))
+    if "source" in by_name and "bundle" in by_name:
+        logger.info("Bundle starts {0:.1f}x faster than plain source".format(
+            by_name["source"].median / by_name["bundle"].median))
+
+
+def main(argv=None):
+    """
+    Build the bundle and optionally compare its cold start with the plain source run
+    :return: Exec return code
+    """
+    parser = argparse.ArgumentParser(description='Build single-file bundle of generate_fingerprint.py')
+
+    parser.add_argument('output',
+                        help='Bundle file, run it with "python antios.pyz"',
+                        nargs='?',
+                        default=DEFAULT_BUNDLE)
+
+    parser.add_argument('--compare',
+                        help='Measure cold start of the bundle against the plain source run',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--repeat',
+                        help='Number of cold start measurements of every variant',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_REPEAT)
+
+    args = parser.parse_args(argv)
+
+    modules = build_bundle(args.output)
+    logger.info("Bundle of {0} modules for Python {1}.{2} written to {3} ({4} bytes)".format(
+        modules, sys.version_info[0], sys.version_info[1], args.output, os.path.getsize(args.output)))
+    if args.compare:
+        log_cold_start(compare_cold_start(args.output, args.repeat))
+    return 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+import mmap
+import types
+import struct
+import threading
+import collections
+import collections.abc
+
+
+__doc__ = """Resources of the single-file bundle built by build_bundle.py.
+The identity tables are embedded into the bundle as a binary resource, stored uncompressed, so it is read in place:
+the bundle file is memory-mapped and values are decoded straight from the mapping on access, instead of compiling or
+unmarshalling the large identity_data module. Resource layout, all integers are little-endian unsigned 32-bit:
+header (magic, version, number of tables), then per table its name, number of values, offset of the offsets array
+and offset and size of the data block. The data block holds the UTF-8 values joined by NUL characters, the offsets
+array holds the start of every value in the data block and the end of the last one.
+Outside of the bundle the module finds nothing and callers fall back to the plain source modules
+"""
+
+# Name of the identity tables resource in the bundle
+IDENTITY_RESOURCE = "identity_store.bin"
+
+RESOURCE_MAGIC = b"AIDT"
+RESOURCE_VERSION = 1
+
+_HEADER = struct.Struct("<4sII")
+_TABLE = struct.Struct("<32sIIII")
+_OFFSET = struct.Struct("<I")
+
+# Local file header of ZIP archives: signature, fixed fields, file name and extra field lengths
+_ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+_ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+
+
+class ResourceTable(collections.abc.Sequence):
+    """
+    Read-only sequence of strings decoded on access from the resource buffer
+    """
+    def __init__(self, name, buffer, count, offsets_position, data_position, data_size):
+        """
+        :param name: table name
+        :param buffer: memoryview of the whole resource
+        """
+        self.name = name
+        self._buffer = buffer
+        self._count = count
+        self._offsets_position = offsets_position
+        self._data = buffer[data_position:data_position + data_size]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("Resource table index out of range")
+        start, end = struct.unpack_from("<II", self._buffer, self._offsets_position + index * _OFFSET.size)
+        # The value ends before the NUL separator, the last one at the end of the data block
+        return bytes(self._data[start:end - 1 if index + 1 < self._count else end]).decode("utf-8")
+
+    def __iter__(self):
+        # Whole table at once: a single decode and split is much faster than decoding values one by one
+        if not self._count:
+            return iter(())
+        return iter(bytes(self._data).decode("utf-8").split("\0"))
+
+
+def build_resource(tables):
+    """
+    :param tables: iterable of (name, sequence of strings) tuples
+    :return: resource bytes
+    """
+    tables = [(name, [value.encode("utf-8") for value in values]) for name, values in tables]
+    for name, values in tables:
+        if any(b"\0" in value for value in values):
+            raise ValueError("Values of table {0} contain NUL characters".format(name))
+    position = _HEADER.size + _TABLE.size * len(tables)
+    directory = []
+    blocks = []
+    for name, values in tables:
+        offsets = []
+        data_size = 0
+        for value in values:
+            offsets.append(data_size)
+            data_size += len(value) + 1
+        data_size = max(data_size - 1, 0)
+        offsets.append(data_size)
+        offsets_block = struct.pack("<{0}I".format(len(offsets)), *offsets)
+        directory.append(_TABLE.pack(name.encode("ascii"), len(values), position, position + len(offsets_block),
+                                     data_size))
+        blocks.append(offsets_block)
+        blocks.append(b"\0".join(values))
+        position += len(offsets_block) + data_size
+    return b"".join([_HEADER.pack(RESOURCE_MAGIC, RESOURCE_VERSION, len(tables))] + directory + blocks)
+
+
+def read_resource(buffer):
+    """
+    :param buffer: memoryview of the resource
+    :return: ordered dictionary table name -> ResourceTable
+    :raises ValueError: if the buffer is not an identity resource
+    """
+    magic, version, count = _HEADER.unpack_from(buffer, 0)
+    if magic != RESOURCE_MAGIC or version != RESOURCE_VERSION:
+        raise ValueError("Not an identity resource of version {0}".format(RESOURCE_VERSION))
+    tables = collections.OrderedDict()
+    for index in range(count):
+        name, values, offsets_position, data_position, data_size = _TABLE.unpack_from(
+            buffer, _HEADER.size + index * _TABLE.size)
+        name = name.rstrip(b"\0").decode("ascii")
+        tables[name] = ResourceTable(name, buffer, values, offsets_position, data_position, data_size)
+    return tables
+
+
+def bundle_path():
+    """
+    :return: path of the bundle file the modules are imported from, None if they are imported from source files
+    """
+    return getattr(__loader__, "archive", None)
+
+
+def application_dir():
+    """
+    :return: directory of the bundle file or of the source modules, where bin and journal directories are looked for
+    """
+    return os.path.dirname(os.path.abspath(bundle_path() or __file__))
+
+
+def stored_member_offset(archive_file, name):
+    """
+    Locate the data of the uncompressed ZIP archive member, so it can be mapped from the archive file directly
+    :param archive_file: archive file object opened for binary reading
+    :param name: member name
+    :return: (offset, size) tuple of the member data in the archive file
+    :raises KeyError: if there is no such member
+    :raises ValueError: if the member is compressed
+    """
+    import zipfile
+    info = zipfile.ZipFile(archive_file).getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Bundle member {0} is compressed and can not be read in place".format(name))
+    archive_file.seek(info.header_offset)
+    signature, name_length, extra_length = _ZIP_LOCAL_HEADER.unpack(archive_file.read(_ZIP_LOCAL_HEADER.size))
+    if signature != _ZIP_LOCAL_SIGNATURE:
+        raise ValueError("Bad local header of bundle member {0}".format(name))
+    return info.header_offset + _ZIP_LOCAL_HEADER.size + name_length + extra_length, info.file_size
+
+
+def map_member(path, name):
+    """
+    :param path: archive file
+    :param name: uncompressed member name
+    :return: memoryview of the member data in the read-only mapping of the archive file
+    """
+    with open(path, "rb") as archive_file:
+        offset, size = stored_member_offset(archive_file, name)
+        # The mapping stays valid after the file is closed
+        mapping = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapping)[offset:offset + size]
+
+
+_identity_tables = None
+_identity_tables_lock = threading.Lock()
+
+
+def identity_tables():
+    """
+    :return: namespace of ResourceTable objects embedded into the bundle, HOSTNAMES, USERNAMES and so on,
+             None outside of the bundle
+    """
+    global _identity_tables
+    path = bundle_path()
+    if path is None:
+        return None
+    with _identity_tables_lock:
+        if _identity_tables is None:
+            _identity_tables = types.SimpleNamespace(**read_resource(map_member(path, IDENTITY_RESOURCE)))
+    return _identity_tables
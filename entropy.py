@@ -0,0 +1,247 @@
+import os
+import uuid
+import string
+import hashlib
+import threading
+import contextlib
+
+
+__doc__ = """Buffered entropy sources shared by all fingerprint generators.
+Randomness is fetched in large chunks into a buffer, and byte strings, GUIDs, digit strings and bounded integers
+are cut from it. Bounded values use rejection sampling, so they are not biased towards small numbers.
+SystemEntropy reads the OS CSPRNG and is used by default; DeterministicEntropy expands a seed with SHA-512
+in counter mode, so the same seed always produces the same profiles, e.g. to reproduce a generated image:
+
+    with entropy.use_source(entropy.DeterministicEntropy("vm01")):
+        plan = generate_fingerprint.build_profile_plan()
+"""
+
+# Number of bytes fetched from the underlying generator at once
+DEFAULT_CHUNK_SIZE = 4096
+
+# Largest multiple of 10 that fits in a byte, bytes above are rejected when digits are generated
+_DIGIT_LIMIT = 250
+
+
+class EntropySource:
+    """
+    Base class of buffered entropy sources, subclasses implement _generate()
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param chunk_size: number of bytes fetched from the underlying generator at once
+        """
+        self.chunk_size = chunk_size
+        self._buffer = b""
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _generate(self, size):
+        """
+        :return: size bytes from the underlying generator
+        """
+        raise NotImplementedError
+
+    def read(self, size):
+        """
+        :param size: number of bytes
+        :return: random bytes
+        """
+        with self._lock:
+            if self._offset + size > len(self._buffer):
+                self._buffer = self._buffer[self._offset:] + self._generate(max(self.chunk_size, size))
+                self._offset = 0
+            data = self._buffer[self._offset:self._offset + size]
+            self._offset += size
+            return data
+
+    def randbelow(self, upper):
+        """
+        :param upper: exclusive upper bound, positive
+        :return: uniformly distributed integer in range [0, upper)
+        """
+        if upper <= 1:
+            return 0
+        bits = (upper - 1).bit_length()
+        size = (bits + 7) // 8
+        mask = (1 << bits) - 1
+        while True:
+            value = int.from_bytes(self.read(size), "little") & mask
+            if value < upper:
+                return value
+
+    def randint(self, low, high):
+        """
+        :return: uniformly distributed integer in range [low, high], both inclusive
+        """
+        return low + self.randbelow(high - low + 1)
+
+    def choice(self, sequence):
+        """
+        :return: random element of the non-empty sequence
+        """
+        return sequence[self.randbelow(len(sequence))]
+
+    def randbelow_many(self, uppers):
+        """
+        Draw many bounded integers with a single buffer read instead of one read per value
+        :param uppers: sequence of exclusive upper bounds
+        :return: list of uniformly distributed integers, one in range [0, upper) per bound
+        """
+        results = []
+        data = b""
+        position = 0
+        for upper in uppers:
+            if upper <= 1:
+                results.append(0)
+                continue
+            bits = (upper - 1).bit_length()
+            size = (bits + 7) // 8
+            mask = (1 << bits) - 1
+            while True:
+                if position + size > len(data):
+                    # Rejection discards less than a half of the values, so twice the remaining size is usually enough
+                    data = self.read(2 * size * (len(uppers) - len(results)))
+                    position = 0
+                value = int.from_bytes(data[position:position + size], "little") & mask
+                position += size
+                if value < upper:
+                    results.append(value)
+                    break
+        return results
+
+    def choices(self, population, k):
+        """
+        :return: list of k elements of the population, chosen with replacement
+        """
+        population = population if isinstance(population, (list, tuple, str, range)) else list(population)
+        return [population[index] for index in self.randbelow_many([len(population)] * k)]
+
+    def sample(self, population, k):
+        """
+        Partial Fisher-Yates shuffle of the population copy
+        :return: list of k distinct elements of the population, chosen without replacement
+        """
+        pool = list(population)
+        if k > len(pool):
+            raise ValueError("Sample larger than population")
+        for index, offset in enumerate(self.randbelow_many(range(len(pool), len(pool) - k, -1))):
+            swap = index + offset
+            pool[index], pool[swap] = pool[swap], pool[index]
+        return pool[:k]
+
+    def digit_string(self, length):
+        """
+        :param length: size of generated string
+        :return: random string of decimal digits
+        """
+        digits = []
+        while len(digits) < length:
+            for byte in self.read(length - len(digits)):
+                if byte < _DIGIT_LIMIT:
+                    digits.append(string.digits[byte % 10])
+        return "".join(digits)
+
+    def uuid4(self):
+        """
+        :return: random version 4 uuid.UUID object
+        """
+        return uuid.UUID(bytes=self.read(16), version=4)
+
+    def guid(self):
+        """
+        :return: random GUID string in lower case, without brackets
+        """
+        return str(self.uuid4())
+
+
+class SystemEntropy(EntropySource):
+    """
+    Cryptographically secure source backed by os.urandom().
+    The buffer is dropped in a forked child process, so workers never hand out the parent's bytes
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(chunk_size)
+        self._pid = os.getpid()
+
+    def _generate(self, size):
+        return os.urandom(size)
+
+    def read(self, size):
+        if self._pid != os.getpid():
+            with self._lock:
+                self._buffer = b""
+                self._offset = 0
+                self._pid = os.getpid()
+        return super().read(size)
+
+
+class DeterministicEntropy(EntropySource):
+    """
+    Reproducible source, SHA-512 of the seed and the block counter in counter mode
+    """
+    def __init__(self, seed, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param seed: str, int or bytes seed
+        :param chunk_size: number of bytes generated at once
+        """
+        super().__init__(chunk_size)
+        seed_bytes = seed if isinstance(seed, bytes) else str(seed).encode("utf-8")
+        self._key = hashlib.sha512(seed_bytes).digest()
+        self._counter = 0
+
+    def _generate(self, size):
+        blocks = []
+        generated = 0
+        while generated < size:
+            block = hashlib.sha512(self._key + self._counter.to_bytes(8, "little")).digest()
+            self._counter += 1
+            blocks.append(block)
+            generated += len(block)
+        return b"".join(blocks)
+
+
+_source = None
+
+# Per-thread overrides of use_source()
+_thread_source = threading.local()
+
+
+def get_source():
+    """
+    :return: EntropySource of use_source() if the current thread is inside it,
+    process-wide source otherwise, SystemEntropy created on first use
+    """
+    global _source
+    source = getattr(_thread_source, "source", None)
+    if source is not None:
+        return source
+    if _source is None:
+        _source = SystemEntropy()
+    return _source
+
+
+def set_source(source):
+    """
+    Replace the process-wide entropy source, e.g. with DeterministicEntropy(seed) for reproducible profiles
+    :param source: EntropySource object, None to use the new SystemEntropy on next use
+    :return: previous EntropySource object
+    """
+    global _source
+    previous = _source
+    _source = source
+    return previous
+
+
+@contextlib.contextmanager
+def use_source(source):
+    """
+    Use the entropy source in the current thread only
+    :param source: EntropySource object, None to keep the process-wide one
+    """
+    previous = getattr(_thread_source, "source", None)
+    _thread_source.source = source
+    try:
+        yield source
+    finally:
+        _thread_source.source = previous
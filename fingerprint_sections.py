@@ -0,0 +1,138 @@
+import logging
+import importlib
+import collections
+import log_helper
+
+logger = log_helper.setup_logger(name="fingerprint_sections", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Registry of fingerprint sections run by generate_fingerprint.py.
+Every section declares its name, command-line flag, the sections it depends on and its factory: the function, which
+generates and applies the section as factory(journal, args) and returns the list of applied RegistryOperation.
+Plugins give the factory as "module:function" reference, which is imported only when the section is selected;
+built-in factories of generate_fingerprint import their generator modules on call, so e.g. a telemetry only run
+never loads the system and hardware generators or the identity tables.
+Extra sections are discovered through the "antios.sections" entry point group; each entry point refers to a Section
+object. Entry points are scanned only when the command line asks for it, because scanning installed distributions
+takes longer than the rest of the start-up. Example of a plugin package setup.cfg:
+
+    [options.entry_points]
+    antios.sections =
+        bios = antios_bios:SECTION
+
+where antios_bios.py holds SECTION = Section("bios", "--bios", "Generate BIOS identifiers", "antios_bios_impl:run")
+"""
+
+ENTRY_POINT_GROUP = "antios.sections"
+
+
+class Section(collections.namedtuple("Section", ["name", "flag", "help", "factory", "requires", "default"])):
+    """
+    Declaration of the fingerprint section. name - unique name, also used in metrics, flag - command-line option,
+    factory - function or its "module:function" reference, requires - tuple of names of sections which are run
+    before this one whenever it is selected, default - run the section if no section is selected
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, flag, help, factory, requires=(), default=False):
+        return super().__new__(cls, name, flag, help, factory, tuple(requires), default)
+
+    @property
+    def dest(self):
+        """
+        :return: attribute name of the flag in parsed arguments
+        """
+        return self.flag.lstrip("-").replace("-", "_")
+
+    def load(self):
+        """
+        Import the factory module if the factory is given by reference
+        :return: factory function
+        """
+        if callable(self.factory):
+            return self.factory
+        module_name, _, function_name = self.factory.partition(":")
+        return getattr(importlib.import_module(module_name), function_name)
+
+
+def iter_entry_points(group=ENTRY_POINT_GROUP):
+    """
+    :return: entry points of the group of installed distributions, empty list before Python 3.8
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        return []
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        return entry_points.select(group=group)
+    return entry_points.get(group, [])
+
+
+def discover_sections(group=ENTRY_POINT_GROUP):
+    """
+    Load section declarations of installed plugins. Broken plugins are logged and skipped
+    :return: list of Section
+    """
+    sections = []
+    for entry_point in iter_entry_points(group):
+        try:
+            section = entry_point.load()
+        except Exception as e:
+            logger.warning("Unable to load fingerprint section plugin {0}: {1}".format(entry_point.name, e))
+            continue
+        if not isinstance(section, Section):
+            logger.warning("Entry point {0} does not refer to a Section object".format(entry_point.name))
+            continue
+        sections.append(section)
+    return sections
+
+
+def available_sections(builtin_sections, plugins=False):
+    """
+    :param builtin_sections: iterable of Section
+    :param plugins: add sections discovered through entry points
+    :return: ordered dictionary section name -> Section, built-in sections first
+    """
+    sections = collections.OrderedDict((section.name, section) for section in builtin_sections)
+    if plugins:
+        for section in discover_sections():
+            if section.name in sections:
+                logger.warning("Fingerprint section {0} is already registered, plugin ignored".format(section.name))
+                continue
+            sections[section.name] = section
+    return sections
+
+
+def resolve(sections, selected):
+    """
+    Add dependencies of selected sections and order them so every section runs after the ones it requires
+    :param sections: ordered dictionary section name -> Section
+    :param selected: iterable of selected section names
+    :return: list of Section in run order
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name not in sections:
+            raise ValueError("Unknown fingerprint section {0}".format(name))
+        section = sections[name]
+        if section in ordered:
+            return
+        if name in visiting:
+            raise ValueError("Fingerprint section {0} depends on itself".format(name))
+        visiting.add(name)
+        for requirement in section.requires:
+            visit(requirement)
+        visiting.discard(name)
+        ordered.append(section)
+
+    # Selected sections run in the order of registration, not in the order of flags
+    selected = set(selected)
+    for name in sections:
+        if name in selected:
+            visit(name)
+    for name in selected - set(sections):
+        visit(name)
+    return ordered
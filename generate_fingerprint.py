@@ -1,136 +1,297 @@
 import os
 import sys
+import json
+import contextlib
 import argparse
 import logging
-import winreg
-import random
+import entropy
 import log_helper
-import system_fingerprint
-import hardware_fingerprint
-import telemetry_fingerprint
 import random_utils
 import registry_helper
+import registry_backend
+import registry_plan
+import registry_journal
+import registry_verify
+import run_metrics
+import fingerprint_sections
+import registry_retry
 
 
 from registry_helper import RegistryKeyType, Wow64RegistryEntry
-from system_utils import is_x64os, platform_version
+from registry_plan import RegistryOperation
+from system_utils import is_x64os, get_system_info, load_system_info, set_system_info
 
 logger = log_helper.setup_logger(name="antidetect", level=logging.INFO, log_to_file=False)
 
+# suppress() without exceptions is a no-op context manager, contextlib.nullcontext needs Python 3.7
+_NO_PHASE = contextlib.suppress()
 
-def generate_telemetry_fingerprint():
+# Report files of --what-if runs
+WHAT_IF_PLAN = "plan.jsonl"
+WHAT_IF_CHANGES = "changes.jsonl"
+WHAT_IF_TIMING = "timing.json"
+
+
+def memory_phase(name):
+    """
+    Mark the phase of the run for memory accounting. memory_report is imported only by runs which track memory,
+    --memory-report and "benchmark.py --memory", other runs get a no-op context
+    :param name: memory_report phase name, e.g. "apply"
+    :return: context manager
+    """
+    memory_report = sys.modules.get("memory_report")
+    if memory_report is None:
+        return _NO_PHASE
+    return memory_report.phase(name)
+
+
+def generate_telemetry_fingerprint(journal=None):
     """
     IDs related to Windows 10 Telemetry
     All the telemetry is getting around the DeviceID registry value
     It can be found in the following kays:
     HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\SQMClient
     HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Diagnostics\\DiagTrack\\SettingsRequests
+    :return: list of applied RegistryOperation
     """
-    windows_ver = platform_version()
-    if not windows_ver.startswith("Windows-10"):
+    if get_system_info().os_major != 10:
         logger.warning("Telemetry ID replace available for Windows 10 only")
-        return
+        return []
 
     current_device_id = registry_helper.read_value(
         key_hive="HKEY_LOCAL_MACHINE",
         key_path="SOFTWARE\\Microsoft\\SQMClient",
-        value_name="MachineId")
-    if current_device_id[1] == winreg.REG_SZ:
+        value_name="MachineId",
+        missing_ok=True)
+    if current_device_id is None:
+        logger.warning("HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\SQMClient Value:MachineId not found, "
+                       "Telemetry DeviceID is not changed")
+        return []
+    if current_device_id[1] == registry_backend.REG_SZ:
         logger.info("Current Windows 10 Telemetry DeviceID is {0}".format(current_device_id[0]))
     else:
         logger.warning("Unexpected type of HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\SQMClient Value:MachineId Type:%d" %
                        current_device_id[1])
-        return
+        return []
 
-    telemetry_fp = telemetry_fingerprint.TelemetryFingerprint()
-    device_id = telemetry_fp.random_device_id_guid()
-    device_id_brackets = "{%s}" % telemetry_fp.random_device_id_guid()
+    import telemetry_fingerprint
+    with memory_phase("generation"):
+        telemetry_profile = telemetry_fingerprint.TelemetryProfile.generate()
+    device_id = telemetry_profile.device_id_guid
+    device_id_brackets = telemetry_profile.device_id_brackets
     logger.info("New Windows 10 Telemetry DeviceID is {0}".format(device_id_brackets))
 
-    registry_helper.write_value(key_hive="HKEY_LOCAL_MACHINE",
-                                key_path="SOFTWARE\\Microsoft\\SQMClient",
-                                value_name="MachineId",
-                                value_type=winreg.REG_SZ,
-                                key_value=device_id_brackets)
+    plan = [RegistryOperation(key_hive="HKEY_LOCAL_MACHINE",
+                              key_path="SOFTWARE\\Microsoft\\SQMClient",
+                              value_name="MachineId",
+                              value_type=registry_backend.REG_SZ,
+                              key_value=device_id_brackets)]
 
-    # Replace queries
+    # Replace queries. They are planned from a single enumeration pass and applied with the MachineId, so the journal
+    # holds their original values and recovery restores the whole telemetry identity
     query_path = "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Diagnostics\\DiagTrack\\SettingsRequests"
-    setting_requests = registry_helper.enumerate_key_subkeys(key_hive="HKEY_LOCAL_MACHINE",
-                                                             key_path=query_path)
-    logger.debug("SettingsRequest subkeys: {0}".format(setting_requests))
-
-    for request in setting_requests:
-        query_params = registry_helper.read_value(key_hive="HKEY_LOCAL_MACHINE",
-                                                  key_path="%s\\%s" % (query_path, request),
-                                                  value_name="ETagQueryParameters")
-        if query_params[1] != winreg.REG_SZ:
-            logger.warning("Unexpected type of %s\\%s Value:MachineId Type:%d" % (query_path, request, query_params[1]))
-            return
-
-        query_string = query_params[0]
-        new_query_string = query_string.replace(current_device_id[0], device_id)
-        registry_helper.write_value(key_hive="HKEY_LOCAL_MACHINE",
-                                    key_path="%s\\%s" % (query_path, request),
-                                    value_name="ETagQueryParameters",
-                                    value_type=winreg.REG_SZ,
-                                    key_value=new_query_string)
+    queries = registry_helper.read_subkeys_value(
+        key_hive="HKEY_LOCAL_MACHINE",
+        key_path=query_path,
+        value_name="ETagQueryParameters",
+        value_type=registry_backend.REG_SZ)
+    unchanged = 0
+    if queries is not None:
+        for subkey_name, value_name, query_string in queries.values:
+            new_query_string = query_string.replace(current_device_id[0], device_id)
+            if new_query_string == query_string:
+                unchanged += 1
+                continue
+            plan.append(RegistryOperation(key_hive="HKEY_LOCAL_MACHINE",
+                                          key_path="{0}\\{1}".format(query_path, subkey_name),
+                                          value_name=value_name,
+                                          value_type=registry_backend.REG_SZ,
+                                          key_value=new_query_string))
+        run_metrics.add(run_metrics.VALUES_SKIPPED, unchanged + queries.skipped)
+        run_metrics.add(run_metrics.VALUES_FAILED, queries.failed)
+
+    with memory_phase("apply"):
+        result = registry_plan.apply_plan(plan, journal)
+    if queries is not None:
+        logger.info("SettingsRequests ETagQueryParameters: {0} planned, {1} unchanged, {2} skipped, "
+                    "{3} failed to read; {4} of {5} telemetry values written".format(
+                        len(plan) - 1, unchanged, queries.skipped, queries.failed, result.written, len(plan)))
 
     logger.debug("DeviceID has been replaced from %s to %s" % (current_device_id, device_id))
+    return plan
 
 
-def generate_network_fingerprint():
+def build_network_plan(random_host, random_user):
+    """
+    :param random_host: new hostname
+    :param random_user: new registered owner user name
+    :return: list of RegistryOperation
+    """
+    hive = "HKEY_LOCAL_MACHINE"
+    return [
+        RegistryOperation(key_hive=hive,
+                          key_path="SYSTEM\\CurrentControlSet\\services\\Tcpip\\Parameters",
+                          value_name="NV Hostname",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=random_host),
+        RegistryOperation(key_hive=hive,
+                          key_path="SYSTEM\\CurrentControlSet\\services\\Tcpip\\Parameters",
+                          value_name="Hostname",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=random_host),
+        RegistryOperation(key_hive=hive,
+                          key_path="SYSTEM\\CurrentControlSet\\Control\\ComputerName\\ComputerName",
+                          value_name="ComputerName",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=random_host),
+        RegistryOperation(key_hive=hive,
+                          key_path="SYSTEM\\CurrentControlSet\\Control\\ComputerName\\ActiveComputerName",
+                          value_name="ComputerName",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=random_host),
+        RegistryOperation(key_hive=hive,
+                          key_path="SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion",
+                          value_name="RegisteredOwner",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=random_user,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64)
+    ]
+
+
+def generate_network_fingerprint(journal=None):
     """
     Generate network-related identifiers:
     Hostname (from pre-defined list)
     Username (from pre-defined list)
     MAC address (from pre-defined list)
+    :return: list of applied RegistryOperation
     """
-    random_host = random_utils.random_hostname()
-    random_user = random_utils.random_username()
-    random_mac = random_utils.random_mac_address()
+    with memory_phase("generation"):
+        random_host = random_utils.random_hostname()
+        random_user = random_utils.random_username()
+        random_mac = random_utils.random_mac_address()
     logger.info("Random hostname value is {0}".format(random_host))
     logger.info("Random username value is {0}".format(random_user))
     logger.info("Random MAC addresses value is {0}".format(random_mac))
 
+    with memory_phase("plan"):
+        plan = build_network_plan(random_host, random_user)
+    with memory_phase("apply"):
+        registry_plan.apply_plan(plan, journal)
+    return plan
+
+
+def build_windows_plan(windows_profile):
+    """
+    :param windows_profile: system_fingerprint.WindowsProfile object
+    :return: list of RegistryOperation
+    """
     hive = "HKEY_LOCAL_MACHINE"
-    logger.debug("Tcpip\\Parameters NV Hostname={0}".format(random_host))
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SYSTEM\\CurrentControlSet\\services\\Tcpip\\Parameters",
-                                value_name="NV Hostname",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=random_host)
-
-    logger.debug("Tcpip\\Parameters Hostname={0}".format(random_host))
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SYSTEM\\CurrentControlSet\\services\\Tcpip\\Parameters",
-                                value_name="Hostname",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=random_host)
-
-    logger.debug("Tcpip\\Parameters ComputerName={0}".format(random_host))
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SYSTEM\\CurrentControlSet\\Control\\ComputerName\\ComputerName",
-                                value_name="ComputerName",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=random_host)
-
-    logger.debug("ComputerName\\ActiveComputerName ComputerName={0}".format(random_host))
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SYSTEM\\CurrentControlSet\\Control\\ComputerName\\ActiveComputerName",
-                                value_name="ComputerName",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=random_host)
-
-    logger.debug("Windows NT\\CurrentVersion RegisteredOwner={0}".format(random_user))
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion",
-                                value_name="RegisteredOwner",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=random_user,
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-
-def generate_windows_fingerprint():
+    version_path = "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion"
+    ie_path = "SOFTWARE\\Microsoft\\Internet Explorer"
+    return [
+        # Windows fingerprint
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="BuildGUID",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.build_guid,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="BuildLab",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.build_lab,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="BuildLabEx",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.build_lab_ex,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="CurrentBuild",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.current_build,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="CurrentBuildNumber",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.current_build,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="CurrentVersion",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.current_version,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="DigitalProductId",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=windows_profile.digital_product_id),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="DigitalProductId4",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=windows_profile.digital_product_id4),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="EditionID",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.edition_id,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="InstallDate",
+                          value_type=RegistryKeyType.REG_DWORD,
+                          key_value=windows_profile.install_date),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="ProductId",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.product_id,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=version_path,
+                          value_name="ProductName",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.product_name,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        # IE fingerprint
+        RegistryOperation(key_hive=hive,
+                          key_path=ie_path,
+                          value_name="svcKBNumber",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.ie_service_update,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64),
+        RegistryOperation(key_hive=hive,
+                          key_path=ie_path + "\\Registration",
+                          value_name="ProductId",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=windows_profile.product_id),
+        RegistryOperation(key_hive=hive,
+                          key_path=ie_path + "\\Registration",
+                          value_name="DigitalProductId",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=windows_profile.digital_product_id),
+        RegistryOperation(key_hive=hive,
+                          key_path=ie_path + "\\Registration",
+                          value_name="DigitalProductId4",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=windows_profile.digital_product_id4),
+        RegistryOperation(key_hive=hive,
+                          key_path=ie_path + "\\Migration",
+                          value_name="IE Installed Date",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=windows_profile.ie_install_date,
+                          access_type=Wow64RegistryEntry.KEY_WOW32_64)
+    ]
+
+
+def generate_windows_fingerprint(journal=None):
     """
     Generate common Windows identifiers, responsible for fingerprinting:
     BuildGUID
@@ -150,164 +311,118 @@ def generate_windows_fingerprint():
     IE DigitalProductId
     IE DigitalProductId4
     IE Installed Date
+    :return: list of applied RegistryOperation
+    """
+    import system_fingerprint
+    with memory_phase("generation"):
+        windows_profile = system_fingerprint.WindowsProfile.generate()
+    logger.info("IEDate={0}".format(windows_profile.ie_install_date))
+
+    with memory_phase("plan"):
+        plan = build_windows_plan(windows_profile)
+    with memory_phase("apply"):
+        registry_plan.apply_plan(plan, journal)
+
+    logger.info("Random build GUID {0}".format(windows_profile.build_guid))
+    logger.info("Random BuildLab {0}".format(windows_profile.build_lab))
+    logger.info("Random BuildLabEx {0}".format(windows_profile.build_lab_ex))
+    logger.info("Random Current Build {0}".format(windows_profile.current_build))
+    logger.info("Random Current Build number {0}".format(windows_profile.current_build))
+    logger.info("Random Current Version {0}".format(windows_profile.current_version))
+    logger.info("Random Edition ID {0}".format(windows_profile.edition_id))
+    logger.info("Random Install Date {0}".format(windows_profile.install_date))
+    logger.info("Random product ID {0}".format(windows_profile.product_id))
+    logger.info("Random Product name {0}".format(windows_profile.product_name))
+    logger.debug("Random digital product ID {0}".format(windows_profile.digital_product_id))
+    logger.debug("Random digital product ID 4 {0}".format(windows_profile.digital_product_id4))
+    logger.debug("Random IE service update {0}".format(windows_profile.ie_service_update))
+    logger.debug("Random IE install data {0}".format(windows_profile.ie_install_date))
+    return plan
+
+
+def build_hardware_plan(hardware_profile):
+    """
+    :param hardware_profile: hardware_fingerprint.HardwareProfile object
+    :return: list of RegistryOperation
     """
-    system_fp = system_fingerprint.WinFingerprint()
-
-    # Windows fingerprint
     hive = "HKEY_LOCAL_MACHINE"
-    version_path = "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion"
+    return [
+        # Hardware profile GUID
+        RegistryOperation(key_hive=hive,
+                          key_path="SYSTEM\\CurrentControlSet\\Control\\IDConfigDB\\Hardware Profiles\\0001",
+                          value_name="HwProfileGuid",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=hardware_profile.hw_profile_guid),
+        # Machine GUID
+        RegistryOperation(key_hive=hive,
+                          key_path="SOFTWARE\\Microsoft\\Cryptography",
+                          value_name="MachineGuid",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=hardware_profile.machine_guid),
+        # Windows Update GUID
+        RegistryOperation(key_hive=hive,
+                          key_path="SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate",
+                          value_name="SusClientId",
+                          value_type=RegistryKeyType.REG_SZ,
+                          key_value=hardware_profile.win_update_guid),
+        RegistryOperation(key_hive=hive,
+                          key_path="SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate",
+                          value_name="SusClientIDValidation",
+                          value_type=RegistryKeyType.REG_BINARY,
+                          key_value=hardware_profile.client_id_validation)
+    ]
+
+
+def build_profile_plan(network=True, system=True, hardware=True, hostname=None, username=None):
+    """
+    Generate the new random profile of selected sections as a single plan without writing anything,
+    e.g. to save it and apply it later or to another image
+    :param hostname: hostname of the network section, random if None
+    :param username: registered owner of the network section, random if None
+    :return: list of RegistryOperation
+    """
+    import system_fingerprint
+    import hardware_fingerprint
+    plan = []
+    if network:
+        plan.extend(build_network_plan(hostname if hostname is not None else random_utils.random_hostname(),
+                                       username if username is not None else random_utils.random_username()))
+    if system:
+        plan.extend(build_windows_plan(system_fingerprint.WindowsProfile.generate()))
+    if hardware:
+        plan.extend(build_hardware_plan(hardware_fingerprint.HardwareProfile.generate()))
+    return plan
+
+
+def volume_id_helper_path():
+    """
+    :return: path of VolumeID helper executable matching the system architecture
+    """
+    import bundle_resources
+    return os.path.join(bundle_resources.application_dir(), "bin",
+                        "VolumeID{0}.exe".format("64" if is_x64os() else ""))
+
 
-    logger.debug("Windows NT\\CurrentVersion BuildGUID")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="BuildGUID",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_build_guid(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion BuildLab")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="BuildLab",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_build_lab(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion BuildLabEx")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="BuildLabEx",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_build_lab_ex(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion CurrentBuild")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="CurrentBuild",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_current_build(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion CurrentBuildNumber")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="CurrentBuildNumber",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_current_build(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion CurrentVersion")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="CurrentVersion",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_current_version(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion DigitalProductId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="DigitalProductId",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=random_utils.bytes_list_to_array(system_fp.random_digital_product_id()))
-
-    logger.debug("Windows NT\\CurrentVersion DigitalProductId4")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="DigitalProductId4",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=random_utils.bytes_list_to_array(system_fp.random_digital_product_id4()))
-
-    logger.debug("Windows NT\\CurrentVersion EditionID")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="EditionID",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_edition_id(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion InstallDate")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="InstallDate",
-                                value_type=RegistryKeyType.REG_DWORD,
-                                key_value=system_fp.random_install_date())
-
-    logger.debug("Windows NT\\CurrentVersion ProductId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="ProductId",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_product_id(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Windows NT\\CurrentVersion ProductName")
-    registry_helper.write_value(key_hive=hive,
-                                key_path=version_path,
-                                value_name="ProductName",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_product_name(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    # IE fingerprint
-    logger.debug("Microsoft\\Internet Explorer svcKBNumber")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Internet Explorer",
-                                value_name="svcKBNumber",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_ie_service_update(),
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.debug("Microsoft\\Internet Explorer ProductId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Internet Explorer\\Registration",
-                                value_name="ProductId",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=system_fp.random_product_id())
-
-    logger.debug("Microsoft\\Internet Explorer DigitalProductId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Internet Explorer\\Registration",
-                                value_name="DigitalProductId",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=random_utils.bytes_list_to_array(system_fp.random_digital_product_id()))
-
-    logger.debug("Internet Explorer\\Registration DigitalProductId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Internet Explorer\\Registration",
-                                value_name="DigitalProductId4",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=random_utils.bytes_list_to_array(system_fp.random_digital_product_id4()))
-
-    ie_install_date = system_fp.random_ie_install_date()
-    logger.info("IEDate={0}".format(ie_install_date))
-
-    logger.debug("Internet Explorer\\Migration IE Installed Date")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Internet Explorer\\Migration",
-                                value_name="IE Installed Date",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=ie_install_date,
-                                access_type=Wow64RegistryEntry.KEY_WOW32_64)
-
-    logger.info("Random build GUID {0}".format(system_fp.random_build_guid()))
-    logger.info("Random BuildLab {0}".format(system_fp.random_build_lab()))
-    logger.info("Random BuildLabEx {0}".format(system_fp.random_build_lab_ex()))
-    logger.info("Random Current Build {0}".format(system_fp.random_current_build()))
-    logger.info("Random Current Build number {0}".format(system_fp.random_current_build()))
-    logger.info("Random Current Version {0}".format(system_fp.random_current_version()))
-    logger.info("Random Edition ID {0}".format(system_fp.random_edition_id()))
-    logger.info("Random Install Date {0}".format(system_fp.random_install_date()))
-    logger.info("Random product ID {0}".format(system_fp.random_product_id()))
-    logger.info("Random Product name {0}".format(system_fp.random_product_name()))
-    logger.debug("Random digital product ID {0}".format(system_fp.random_digital_product_id()))
-    logger.debug("Random digital product ID 4 {0}".format(system_fp.random_digital_product_id4()))
-    logger.debug("Random IE service update {0}".format(system_fp.random_ie_service_update()))
-    logger.debug("Random IE install data {0}".format(system_fp.random_ie_install_date()))
-
-
-def generate_hardware_fingerprint():
+def change_volume_id(volume_id, volume_image=None, volume_index=None):
+    """
+    Change system drive volume ID. If the image is given, the boot sector of its system volume is patched directly,
+    otherwise VolumeID helper is used, which is available for the live registry backend only,
+    the volume of the running system is not related to other backends
+    :param volume_id: new Volume ID, XXXX-XXXX
+    :param volume_image: optional raw disk image or partition file of the system volume
+    :param volume_index: index of the volume in the image, None for the Windows system volume
+    """
+    if volume_image is not None:
+        import volume_serial
+        volume_serial.write_volume_serial(volume_image, volume_id, volume_index)
+        return
+    if not registry_backend.is_live(registry_helper.get_backend()):
+        logger.warning("Volume ID change is available for the live Windows registry or --volume-image only")
+        return
+    os.system("{0} C: {1}".format(volume_id_helper_path(), volume_id))
+
+
+def generate_hardware_fingerprint(journal=None, volume_image=None, volume_index=None):
     """
     Generate hardware-related identifiers:
     HwProfileGuid
@@ -315,106 +430,387 @@ def generate_hardware_fingerprint():
     Volume ID
     SusClientId
     SusClientIDValidation
+    :return: list of applied RegistryOperation
     """
+    import hardware_fingerprint
+    with memory_phase("generation"):
+        hardware_profile = hardware_fingerprint.HardwareProfile.generate()
 
-    hardware_fp = hardware_fingerprint.HardwareFingerprint()
+    with memory_phase("plan"):
+        plan = build_hardware_plan(hardware_profile)
+    with memory_phase("apply"):
+        registry_plan.apply_plan(plan, journal)
 
-    hive = "HKEY_LOCAL_MACHINE"
-    # Hardware profile GUID
-
-    logger.debug("Hardware Profiles\\0001 HwProfileGuid")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SYSTEM\\CurrentControlSet\\Control\\IDConfigDB\\Hardware Profiles\\0001",
-                                value_name="HwProfileGuid",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=hardware_fp.random_hw_profile_guid())
-
-    # Machine GUID
-    logger.debug("Microsoft\\Cryptography MachineGuid")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Cryptography",
-                                value_name="MachineGuid",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=hardware_fp.random_machine_guid())
-
-    # Windows Update GUID
-    logger.debug("CurrentVersion\\WindowsUpdate SusClientId")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate",
-                                value_name="SusClientId",
-                                value_type=RegistryKeyType.REG_SZ,
-                                key_value=hardware_fp.random_win_update_guid())
-
-    logger.debug("CurrentVersion\\WindowsUpdate SusClientIDValidation")
-    registry_helper.write_value(key_hive=hive,
-                                key_path="SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate",
-                                value_name="SusClientIDValidation",
-                                value_type=RegistryKeyType.REG_BINARY,
-                                key_value=random_utils.bytes_list_to_array(hardware_fp.random_client_id_validation()))
-
-    dir_name = os.path.join(os.path.dirname(__file__), "bin")
     volume_id = random_utils.random_volume_id()
     logger.info("VolumeID={0}".format(volume_id))
-    volume_id_path = os.path.join(dir_name, "VolumeID{0}.exe C: {1}".format("64" if is_x64os() else "", volume_id))
-    os.system(volume_id_path)
+    change_volume_id(volume_id, volume_image, volume_index)
+
+    logger.info("Random Hardware profile GUID {0}".format(hardware_profile.hw_profile_guid))
+    logger.info("Random Hardware CKCL GUID {0}".format(hardware_profile.performance_guid))
+    logger.info("Random Machine GUID {0}".format(hardware_profile.machine_guid))
+    logger.info("Random Windows Update GUID {0}".format(hardware_profile.win_update_guid))
+    logger.debug("Random Windows Update Validation ID {0}".format(hardware_profile.win_update_guid))
+    return plan
+
+
+def telemetry_section(journal, args):
+    """
+    Factory of the telemetry section
+    """
+    return generate_telemetry_fingerprint(journal)
+
 
-    logger.info("Random Hardware profile GUID {0}".format(hardware_fp.random_hw_profile_guid()))
-    logger.info("Random Hardware CKCL GUID {0}".format(hardware_fp.random_performance_guid()))
-    logger.info("Random Machine GUID {0}".format(hardware_fp.random_machine_guid()))
-    logger.info("Random Windows Update GUID {0}".format(hardware_fp.random_win_update_guid()))
-    logger.debug("Random Windows Update Validation ID {0}".format(hardware_fp.random_win_update_guid()))
+def network_section(journal, args):
+    """
+    Factory of the network section
+    """
+    return generate_network_fingerprint(journal)
 
 
-def main():
+def system_section(journal, args):
+    """
+    Factory of the system section
+    """
+    return generate_windows_fingerprint(journal)
+
+
+def hardware_section(journal, args):
+    """
+    Factory of the hardware section
+    """
+    # What-if runs change no disk images
+    return generate_hardware_fingerprint(journal, args.volume_image if not args.what_if else None, args.volume_index)
+
+
+SECTIONS = (
+    fingerprint_sections.Section("telemetry", "--telemetry", "Generate Windows 10 Telemetry IDs",
+                                 telemetry_section),
+    fingerprint_sections.Section("network", "--network", "Generate network-related fingerprint",
+                                 network_section, default=True),
+    fingerprint_sections.Section("system", "--system", "Generate fingerprint based on system version and identifiers",
+                                 system_section, default=True),
+    fingerprint_sections.Section("hardware", "--hardware", "Generate fingerprint based on hardware identifiers",
+                                 hardware_section, default=True),
+)
+
+
+def main(argv=None):
     """
     Generate and change/spoof Windows identification to protect user from local installed software
+    :param argv: command-line arguments, sys.argv[1:] if None
     :return: Exec return code
     """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Plugin sections are looked up only if built-in sections do not know some options, because scanning
+    # installed distributions takes longer than the rest of the start-up
+    sections = fingerprint_sections.available_sections(SECTIONS)
+    if "-h" in argv or "--help" in argv or build_parser(sections).parse_known_args(argv)[1]:
+        sections = fingerprint_sections.available_sections(SECTIONS, plugins=True)
+    args = build_parser(sections).parse_args(argv)
+    args.sections = sections
+    if args.journal_dir is None:
+        args.journal_dir = default_journal_dir()
+    return run_tracked(args)
+
+
+def default_journal_dir():
+    """
+    :return: journal directory next to the bundle file or the source modules
+    """
+    import bundle_resources
+    return os.path.join(bundle_resources.application_dir(), "journal")
+
 
+def build_parser(sections):
+    """
+    :param sections: ordered dictionary section name -> fingerprint_sections.Section
+    :return: argparse.ArgumentParser of the command line
+    """
     parser = argparse.ArgumentParser(description='Command-line parameters')
 
-    parser.add_argument('--telemetry',
-                        help='Generate Windows 10 Telemetry IDs',
-                        action='store_true',
+    for section in sections.values():
+        parser.add_argument(section.flag,
+                            help=section.help,
+                            dest=section.dest,
+                            action='store_true',
+                            required=False,
+                            default=False)
+
+    parser.add_argument('--journal-dir',
+                        help='Directory of the write-ahead journal of registry changes, journal next to the program '
+                             'by default',
                         required=False,
-                        default=False)
+                        default=None)
 
-    parser.add_argument('--network',
-                        help='Generate network-related fingerprint',
+    parser.add_argument('--journal-batch',
+                        help='Number of journaled registry operations flushed to disk at once',
+                        type=int,
+                        required=False,
+                        default=registry_journal.DEFAULT_BATCH_SIZE)
+
+    parser.add_argument('--no-journal',
+                        help='Do not journal registry changes',
                         action='store_true',
                         required=False,
                         default=False)
 
-    parser.add_argument('--system',
-                        help='Generate fingerprint based on system version and identifiers',
+    parser.add_argument('--recover',
+                        help='Roll incomplete journals of interrupted runs forward or back and exit',
+                        choices=[registry_journal.RECOVER_FORWARD, registry_journal.RECOVER_BACK],
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--no-verify',
+                        help='Do not read back and verify written values',
                         action='store_true',
                         required=False,
                         default=False)
 
-    parser.add_argument('--hardware',
-                        help='Generate fingerprint based on hardware identifiers',
+    parser.add_argument('--import-reg',
+                        help='Import .reg file instead of generating the fingerprint',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--hive-dir',
+                        help='Apply changes to offline SYSTEM and SOFTWARE hive files in this directory, '
+                             'e.g. Windows\\System32\\config of a mounted disk image',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--volume-image',
+                        help='Change Volume ID in this raw disk image or partition file of the system volume',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--volume-index',
+                        help='Index of the volume in --volume-image to change, in partition table order of NTFS and '
+                             'FAT volumes; by default the only NTFS volume or the largest one',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--seed',
+                        help='Generate reproducible identifiers from this seed instead of the system CSPRNG',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--profile-out',
+                        help='Profile the run: write cProfile stats to this file and sampled collapsed stacks '
+                             'for flame graphs to the same path with .collapsed suffix',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--memory-report',
+                        help='Trace memory allocations and report them by phase and module at the end of the run',
                         action='store_true',
                         required=False,
                         default=False)
 
-    args = parser.parse_args()
+    parser.add_argument('--metrics-out',
+                        help='Write run metrics in Prometheus text format to this .prom file, '
+                             'e.g. in the node_exporter textfile collector directory',
+                        required=False,
+                        default=None)
 
-    # Selected nothing means select all
-    if args.telemetry is False and args.network is False and args.system is False and args.hardware is False:
-        args.network = True
-        args.system = True
-        args.hardware = True
+    parser.add_argument('--retries',
+                        help='Maximum number of attempts of a registry call failed with a transient error, '
+                             'e.g. a sharing violation while another process holds the key; 1 disables retries',
+                        type=int,
+                        required=False,
+                        default=registry_retry.DEFAULT_ATTEMPTS)
 
-    if args.telemetry:
-        generate_telemetry_fingerprint()
-    if args.network:
-        generate_network_fingerprint()
-    if args.system:
-        generate_windows_fingerprint()
-    if args.hardware:
-        generate_hardware_fingerprint()
+    parser.add_argument('--operation-timeout',
+                        help='Deadline of a single registry call with all its retries, seconds, 0 for no deadline',
+                        type=float,
+                        required=False,
+                        default=registry_retry.DEFAULT_OPERATION_TIMEOUT)
 
-    return 0
+    parser.add_argument('--run-timeout',
+                        help='Seconds after the start, when transient registry errors are no longer retried, '
+                             '0 for no deadline',
+                        type=float,
+                        required=False,
+                        default=registry_retry.DEFAULT_RUN_TIMEOUT)
+
+    parser.add_argument('--what-if',
+                        help='Dry run: stage all writes in memory on top of the registry, which is only read, and '
+                             'write the resulting plan, changes and timing to this directory',
+                        required=False,
+                        default=None)
+
+    return parser
+
+
+def run_tracked(args):
+    """
+    Start tracking of the run and run it. Run metrics are always collected for the latency report,
+    memory and profile tracking are opt-in
+    :param args: parsed command-line arguments
+    :return: Exec return code
+    """
+    run_metrics.start_collecting()
+    if args.memory_report:
+        import memory_report
+        memory_report.start_tracking()
+        # Identity tables are loaded up front, so their cost is reported as the import phase
+        with memory_report.phase(memory_report.PHASE_IMPORT):
+            random_utils.identity_tables()
+    exit_code = 1
+    try:
+        if args.profile_out:
+            import run_profiler
+            with run_profiler.profile_to(args.profile_out):
+                exit_code = run(args)
+        else:
+            exit_code = run(args)
+        return exit_code
+    finally:
+        if args.memory_report:
+            memory_report.log_report(memory_report.stop_tracking())
+        metrics = run_metrics.stop_collecting()
+        for line in run_metrics.format_report(metrics):
+            logger.info(line)
+        if args.metrics_out:
+            run_metrics.write_textfile(metrics, args.metrics_out, exit_code == 0)
+        if args.what_if:
+            os.makedirs(args.what_if, exist_ok=True)
+            with open(os.path.join(args.what_if, WHAT_IF_TIMING), "w", encoding="utf-8") as timing_file:
+                json.dump(metrics.timing(), timing_file, indent=2, sort_keys=True)
+
+
+def run(args):
+    """
+    Select the registry backend, system info and entropy source and run
+    :param args: parsed command-line arguments
+    :return: Exec return code
+    """
+    source = entropy.DeterministicEntropy(args.seed) if args.seed is not None else None
+    with entropy.use_source(source):
+        if args.hive_dir:
+            import regf_hive
+            offline_registry = regf_hive.OfflineRegistry.open_directory(args.hive_dir, writable=not args.what_if)
+            previous_backend = registry_helper.set_backend(offline_registry)
+            previous_info = set_system_info(offline_registry.system_info())
+            try:
+                return run_backend(offline_registry, args)
+            finally:
+                set_system_info(previous_info)
+                registry_helper.set_backend(previous_backend)
+                offline_registry.close()
+
+        load_system_info()
+        return run_backend(registry_helper.get_backend(), args)
+
+
+def retry_policy(args):
+    """
+    :param args: parsed command-line arguments
+    :return: registry_retry.RetryPolicy of the run
+    """
+    return registry_retry.RetryPolicy(attempts=args.retries,
+                                      operation_timeout=args.operation_timeout or None,
+                                      run_timeout=args.run_timeout or None)
+
+
+def run_backend(backend, args):
+    """
+    Run against the backend, or with --what-if against the overlay on top of it, and save the what-if report
+    :param backend: registry backend
+    :param args: parsed command-line arguments
+    :return: Exec return code
+    """
+    backend = registry_retry.retrying(backend, retry_policy(args))
+    if not args.what_if:
+        with registry_helper.use_backend(run_metrics.instrument(backend)):
+            return run_sections(args)
+
+    import registry_overlay
+    overlay = registry_overlay.OverlayRegistry(backend)
+    with registry_helper.use_backend(run_metrics.instrument(overlay)):
+        exit_code = run_sections(args)
+    os.makedirs(args.what_if, exist_ok=True)
+    plan = overlay.staged_plan()
+    registry_plan.save_plan(plan, os.path.join(args.what_if, WHAT_IF_PLAN))
+    changes = registry_overlay.save_changes(overlay.changes(), os.path.join(args.what_if, WHAT_IF_CHANGES))
+    logger.info("What-if run staged {0} values, {1} of them change the registry, report written to {2}".format(
+        len(plan), changes, args.what_if))
+    return exit_code
+
+
+def journal_target(args):
+    """
+    :param args: parsed command-line arguments
+    :return: journal target of the run, the live registry or the offline hive directory
+    """
+    if args.hive_dir:
+        return registry_journal.offline_target(args.hive_dir)
+    return registry_journal.LIVE_TARGET
+
+
+def run_sections(args):
+    """
+    Recover or journal and run selected fingerprint sections against the current registry backend
+    :param args: parsed command-line arguments
+    :return: Exec return code
+    """
+    target = journal_target(args)
+    incomplete_journals = []
+    other_journals = []
+    for journal_path in registry_journal.find_incomplete(args.journal_dir):
+        if registry_journal.read_target(journal_path) == target:
+            incomplete_journals.append(journal_path)
+        else:
+            other_journals.append(journal_path)
+    # Journals of other targets are never replayed here, e.g. a journal of an offline image against the live registry
+    for journal_path in other_journals:
+        logger.warning("Incomplete journal {0} was written for {1}, recover it with a run against that target".format(
+            journal_path, registry_journal.read_target(journal_path) or "unknown target"))
+
+    if args.recover:
+        for journal_path in incomplete_journals:
+            registry_journal.recover(journal_path, args.recover, target)
+        return 1 if other_journals else 0
+    if incomplete_journals:
+        logger.error("Found incomplete journals of interrupted runs, use --recover forward or --recover back: "
+                     "{0}".format(", ".join(incomplete_journals)))
+        return 1
+
+    # What-if runs write nothing, so there is nothing to journal
+    no_journal = args.no_journal or args.what_if is not None
+    if args.import_reg:
+        journal = None
+        if not no_journal:
+            journal = registry_journal.WriteAheadJournal.create(args.journal_dir, args.journal_batch, target)
+        import reg_file
+        result = reg_file.apply_reg_file(args.import_reg, journal)
+        if journal is not None:
+            journal.commit()
+        logger.info("Imported {0}: {1} written, {2} failed".format(args.import_reg, result.written, result.failed))
+        return 1 if result.failed else 0
+
+    # Selected nothing means select all default sections
+    selected = [name for name, section in args.sections.items() if getattr(args, section.dest)]
+    if not selected:
+        selected = [name for name, section in args.sections.items() if section.default]
+
+    journal = None
+    if not no_journal:
+        journal = registry_journal.WriteAheadJournal.create(args.journal_dir, args.journal_batch, target)
+
+    applied = []
+    for section in fingerprint_sections.resolve(args.sections, selected):
+        with run_metrics.section(section.name):
+            applied.extend(section.load()(journal, args))
+
+    if journal is not None:
+        journal.commit()
+
+    if args.no_verify:
+        return 0
+    with memory_phase("apply"), run_metrics.section("verify"):
+        report = registry_verify.verify_plan(applied)
+    registry_verify.log_report(report)
+    return 0 if report.ok else 1
 
 
 ###########################################################################
@@ -1,6 +1,7 @@
-import random
-import uuid
+import sys
 import string
+import entropy
+import collections
 import random_utils
 
 
@@ -9,10 +10,11 @@ class HardwareFingerprint:
     Hardware-related GUIDs
     """
     def __init__(self):
-        self.hw_profile_guid = ("{%s}" % str(uuid.uuid4()))
-        self.performance_guid = ("{%s}" % str(uuid.uuid4()))
-        self.machine_guid = str(uuid.uuid4())
-        self.win_update_guid = str(uuid.uuid4())
+        source = entropy.get_source()
+        self.hw_profile_guid = ("{%s}" % source.guid())
+        self.performance_guid = ("{%s}" % source.guid())
+        self.machine_guid = source.guid()
+        self.win_update_guid = source.guid()
         self.system_client_id = self.__random_system_client_id()
 
     def random_hw_profile_guid(self):
@@ -50,19 +52,19 @@ class HardwareFingerprint:
 
     @staticmethod
     def __random_id1():
-        random_id1 = random.choices(string.digits+string.ascii_uppercase, k=19)
+        random_id1 = entropy.get_source().choices(string.digits+string.ascii_uppercase, k=19)
         random_id1_list = random_utils.disperse_string(random_id1)
         return random_id1_list
 
     @staticmethod
     def __random_id2():
-        return random.choices(range(1, 255), k=5)
+        return entropy.get_source().choices(range(1, 255), k=5)
 
     @staticmethod
     def __random_system_client_id():
         system_client_id = [0] * 0x08
         system_client_id[0x00:0x03] = [0x06, 0x02, 0x28, 0x01]
-        system_client_id[0x04:0x06] = random.sample(range(1, 255), 3)
+        system_client_id[0x04:0x06] = entropy.get_source().sample(range(1, 255), 3)
         system_client_id[0x07] = 0
         # 0x08 - Start random part of ID
         system_client_id.extend(HardwareFingerprint.__random_id1())
@@ -70,3 +72,30 @@ class HardwareFingerprint:
         system_client_id.extend(HardwareFingerprint.__random_id2())
         system_client_id.extend(random_utils.disperse_string("None"))
         return system_client_id
+
+
+class HardwareProfile(collections.namedtuple("HardwareProfile", [
+        "hw_profile_guid", "performance_guid", "machine_guid", "win_update_guid", "client_id_validation"])):
+    """
+    Immutable hardware-related GUIDs of the single generated profile, SusClientIDValidation is bytes
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_fingerprint(cls, hardware_fp):
+        """
+        :param hardware_fp: HardwareFingerprint object
+        :return: HardwareProfile object
+        """
+        return cls(hw_profile_guid=sys.intern(hardware_fp.random_hw_profile_guid()),
+                   performance_guid=sys.intern(hardware_fp.random_performance_guid()),
+                   machine_guid=sys.intern(hardware_fp.random_machine_guid()),
+                   win_update_guid=sys.intern(hardware_fp.random_win_update_guid()),
+                   client_id_validation=random_utils.bytes_list_to_array(hardware_fp.random_client_id_validation()))
+
+    @classmethod
+    def generate(cls):
+        """
+        :return: new random HardwareProfile object
+        """
+        return cls.from_fingerprint(HardwareFingerprint())
@@ -0,0 +1,115 @@
+import threading
+import collections
+import entropy
+import random_utils
+
+
+__doc__ = """Indexed identity tables and batch-unique sampling from them.
+The store holds the hostname, username and MAC address tables of identity_data as immutable sequences, with
+case-insensitive duplicates removed, so distinct indices always mean distinct values. A batch of k distinct values
+is drawn with Floyd's algorithm, which touches only k table entries and keeps only k indices, whatever the table
+size. If a hostname or username batch is larger than the table, every entry is used once and the rest are made unique
+by deterministic suffixes, "name-2", "name-3" and so on, instead of drawing again until an unused value comes up.
+MAC address prefixes can not take a suffix, a larger batch of them is an error
+"""
+
+HOSTNAMES = "HOSTNAMES"
+USERNAMES = "USERNAMES"
+MAC_ADDRESSES = "MAC_ADDRESSES"
+
+TABLES = (HOSTNAMES, USERNAMES, MAC_ADDRESSES)
+# Tables whose values stay valid with a "-N" suffix
+SUFFIXED_TABLES = (HOSTNAMES, USERNAMES)
+
+
+class IdentityTable(collections.namedtuple("IdentityTable", ["name", "values"])):
+    """
+    Identity table: name and tuple of distinct values
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_table(name):
+    """
+    :param name: table name, e.g. HOSTNAMES
+    :return: IdentityTable, built from identity_data on first use
+    """
+    table = _tables.get(name)
+    if table is not None:
+        return table
+    if name not in TABLES:
+        raise ValueError("Unknown identity table {0}".format(name))
+    with _tables_lock:
+        table = _tables.get(name)
+        if table is None:
+            seen = set()
+            values = []
+            for value in getattr(random_utils.identity_tables(), name):
+                if value.lower() not in seen:
+                    seen.add(value.lower())
+                    values.append(value)
+            table = _tables[name] = IdentityTable(name, tuple(values))
+    return table
+
+
+def sample_indices(population, k, source=None):
+    """
+    Floyd's sampling: k distinct indices in O(k) time and memory, shuffled afterwards so their order is random too
+    :param population: number of table entries
+    :param k: number of indices, not more than population
+    :param source: EntropySource, entropy.get_source() if None
+    :return: list of k distinct integers in range [0, population)
+    """
+    if k > population:
+        raise ValueError("Sample larger than population")
+    source = entropy.get_source() if source is None else source
+    chosen = set()
+    indices = []
+    bounds = range(population - k + 1, population + 1)
+    for upper, offset in zip(bounds, source.randbelow_many(bounds)):
+        # offset is in [0, upper), the new index upper - 1 is not chosen yet
+        index = offset if offset not in chosen else upper - 1
+        chosen.add(index)
+        indices.append(index)
+    return source.sample(indices, k)
+
+
+def sample_unique(name, k, source=None):
+    """
+    Draw k values, distinct case-insensitively within the batch
+    :param name: table name, e.g. HOSTNAMES
+    :param k: number of values
+    :param source: EntropySource, entropy.get_source() if None
+    :return: list of k values
+    :raise ValueError: k is larger than a table not in SUFFIXED_TABLES
+    """
+    table = get_table(name)
+    population = len(table)
+    if k <= population:
+        return [table[index] for index in sample_indices(population, k, source)]
+    if name not in SUFFIXED_TABLES:
+        raise ValueError("Only {0} distinct {1} values available, {2} requested".format(population, name, k))
+
+    # Every entry once in random order, then numbered rounds over the same order
+    order = sample_indices(population, population, source)
+    values = [table[index] for index in order]
+    used = set(value.lower() for value in values)
+    for position in range(population, k):
+        base = table[order[position % population]]
+        value = "{0}-{1}".format(base, position // population + 1)
+        if value.lower() in used:
+            # The table itself has such a value, e.g. "pc-2" next to "pc": the position makes it unique
+            value = "{0}-{1}".format(value, position)
+        used.add(value.lower())
+        values.append(value)
+    return values
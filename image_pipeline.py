@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import collections
+import concurrent.futures
+import log_helper
+import entropy
+import system_utils
+import registry_helper
+import registry_plan
+import registry_journal
+import registry_verify
+import regf_hive
+import random_utils
+import volume_serial
+import generate_fingerprint
+import profile_archive
+
+logger = log_helper.setup_logger(name="image_pipeline", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Batch application of fingerprint profiles to many offline Windows images.
+The manifest is a JSON lines file, one image per line:
+{"name": "vm01", "hive_dir": "images/vm01/Windows/System32/config", "plan": "profiles/vm01.plan",
+ "volume_image": "images/vm01.img", "volume_index": 1}
+"plan" is optional: without it a new random profile is generated for the image and saved to the plan directory.
+"volume_image" is optional raw disk image or partition file which Volume ID is changed with the hardware section,
+"volume_index" selects its volume if the Windows volume of a full disk image is ambiguous, see volume_serial.
+Changes are made to copies of the hive files, which are swapped in only if the whole image succeeded, so a failed
+image keeps its original hives. An image which could not be put back is reported with needs_restore.
+With a seed, the profile of every image is generated from the seed and the image name, so the run is reproducible.
+Images are processed on a pool of worker processes; the manifest is read lazily and only a bounded number of images
+is submitted at once, so memory use does not depend on the manifest size. A result record is written per image
+"""
+
+
+class ImageTask(collections.namedtuple("ImageTask", ["name", "hive_dir", "plan_path", "volume_image",
+                                                     "volume_index"])):
+    """
+    Single manifest entry. plan_path is None if a new profile has to be generated,
+    volume_image is None if Volume ID is not changed, volume_index is None to patch the Windows volume
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, hive_dir, plan_path=None, volume_image=None, volume_index=None):
+        return super(ImageTask, cls).__new__(cls, name, hive_dir, plan_path, volume_image, volume_index)
+
+
+class ImageResult(collections.namedtuple("ImageResult", ["name", "hive_dir", "plan_path", "written", "failed",
+                                                         "mismatched", "seconds", "error", "needs_restore"])):
+    """
+    Outcome of processing a single image. mismatched is the number of values which did not pass read-back
+    verification, error is None if every value was written and verified and the hives were swapped in; an image
+    with failed or mismatched values gets an error and keeps its original hives. needs_restore is True if the
+    image failed halfway and is left partially changed, e.g. some hives could not be put back
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, hive_dir, plan_path, written, failed, mismatched, seconds, error, needs_restore=False):
+        return super(ImageResult, cls).__new__(cls, name, hive_dir, plan_path, written, failed, mismatched, seconds,
+                                               error, needs_restore)
+
+    @property
+    def ok(self):
+        return self.error is None and self.failed == 0 and self.mismatched == 0
+
+
+class PipelineOptions(collections.namedtuple("PipelineOptions", ["telemetry", "network", "system", "hardware",
+                                                                 "plan_dir", "journal_dir", "seed"])):
+    """
+    Settings shared by all images of the run. journal_dir is None to apply without journal,
+    seed is None to generate profiles from the system CSPRNG
+    """
+    __slots__ = ()
+
+    def __new__(cls, telemetry, network, system, hardware, plan_dir, journal_dir, seed=None):
+        return super(PipelineOptions, cls).__new__(cls, telemetry, network, system, hardware, plan_dir, journal_dir,
+                                                   seed)
+
+
+def iter_manifest(path):
+    """
+    Stream manifest entries. Relative paths are resolved against the manifest directory
+    :return: generator of ImageTask
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as manifest_file:
+        for line in manifest_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            hive_dir = os.path.join(base_dir, record["hive_dir"])
+            plan_path = record.get("plan")
+            volume_image = record.get("volume_image")
+            volume_index = record.get("volume_index")
+            yield ImageTask(name=record.get("name") or os.path.basename(os.path.normpath(hive_dir)),
+                            hive_dir=hive_dir,
+                            plan_path=os.path.join(base_dir, plan_path) if plan_path else None,
+                            volume_image=os.path.join(base_dir, volume_image) if volume_image else None,
+                            volume_index=int(volume_index) if volume_index is not None else None)
+
+
+def result_to_dict(result):
+    return dict(result._asdict())
+
+
+def image_entropy(task, options):
+    """
+    :return: DeterministicEntropy of the run seed and the image name, None if the run is not seeded
+    """
+    if options.seed is None:
+        return None
+    return entropy.DeterministicEntropy("{0}:{1}".format(options.seed, task.name))
+
+
+def restore_volume_serial(task, volume_id):
+    """
+    Put back the Volume ID of the failed image
+    :return: True if restored
+    """
+    try:
+        volume_serial.write_volume_serial(task.volume_image, volume_id, task.volume_index)
+        return True
+    except Exception as e:
+        logger.error("Unable to restore Volume ID {0} of image {1}: {2}".format(volume_id, task.name, e))
+        return False
+
+
+def process_image(task, options):
+    """
+    Apply a loaded or newly generated profile to the single image. Runs in the worker process
+    :param task: ImageTask
+    :param options: PipelineOptions
+    :return: ImageResult
+    """
+    start_time = time.time()
+    plan_path = task.plan_path
+    written = failed = mismatched = 0
+    needs_restore = False
+    with entropy.use_source(image_entropy(task, options)):
+        try:
+            offline_registry = regf_hive.OfflineRegistry.open_staged(task.hive_dir)
+            journal = None
+            previous_volume_id = None
+            try:
+                previous_backend = registry_helper.set_backend(offline_registry)
+                previous_info = system_utils.set_system_info(offline_registry.system_info())
+                try:
+                    if plan_path is None:
+                        plan = generate_fingerprint.build_profile_plan(options.network, options.system,
+                                                                       options.hardware)
+                        plan_path = os.path.join(options.plan_dir, "{0}.plan".format(task.name))
+                        registry_plan.save_plan(plan, plan_path)
+                    else:
+                        plan = registry_plan.load_plan(plan_path)
+
+                    if options.journal_dir is not None:
+                        journal = registry_journal.WriteAheadJournal.create(
+                            os.path.join(options.journal_dir, task.name),
+                            target=registry_journal.offline_target(task.hive_dir))
+                    if options.telemetry:
+                        generate_fingerprint.generate_telemetry_fingerprint(journal)
+                    result = registry_plan.apply_plan(plan, journal)
+                    written, failed = result.written, result.failed
+                    mismatched = registry_verify.verify_plan(plan, workers=1).failed
+                    if failed or mismatched:
+                        # A partially applied profile is never swapped in, the image keeps its original hives
+                        raise RuntimeError("{0} values were not written, {1} did not pass read-back "
+                                           "verification".format(failed, mismatched))
+                    if options.hardware and task.volume_image is not None:
+                        previous_volume_id = volume_serial.write_volume_serial(
+                            task.volume_image, random_utils.random_volume_id(), task.volume_index)
+                finally:
+                    system_utils.set_system_info(previous_info)
+                    registry_helper.set_backend(previous_backend)
+                try:
+                    offline_registry.commit()
+                except regf_hive.StagedCommitError:
+                    needs_restore = True
+                    raise
+            except Exception:
+                offline_registry.discard()
+                if previous_volume_id is not None and not needs_restore:
+                    needs_restore = not restore_volume_serial(task, previous_volume_id)
+                if journal is not None:
+                    # The journal of a partially changed image stays incomplete
+                    journal.close(None if needs_restore else "discarded")
+                raise
+            if journal is not None:
+                journal.commit()
+        except Exception as e:
+            if needs_restore:
+                logger.error("Image {0} failed and is left partially changed, restore it: {1}".format(task.name, e))
+            else:
+                logger.error("Image {0} failed, original hives are kept: {1}".format(task.name, e))
+            return ImageResult(task.name, task.hive_dir, plan_path, written, failed, mismatched,
+                               time.time() - start_time, str(e), needs_restore)
+    return ImageResult(task.name, task.hive_dir, plan_path, written, failed, mismatched, time.time() - start_time,
+                       None)
+
+
+def run_pipeline(tasks, options, workers=None, max_in_flight=None):
+    """
+    Process images on the pool of worker processes
+    :param tasks: iterable of ImageTask, consumed lazily
+    :param options: PipelineOptions
+    :param workers: number of worker processes, number of CPU cores if None
+    :param max_in_flight: maximum number of submitted but not finished images, twice the workers if None
+    :return: generator of ImageResult in order of completion
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or workers * 2, 1)
+    tasks = iter(tasks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                else:
+                    in_flight.add(executor.submit(process_image, task, options))
+            if not in_flight:
+                break
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def main(argv=None):
+    """
+    Apply fingerprint profiles to all images of the manifest
+    :return: Exec return code, 1 if any image failed
+    """
+    parser = argparse.ArgumentParser(description='Apply fingerprint profiles to many offline Windows images')
+
+    parser.add_argument('manifest',
+                        help='JSON lines manifest of images')
+
+    parser.add_argument('--results',
+                        help='JSON lines file to write per-image result records to',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--plan-dir',
+                        help='Directory to save generated profiles to',
+                        required=False,
+                        default="profiles")
+
+    parser.add_argument('--journal-dir',
+                        help='Directory of per-image write-ahead journals',
+                        required=False,
+                        default="journal")
+
+    parser.add_argument('--no-journal',
+                        help='Do not journal registry changes',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--workers',
+                        help='Number of worker processes, number of CPU cores by default',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--max-in-flight',
+                        help='Maximum number of images submitted to workers at once, twice the workers by default',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--archive',
+                        help='SQLite profile archive to record applied profiles and their images in',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--seed',
+                        help='Generate reproducible profiles from this seed and the image names',
+                        required=False,
+                        default=None)
+
+    for section in ("telemetry", "network", "system", "hardware"):
+        parser.add_argument('--{0}'.format(section),
+                            help='Apply {0} section'.format(section),
+                            action='store_true',
+                            required=False,
+                            default=False)
+
+    args = parser.parse_args(argv)
+
+    # Selected nothing means select all
+    if not (args.telemetry or args.network or args.system or args.hardware):
+        args.network = args.system = args.hardware = True
+
+    os.makedirs(args.plan_dir, exist_ok=True)
+    options = PipelineOptions(telemetry=args.telemetry,
+                              network=args.network,
+                              system=args.system,
+                              hardware=args.hardware,
+                              plan_dir=os.path.abspath(args.plan_dir),
+                              journal_dir=None if args.no_journal else os.path.abspath(args.journal_dir),
+                              seed=args.seed)
+
+    results_file = open(args.results, "w", encoding="utf-8") if args.results else None
+    succeeded = failed = restore = 0
+    applied = []
+    try:
+        for result in run_pipeline(iter_manifest(args.manifest), options, args.workers, args.max_in_flight):
+            if result.ok:
+                succeeded += 1
+                applied.append((result.name, result.plan_path))
+                logger.info("Image {0}: {1} written in {2:.2f} s".format(result.name, result.written, result.seconds))
+            else:
+                failed += 1
+                restore += result.needs_restore
+            if results_file is not None:
+                results_file.write(json.dumps(result_to_dict(result), sort_keys=True))
+                results_file.write("\n")
+                results_file.flush()
+    finally:
+        if results_file is not None:
+            results_file.close()
+
+    logger.info("Images processed: {0} succeeded, {1} failed".format(succeeded, failed))
+    if restore:
+        logger.error("{0} images are left partially changed and have to be restored, see needs_restore in the "
+                     "results".format(restore))
+    if args.archive:
+        with profile_archive.ProfileArchive(args.archive) as archive:
+            count = archive.add_many((registry_plan.load_plan(plan_path), name, None) for name, plan_path in applied)
+        logger.info("{0} applied profiles recorded in {1}".format(count, args.archive))
+    return 1 if failed else 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
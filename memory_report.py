@@ -0,0 +1,238 @@
+import os
+import json
+import logging
+import compileall
+import importlib
+import tracemalloc
+import contextlib
+import collections
+import log_helper
+
+logger = log_helper.setup_logger(name="memory_report", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Opt-in memory accounting of runs with tracemalloc.
+Code marks its phases with phase(), which does nothing unless tracking was started with start_tracking(). For every
+phase the report holds the memory allocated and kept by it, its peak of traced memory and the modules which
+allocated most, so e.g. the cost of loading the identity tables is visible separately from plan building.
+The peak of the standard run is checked against the stored budget by "python benchmark.py --memory"
+"""
+
+PHASE_IMPORT = "import"
+PHASE_GENERATION = "generation"
+PHASE_PLAN = "plan"
+PHASE_APPLY = "apply"
+
+# Number of modules listed per phase
+DEFAULT_TOP_MODULES = 5
+
+# Allocations made by tracemalloc and by the accounting itself are never reported
+_EXCLUDED_FILES = (tracemalloc.__file__, __file__)
+
+
+class PhaseStats(collections.namedtuple("PhaseStats", ["name", "allocated", "peak", "modules"])):
+    """
+    Memory of the phase, summed over all its runs. allocated - bytes allocated and not freed by the phase,
+    peak - largest traced memory during the phase, modules - list of (module, allocated bytes), largest first
+    """
+    __slots__ = ()
+
+
+class MemoryReport(collections.namedtuple("MemoryReport", ["phases", "peak", "current"])):
+    """
+    Tracked run: list of PhaseStats in order of first run, peak and final traced memory in bytes
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return {"peak": self.peak,
+                "current": self.current,
+                "phases": [{"name": stats.name, "allocated": stats.allocated, "peak": stats.peak,
+                            "modules": stats.modules} for stats in self.phases]}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(phases=[PhaseStats(name=stats["name"], allocated=stats["allocated"], peak=stats["peak"],
+                                      modules=[tuple(module) for module in stats["modules"]])
+                           for stats in record["phases"]],
+                   peak=record["peak"],
+                   current=record["current"])
+
+    def format(self):
+        """
+        :return: list of report lines
+        """
+        lines = ["Traced memory: peak {0}, at the end {1}".format(format_size(self.peak), format_size(self.current))]
+        for stats in self.phases:
+            modules = ", ".join("{0} {1}".format(module, format_size(size, signed=True))
+                                for module, size in stats.modules)
+            lines.append("  {0:<10} allocated {1:>10}, peak {2:>10}: {3}".format(
+                stats.name, format_size(stats.allocated, signed=True), format_size(stats.peak), modules))
+        return lines
+
+
+def format_size(size, signed=False):
+    """
+    :return: size in human readable units, e.g. "1.5 MB"
+    """
+    sign = ("+" if size >= 0 else "-") if signed else ""
+    size = abs(size)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return "{0}{1:.1f} {2}".format(sign, size, unit) if unit != "B" else "{0}{1} B".format(sign, size)
+        size /= 1024.0
+
+
+def _module_name(filename):
+    if filename.startswith("<"):
+        # Frozen modules, e.g. <frozen importlib._bootstrap_external> which allocates code objects of imported modules
+        return filename.strip("<>")
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _sizes_by_file():
+    """
+    :return: dictionary source file name -> traced bytes, computed right away so the snapshot itself is freed
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, filename)
+                                                          for filename in _EXCLUDED_FILES])
+    return dict((statistic.traceback[0].filename, statistic.size) for statistic in snapshot.statistics("filename"))
+
+
+class MemoryTracker:
+    """
+    Accumulates per-phase statistics while tracemalloc is tracing
+    """
+    def __init__(self, top_modules=DEFAULT_TOP_MODULES):
+        self.top_modules = top_modules
+        self.peak = 0
+        self._allocated = collections.OrderedDict()
+        self._peaks = {}
+        self._files = {}
+
+    def _snapshot(self):
+        """
+        Account the peak since the previous snapshot and take the new one. Peaks are reset after every snapshot
+        (Python 3.9+), so the memory of snapshots themselves is not included in them
+        :return: tuple (traced memory before the snapshot, after it, peak, dictionary file name -> traced bytes)
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        sizes = _sizes_by_file()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return current, tracemalloc.get_traced_memory()[0], peak, sizes
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Allocated memory is counted between the end of the first snapshot and the start of the second one
+        _, before, _, before_files = self._snapshot()
+        try:
+            yield
+        finally:
+            after, _, peak, after_files = self._snapshot()
+            self._allocated[name] = self._allocated.get(name, 0) + after - before
+            self._peaks[name] = max(self._peaks.get(name, 0), peak)
+            files = self._files.setdefault(name, {})
+            for filename in set(before_files) | set(after_files):
+                files[filename] = files.get(filename, 0) + after_files.get(filename, 0) - before_files.get(filename, 0)
+
+    def report(self):
+        """
+        :return: MemoryReport of phases tracked so far
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        phases = []
+        for name, allocated in self._allocated.items():
+            modules = collections.Counter()
+            for filename, size in self._files[name].items():
+                modules[_module_name(filename)] += size
+            phases.append(PhaseStats(name=name,
+                                     allocated=allocated,
+                                     peak=self._peaks[name],
+                                     modules=[(module, size) for module, size in modules.most_common()
+                                              if size > 0][:self.top_modules]))
+        return MemoryReport(phases=phases, peak=max(self.peak, peak), current=current)
+
+
+_tracker = None
+
+
+def start_tracking(top_modules=DEFAULT_TOP_MODULES):
+    """
+    Start tracemalloc and per-phase accounting
+    :return: MemoryTracker object
+    """
+    global _tracker
+    tracemalloc.start()
+    _tracker = MemoryTracker(top_modules)
+    return _tracker
+
+
+def stop_tracking():
+    """
+    Stop tracemalloc
+    :return: MemoryReport of the tracked run, None if tracking was not started
+    """
+    global _tracker
+    if _tracker is None:
+        return None
+    report = _tracker.report()
+    tracemalloc.stop()
+    _tracker = None
+    return report
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Account the code inside the context to the phase if tracking is started, do nothing otherwise
+    :param name: phase name, e.g. PHASE_GENERATION
+    """
+    if _tracker is None:
+        yield
+        return
+    with _tracker.phase(name):
+        yield
+
+
+def log_report(report):
+    for line in report.format():
+        logger.info(line)
+
+
+def measure_standard_run():
+    """
+    Run all fingerprint sections against the in-memory registry stand-in of Windows 10 x64 with tracking.
+    Fingerprint modules are imported inside the import phase, so it has to be called in a fresh interpreter.
+    Bytecode is compiled beforehand: compiling the identity tables would take several times more memory than
+    loading them
+    :return: MemoryReport
+    """
+    compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), maxlevels=0, quiet=1)
+    start_tracking()
+    try:
+        with phase(PHASE_IMPORT):
+            benchmark = importlib.import_module("benchmark")
+            importlib.import_module("random_utils").identity_tables()
+        registry_helper = importlib.import_module("registry_helper")
+        system_utils = importlib.import_module("system_utils")
+        generate_fingerprint = importlib.import_module("generate_fingerprint")
+        registry = benchmark.windows10_registry()
+        with registry_helper.use_backend(registry), \
+                system_utils.use_system_info(system_utils.SystemInfo.windows(10)):
+            logging.disable(logging.WARNING)
+            try:
+                generate_fingerprint.main(["--no-journal"])
+            finally:
+                logging.disable(logging.NOTSET)
+    finally:
+        report = stop_tracking()
+    return report
+
+
+def standard_run_json():
+    """
+    :return: JSON of measure_standard_run() report, for the parent process of the fresh interpreter
+    """
+    return json.dumps(measure_standard_run().to_dict())
@@ -0,0 +1,326 @@
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import argparse
+import itertools
+import collections
+import log_helper
+import identity_store
+import registry_plan
+import generate_fingerprint
+
+logger = log_helper.setup_logger(name="profile_archive", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Archive of generated profiles in a single SQLite database file.
+Every profile is stored with its plan and the identifiers it is looked up by: hostname, MachineGuid, MAC address
+and the name of the VM it was assigned to, each with its own index, so lookups stay fast at millions of profiles.
+Plans are stored as zlib-compressed JSON. Profiles are added in bulk within a single transaction and exported
+as JSON lines by iterating the cursor, so neither direction loads the whole archive into memory
+"""
+
+# Number of profiles inserted with a single executemany() call during bulk insert
+INSERT_BATCH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY,
+    vm_name TEXT,
+    hostname TEXT,
+    machine_guid TEXT,
+    mac_address TEXT,
+    created REAL NOT NULL,
+    plan BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS profiles_vm_name ON profiles (vm_name);
+CREATE INDEX IF NOT EXISTS profiles_hostname ON profiles (hostname COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS profiles_machine_guid ON profiles (machine_guid COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS profiles_mac_address ON profiles (mac_address COLLATE NOCASE);
+"""
+
+_COLUMNS = "id, vm_name, hostname, machine_guid, mac_address, created, plan"
+
+# Indexed lookup columns and their collation
+_LOOKUPS = collections.OrderedDict([("vm_name", ""),
+                                    ("hostname", " COLLATE NOCASE"),
+                                    ("machine_guid", " COLLATE NOCASE"),
+                                    ("mac_address", " COLLATE NOCASE")])
+
+
+class ArchivedProfile(collections.namedtuple("ArchivedProfile", ["profile_id", "vm_name", "hostname", "machine_guid",
+                                                                 "mac_address", "created", "plan"])):
+    """
+    Stored profile. vm_name is None until the profile is assigned, plan is the list of RegistryOperation
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return {"id": self.profile_id,
+                "vm_name": self.vm_name,
+                "hostname": self.hostname,
+                "machine_guid": self.machine_guid,
+                "mac_address": self.mac_address,
+                "created": self.created,
+                "plan": [registry_plan.operation_to_dict(operation) for operation in self.plan]}
+
+
+def encode_plan(plan):
+    """
+    :return: compressed JSON of the plan
+    """
+    return zlib.compress(json.dumps([registry_plan.operation_to_dict(operation) for operation in plan],
+                                    sort_keys=True).encode("utf-8"))
+
+
+def decode_plan(blob):
+    """
+    :return: list of RegistryOperation
+    """
+    return [registry_plan.operation_from_dict(record) for record in json.loads(zlib.decompress(blob).decode("utf-8"))]
+
+
+def plan_identifiers(plan):
+    """
+    :param plan: iterable of RegistryOperation
+    :return: tuple (hostname, MachineGuid), None for identifiers the plan does not change
+    """
+    hostname = machine_guid = None
+    for operation in plan:
+        if operation.value_name == "Hostname" and operation.key_path.endswith("Tcpip\\Parameters"):
+            hostname = operation.key_value
+        elif operation.value_name == "MachineGuid" and operation.key_path.endswith("Cryptography"):
+            machine_guid = operation.key_value
+    return hostname, machine_guid
+
+
+def _row_to_profile(row):
+    return ArchivedProfile(profile_id=row[0], vm_name=row[1], hostname=row[2], machine_guid=row[3],
+                           mac_address=row[4], created=row[5], plan=decode_plan(row[6]))
+
+
+class ProfileArchive:
+    """
+    SQLite archive of generated profiles
+    """
+    def __init__(self, path):
+        """
+        :param path: database file path, created if it does not exist
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _row(plan, vm_name, mac_address, created):
+        hostname, machine_guid = plan_identifiers(plan)
+        return vm_name, hostname, machine_guid, mac_address, created, encode_plan(plan)
+
+    def add(self, plan, vm_name=None, mac_address=None):
+        """
+        :param plan: list of RegistryOperation
+        :param vm_name: name of the VM the profile is assigned to
+        :param mac_address: MAC address of the profile, if any
+        :return: profile ID
+        """
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO profiles (vm_name, hostname, machine_guid, mac_address, created, plan) "
+                "VALUES (?, ?, ?, ?, ?, ?)", self._row(plan, vm_name, mac_address, time.time()))
+        return cursor.lastrowid
+
+    def add_many(self, profiles):
+        """
+        Insert profiles within a single transaction, nothing is inserted if any of them fails
+        :param profiles: iterable of (plan, vm_name, mac_address) tuples, consumed lazily
+        :return: number of inserted profiles
+        """
+        created = time.time()
+        rows = (self._row(plan, vm_name, mac_address, created) for plan, vm_name, mac_address in profiles)
+        count = 0
+        with self._connection:
+            while True:
+                batch = list(itertools.islice(rows, INSERT_BATCH_SIZE))
+                if not batch:
+                    break
+                self._connection.executemany(
+                    "INSERT INTO profiles (vm_name, hostname, machine_guid, mac_address, created, plan) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", batch)
+                count += len(batch)
+        return count
+
+    def assign(self, profile_id, vm_name):
+        """
+        Record that the profile went to the VM
+        :return: True if the profile exists, False otherwise
+        """
+        with self._connection:
+            cursor = self._connection.execute("UPDATE profiles SET vm_name = ? WHERE id = ?", (vm_name, profile_id))
+        return cursor.rowcount == 1
+
+    def get(self, profile_id):
+        """
+        :return: ArchivedProfile, None if there is no such profile
+        """
+        row = self._connection.execute("SELECT {0} FROM profiles WHERE id = ?".format(_COLUMNS),
+                                       (profile_id,)).fetchone()
+        return _row_to_profile(row) if row is not None else None
+
+    def find(self, **identifiers):
+        """
+        Look profiles up by indexed identifiers, e.g. find(hostname="DESKTOP-1"); hostname, MachineGuid and MAC address
+        are compared case-insensitively
+        :param identifiers: vm_name, hostname, machine_guid and/or mac_address values, all of them have to match
+        :return: list of ArchivedProfile
+        """
+        conditions = []
+        for column in identifiers:
+            if column not in _LOOKUPS:
+                raise ValueError("Profiles can not be looked up by {0}".format(column))
+            conditions.append("{0} = ?{1}".format(column, _LOOKUPS[column]))
+        if not conditions:
+            raise ValueError("At least one identifier is required")
+        cursor = self._connection.execute("SELECT {0} FROM profiles WHERE {1} ORDER BY id".format(
+            _COLUMNS, " AND ".join(conditions)), list(identifiers.values()))
+        return [_row_to_profile(row) for row in cursor]
+
+    def count(self):
+        """
+        :return: number of stored profiles
+        """
+        return self._connection.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+
+    def iter_profiles(self, unassigned_only=False):
+        """
+        Stream stored profiles in order of insertion
+        :param unassigned_only: skip profiles assigned to a VM
+        :return: generator of ArchivedProfile
+        """
+        query = "SELECT {0} FROM profiles{1} ORDER BY id".format(_COLUMNS,
+                                                                " WHERE vm_name IS NULL" if unassigned_only else "")
+        for row in self._connection.execute(query):
+            yield _row_to_profile(row)
+
+    def export(self, path):
+        """
+        Write all profiles to JSON lines file incrementally
+        :return: number of exported profiles
+        """
+        count = 0
+        with open(path, "w", encoding="utf-8") as export_file:
+            for profile in self.iter_profiles():
+                export_file.write(json.dumps(profile.to_dict(), sort_keys=True))
+                export_file.write("\n")
+                count += 1
+        return count
+
+
+def iter_generated(count, network=True, system=True, hardware=True):
+    """
+    Hostnames, usernames and MAC addresses are unique within the batch
+    :return: generator of count new (plan, None, MAC address) tuples for ProfileArchive.add_many()
+    :raise ValueError: count is larger than the MAC address table, raised before the first profile
+    """
+    if not network:
+        for _ in range(count):
+            yield generate_fingerprint.build_profile_plan(network, system, hardware), None, None
+        return
+    hostnames = identity_store.sample_unique(identity_store.HOSTNAMES, count)
+    usernames = identity_store.sample_unique(identity_store.USERNAMES, count)
+    mac_addresses = identity_store.sample_unique(identity_store.MAC_ADDRESSES, count)
+    for hostname, username, mac_address in zip(hostnames, usernames, mac_addresses):
+        plan = generate_fingerprint.build_profile_plan(network, system, hardware, hostname, username)
+        yield plan, None, mac_address
+
+
+def main(argv=None):
+    """
+    Pre-generate, look up and export archived profiles
+    :return: Exec return code
+    """
+    parser = argparse.ArgumentParser(description='Archive of generated fingerprint profiles')
+
+    parser.add_argument('archive',
+                        help='SQLite archive file')
+
+    parser.add_argument('--generate',
+                        help='Generate this number of new profiles into the archive',
+                        type=int,
+                        required=False,
+                        default=0)
+
+    parser.add_argument('--assign',
+                        help='Assign profile with this ID to the VM given by --vm',
+                        type=int,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--vm',
+                        help='Find profile assigned to this VM, or the VM name to assign to',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--hostname',
+                        help='Find profiles with this hostname',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--machine-guid',
+                        help='Find profiles with this MachineGuid',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--mac',
+                        help='Find profiles with this MAC address',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--export',
+                        help='Export all profiles to this JSON lines file',
+                        required=False,
+                        default=None)
+
+    args = parser.parse_args(argv)
+
+    with ProfileArchive(args.archive) as archive:
+        if args.generate:
+            try:
+                count = archive.add_many(iter_generated(args.generate))
+            except ValueError as error:
+                logger.error("Unable to generate {0} profiles: {1}".format(args.generate, error))
+                return 1
+            logger.info("{0} profiles generated, {1} in the archive".format(count, archive.count()))
+        if args.assign is not None:
+            if not args.vm or not archive.assign(args.assign, args.vm):
+                logger.error("Unable to assign profile {0} to VM {1}".format(args.assign, args.vm))
+                return 1
+            return 0
+
+        lookups = {"vm_name": args.vm, "hostname": args.hostname, "machine_guid": args.machine_guid,
+                   "mac_address": args.mac}
+        lookups = dict((column, value) for column, value in lookups.items() if value is not None)
+        if lookups:
+            for profile in archive.find(**lookups):
+                print(json.dumps(profile.to_dict(), sort_keys=True))
+        if args.export:
+            count = archive.export(args.export)
+            logger.info("{0} profiles exported to {1}".format(count, args.export))
+    return 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,45 +1,66 @@
-import os
 import logging
-import string
 import log_helper
-import identity_data
-import random
+import entropy
 import time
 import datetime
 import itertools
 import binascii
+import run_metrics
+import bundle_resources
 
 logger = log_helper.setup_logger(name="random_utils", level=logging.INFO, log_to_file=False)
 
 
 __doc__ = """Service functions for generation random values and sequences with given format.
 Hostname, user name and MAC address, randomly selected from lists imported from identity_data module,
-random unix time, random string sequences. Helper functions for writing special values to Windows registry
+random unix time, random string sequences. Helper functions for writing special values to Windows registry.
+All random values are drawn from the current entropy.get_source(). The large identity_data module is imported on first
+use, so runs which do not need names and addresses do not pay for loading it
 """
 
 
+_identity_tables = None
+
+
+def identity_tables():
+    """
+    :return: identity tables embedded into the bundle if run from it, identity_data module otherwise,
+             loaded on first call
+    """
+    global _identity_tables
+    if _identity_tables is None:
+        start_time = time.perf_counter()
+        tables = bundle_resources.identity_tables()
+        if tables is None:
+            import identity_data
+            tables = identity_data
+        _identity_tables = tables
+        run_metrics.set_value(run_metrics.IDENTITY_TABLES_LOAD, time.perf_counter() - start_time)
+    return _identity_tables
+
+
 def random_hostname():
     """
     :return: random host name from the list
     """
-    logger.info("Length of hostname list is {0}".format(len(identity_data.HOSTNAMES)))
-    return random.choice(identity_data.HOSTNAMES)
+    logger.info("Length of hostname list is {0}".format(len(identity_tables().HOSTNAMES)))
+    return entropy.get_source().choice(identity_tables().HOSTNAMES)
 
 
 def random_username():
     """
     :return: random user name from the list
     """
-    logger.info("Length of username list is {0}".format(len(identity_data.USERNAMES)))
-    return random.choice(identity_data.USERNAMES)
+    logger.info("Length of username list is {0}".format(len(identity_tables().USERNAMES)))
+    return entropy.get_source().choice(identity_tables().USERNAMES)
 
 
 def random_mac_address():
     """
     :return: random user name from the list
     """
-    logger.info("Length of MAC addresses list is {0}".format(len(identity_data.MAC_ADDRESSES)))
-    return random.choice(identity_data.MAC_ADDRESSES)
+    logger.info("Length of MAC addresses list is {0}".format(len(identity_tables().MAC_ADDRESSES)))
+    return entropy.get_source().choice(identity_tables().MAC_ADDRESSES)
 
 
 def random_unix_time(from_date, to_date):
@@ -49,7 +70,7 @@ def random_unix_time(from_date, to_date):
     """
     from_unix = int(time.mktime(datetime.datetime.strptime(from_date, "%d.%m.%Y").timetuple()))
     to_unix = int(time.mktime(datetime.datetime.strptime(to_date, "%d.%m.%Y").timetuple()))
-    return random.randint(from_unix, to_unix)
+    return entropy.get_source().randint(from_unix, to_unix)
 
 
 def random_digit_string(length):
@@ -57,7 +78,7 @@ def random_digit_string(length):
     :param length: size of generated string
     :return: random string of digits
     """
-    return ''.join(random.choices(string.digits, k=length))
+    return entropy.get_source().digit_string(length)
 
 
 def disperse_string(solid_string):
@@ -92,6 +113,5 @@ def random_volume_id():
     """
     :return: Random Volume ID, XXXX-XXXX, where X is a series of numbers and letters
     """
-    x1 = binascii.b2a_hex(os.urandom(2)).decode("utf-8")
-    x2 = binascii.b2a_hex(os.urandom(2)).decode("utf-8")
-    return "{0}-{1}".format(x1, x2)
+    volume_id = binascii.b2a_hex(entropy.get_source().read(4)).decode("utf-8")
+    return "{0}-{1}".format(volume_id[:4], volume_id[4:])
@@ -0,0 +1,352 @@
+import io
+import sys
+import codecs
+import logging
+import argparse
+import itertools
+import log_helper
+import registry_plan
+import registry_helper
+import registry_backend
+
+from registry_helper import Wow64RegistryEntry, WOW64_MAP, HIVES_MAP
+from registry_plan import RegistryOperation, SnapshotEntry
+from system_utils import is_x64os
+
+logger = log_helper.setup_logger(name="reg_file", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Streaming export and import of plans and snapshots in the .reg file format of Registry Editor.
+Files are written as "Windows Registry Editor Version 5.00" in UTF-16 with BOM, like regedit does, and read in both
+this format and "REGEDIT4". Both directions work line by line, so large files are never loaded whole.
+The .reg format has no registry views: 32-bit view entries of HKLM\\SOFTWARE are exported under WOW6432Node and
+imported paths are used as is in the 64-bit view. A snapshot entry of a value which did not exist is exported as
+value deletion ("Name"=-), so the exported snapshot restores the original state when imported
+"""
+
+HEADER_V5 = "Windows Registry Editor Version 5.00"
+HEADER_V4 = "REGEDIT4"
+
+# Hex data lines are wrapped at this width like regedit does
+LINE_WIDTH = 80
+
+# Number of imported operations applied with a single apply_plan() call
+IMPORT_CHUNK_SIZE = 256
+
+_STRING_ESCAPES = {"\\": "\\\\", "\"": "\\\""}
+
+
+#############################################################################
+# Export
+
+def _quote(text):
+    return "\"{0}\"".format("".join(_STRING_ESCAPES.get(char, char) for char in text))
+
+
+def _hex_lines(prefix, raw):
+    """
+    :return: generator of "prefix"xx,xx,... lines wrapped with trailing backslash
+    """
+    line = prefix
+    for index, byte in enumerate(raw):
+        item = "{0:02x}".format(byte) + ("," if index + 1 < len(raw) else "")
+        if len(line) + len(item) > LINE_WIDTH - 2:
+            yield line + "\\"
+            line = "  "
+        line += item
+    yield line
+
+
+def format_value(value_name, value_type, key_value):
+    """
+    :param value_name: value name, empty for the default value
+    :param value_type: winreg value type, None to format value deletion
+    :param key_value: value data, as winreg.SetValueEx() accepts it
+    :return: generator of .reg file lines of the value
+    """
+    name = _quote(value_name) if value_name else "@"
+    if value_type is None:
+        yield name + "=-"
+    elif value_type == registry_backend.REG_SZ and isinstance(key_value, str) and \
+            "\n" not in key_value and "\r" not in key_value and "\0" not in key_value:
+        yield "{0}={1}".format(name, _quote(key_value))
+    elif value_type == registry_backend.REG_DWORD and isinstance(key_value, int):
+        yield "{0}=dword:{1:08x}".format(name, key_value & 0xFFFFFFFF)
+    else:
+        raw = registry_backend.encode_data(value_type, key_value)
+        kind = "hex" if value_type == registry_backend.REG_BINARY else "hex({0:x})".format(value_type)
+        for line in _hex_lines("{0}={1}:".format(name, kind), raw):
+            yield line
+
+
+def _export_path(key_hive, key_path, access_type):
+    parts = registry_backend.split_path(key_path)
+    if is_x64os():
+        parts = registry_backend.wow64_redirect(key_hive, parts, WOW64_MAP[access_type])
+    return "{0}\\{1}".format(key_hive, "\\".join(parts))
+
+
+def _iter_states(records):
+    """
+    :param records: iterable of RegistryOperation or SnapshotEntry
+    :return: generator of (key, value name, winreg type or None, value) tuples
+    """
+    x64 = is_x64os()
+    for record in records:
+        value_type = registry_plan.winreg_type(record.value_type)
+        if x64 and record.access_type == Wow64RegistryEntry.KEY_WOW32_64:
+            access_types = (Wow64RegistryEntry.KEY_WOW32, Wow64RegistryEntry.KEY_WOW64)
+        else:
+            access_types = (record.access_type,)
+        for access_type in access_types:
+            yield _export_path(record.key_hive, record.key_path, access_type), record.value_name, value_type, \
+                record.key_value
+
+
+def iter_reg_lines(records):
+    """
+    Format plan operations or snapshot entries as .reg file lines. Consecutive records of the same key share
+    the key section, so sorted snapshots produce one section per key
+    :param records: iterable of RegistryOperation or SnapshotEntry
+    :return: generator of lines without line breaks
+    """
+    yield HEADER_V5
+    current_key = None
+    for key, value_name, value_type, key_value in _iter_states(records):
+        if current_key is None or key.upper() != current_key.upper():
+            yield ""
+            yield "[{0}]".format(key)
+            current_key = key
+        for line in format_value(value_name, value_type, key_value):
+            yield line
+    yield ""
+
+
+def save_reg_file(records, path):
+    """
+    Write plan operations or snapshot entries to .reg file incrementally
+    :param records: iterable of RegistryOperation or SnapshotEntry
+    :param path: .reg file path
+    :return: number of written lines
+    """
+    count = 0
+    with open(path, "w", encoding="utf-16-le", newline="\r\n") as reg_file:
+        reg_file.write("\ufeff")
+        for line in iter_reg_lines(records):
+            reg_file.write(line)
+            reg_file.write("\n")
+            count += 1
+    return count
+
+
+#############################################################################
+# Import
+
+def _open_text(path):
+    """
+    Open .reg file as text, UTF-16 files are detected by BOM
+    """
+    binary_file = open(path, "rb")
+    bom = binary_file.read(2)
+    binary_file.seek(0)
+    encoding = "utf-16" if bom in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE) else "utf-8-sig"
+    return io.TextIOWrapper(binary_file, encoding=encoding, errors="replace")
+
+
+def _iter_logical_lines(text_file):
+    """
+    Join lines continued with trailing backslash of hex data
+    :return: generator of (line number, line) tuples
+    """
+    pending = None
+    for number, line in enumerate(text_file, 1):
+        line = line.rstrip()
+        if pending is not None:
+            pending = (pending[0], pending[1] + line.strip())
+        else:
+            pending = (number, line)
+        if pending[1].endswith("\\") and "=hex" in pending[1].lower():
+            pending = (pending[0], pending[1][:-1])
+            continue
+        yield pending
+        pending = None
+    if pending is not None:
+        yield pending
+
+
+def _parse_quoted(line, start):
+    """
+    :return: tuple (unescaped string, index after the closing quote)
+    """
+    result = []
+    index = start + 1
+    while index < len(line):
+        char = line[index]
+        if char == "\\" and index + 1 < len(line):
+            result.append(line[index + 1])
+            index += 2
+        elif char == "\"":
+            return "".join(result), index + 1
+        else:
+            result.append(char)
+            index += 1
+    raise ValueError("Unterminated string")
+
+
+def parse_value(line):
+    """
+    Parse .reg file value line
+    :return: tuple (value name, winreg type or None for deletion, value data)
+    """
+    if line.startswith("@"):
+        value_name, index = "", 1
+    elif line.startswith("\""):
+        value_name, index = _parse_quoted(line, 0)
+    else:
+        raise ValueError("Value name expected")
+    data = line[index:].lstrip()
+    if not data.startswith("="):
+        raise ValueError("'=' expected")
+    data = data[1:].strip()
+
+    if data == "-":
+        return value_name, None, None
+    if data.startswith("\""):
+        return value_name, registry_backend.REG_SZ, _parse_quoted(data, 0)[0]
+    if data.lower().startswith("dword:"):
+        return value_name, registry_backend.REG_DWORD, int(data[6:], 16)
+    if data.lower().startswith("hex"):
+        kind, _, hex_data = data.partition(":")
+        value_type = int(kind[4:-1], 16) if kind.lower().startswith("hex(") else registry_backend.REG_BINARY
+        raw = bytes(int(item, 16) for item in hex_data.replace(" ", "").split(",") if item)
+        return value_name, value_type, registry_backend.decode_data(value_type, raw)
+    raise ValueError("Unknown value data format")
+
+
+def _split_key(key):
+    hive, _, key_path = key.partition("\\")
+    hive = hive.upper()
+    if hive not in HIVES_MAP:
+        raise ValueError("Unknown registry hive {0}".format(hive))
+    return hive, key_path
+
+
+def iter_reg_file(path):
+    """
+    Stream value states from .reg file. Value deletions are SnapshotEntry objects which do not exist;
+    key deletions are not supported and skipped with warning
+    :param path: .reg file path
+    :return: generator of SnapshotEntry
+    """
+    with _open_text(path) as text_file:
+        lines = _iter_logical_lines(text_file)
+        header = next(lines, (0, ""))[1].strip()
+        if header not in (HEADER_V5, HEADER_V4):
+            raise ValueError("{0} is not a registry file".format(path))
+        key = None
+        for number, line in lines:
+            line = line.strip()
+            if not line or line.startswith(";"):
+                continue
+            try:
+                if line.startswith("[-"):
+                    logger.warning("{0}:{1}: key deletion is not supported, skipped".format(path, number))
+                    key = None
+                elif line.startswith("["):
+                    key = _split_key(line[1:line.rindex("]")])
+                elif key is not None:
+                    value_name, value_type, key_value = parse_value(line)
+                    yield SnapshotEntry(key_hive=key[0], key_path=key[1], value_name=value_name,
+                                        access_type=Wow64RegistryEntry.KEY_WOW64, value_type=value_type,
+                                        key_value=key_value)
+            except ValueError as e:
+                logger.warning("{0}:{1}: {2}, line skipped".format(path, number, e))
+
+
+def iter_reg_operations(path):
+    """
+    Stream operations from .reg file in file order, value deletions are operations without value type
+    :return: generator of RegistryOperation
+    """
+    for entry in iter_reg_file(path):
+        yield RegistryOperation(key_hive=entry.key_hive,
+                                key_path=entry.key_path,
+                                value_name=entry.value_name,
+                                value_type=entry.value_type,
+                                key_value=entry.key_value,
+                                access_type=entry.access_type)
+
+
+def _create_keys(operations, known_keys):
+    """
+    Create the keys of written values which do not exist yet, like regedit does
+    :param operations: list of RegistryOperation
+    :param known_keys: set of keys created or opened before, updated
+    """
+    backend = registry_helper.get_backend()
+    for operation in operations:
+        key = (operation.key_hive.upper(), operation.key_path.upper(), int(operation.access_type))
+        if operation.deletes or key in known_keys:
+            continue
+        known_keys.add(key)
+        # Existing keys are opened, missing ones are created with their parents
+        registry_key = registry_helper.create_key(operation.key_hive, operation.key_path, operation.access_type)
+        if registry_key is not None:
+            backend.CloseKey(registry_key)
+
+
+def apply_reg_file(path, journal=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Import .reg file into the registry. Writes and value deletions are applied in file order, in chunks with
+    registry_plan.apply_plan(), so all of them are journaled with their original values if journal is given.
+    Missing keys of written values are created like regedit does; key creation is not journaled, so recovery
+    restores the values but leaves the created keys in place, empty
+    :param path: .reg file path
+    :param journal: optional registry_journal.WriteAheadJournal
+    :param chunk_size: number of operations applied at once
+    :return: registry_plan.ApplyResult
+    """
+    written = failed = 0
+    known_keys = set()
+    operations = iter_reg_operations(path)
+    while True:
+        chunk = list(itertools.islice(operations, chunk_size))
+        if not chunk:
+            break
+        _create_keys(chunk, known_keys)
+        result = registry_plan.apply_plan(chunk, journal)
+        written += result.written
+        failed += result.failed
+    return registry_plan.ApplyResult(written=written, failed=failed)
+
+
+def main(argv=None):
+    """
+    Convert saved plan or snapshot JSON lines file to .reg file
+    :return: Exec return code
+    """
+    parser = argparse.ArgumentParser(description='Export plan or snapshot file to .reg file')
+
+    parser.add_argument('input',
+                        help='Plan or snapshot JSON lines file')
+
+    parser.add_argument('output',
+                        help='.reg file to write')
+
+    parser.add_argument('--snapshot',
+                        help='Input is a snapshot file',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    args = parser.parse_args(argv)
+
+    records = registry_plan.iter_snapshot(args.input) if args.snapshot else registry_plan.iter_plan(args.input)
+    lines = save_reg_file(records, args.output)
+    logger.info("{0} lines written to {1}".format(lines, args.output))
+    return 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
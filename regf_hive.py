@@ -0,0 +1,924 @@
+import os
+import mmap
+import shutil
+import time
+import bisect
+import struct
+import logging
+import log_helper
+import system_utils
+import registry_backend
+
+from registry_backend import RegistryError, ERROR_FILE_NOT_FOUND, ERROR_NO_MORE_ITEMS, ERROR_INVALID_HANDLE, \
+    ERROR_NOT_SUPPORTED, ERROR_BADDB, KEY_WOW64_32KEY
+
+logger = log_helper.setup_logger(name="regf_hive", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Offline registry backend working directly with regf hive files, e.g. SYSTEM and SOFTWARE from
+Windows\\System32\\config of a mounted VM disk image. Hive files are memory-mapped; key paths are resolved through
+the key node cells and hash-leaf subkey indexes, writes reuse value cells in place when the new data fits and
+allocate new cells from free space or new hive bins otherwise. The base block sequence numbers and checksum are
+updated on flush, so the hive stays consistent for Windows to load
+"""
+
+BASE_BLOCK_SIZE = 4096
+HBIN_HEADER_SIZE = 32
+HBIN_ALIGNMENT = 4096
+CELL_ALIGNMENT = 8
+NO_OFFSET = 0xFFFFFFFF
+
+# Values larger than this are stored in "db" big data cells since hive format 1.4
+BIG_DATA_THRESHOLD = 16344
+
+KEY_HIVE_ENTRY = 0x0004
+KEY_NO_DELETE = 0x0008
+KEY_COMP_NAME = 0x0020
+VALUE_COMP_NAME = 0x0001
+DATA_RESIDENT = 0x80000000
+
+# Hive files mounted under HKEY_LOCAL_MACHINE from the config directory
+HIVE_FILES = ("SYSTEM", "SOFTWARE")
+
+# Suffixes of hive copies changed by staged runs and of original hives while the copies are swapped in
+STAGED_SUFFIX = ".antios-staged"
+BACKUP_SUFFIX = ".antios-backup"
+
+_FILETIME_EPOCH_OFFSET = 11644473600
+
+
+def _filetime_now():
+    return int((time.time() + _FILETIME_EPOCH_OFFSET) * 10000000)
+
+
+def _align(size, alignment):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def name_hash(name):
+    """
+    :return: "lh" subkey index hash of the key name
+    """
+    result = 0
+    for char in name.upper():
+        result = (result * 37 + ord(char)) & 0xFFFFFFFF
+    return result
+
+
+def _encode_name(name):
+    """
+    :return: tuple (name bytes, True if the name is stored compressed as Latin-1)
+    """
+    try:
+        return name.encode("latin-1"), True
+    except UnicodeEncodeError:
+        return name.encode("utf-16-le"), False
+
+
+def _base_block_checksum(data):
+    checksum = 0
+    for dword in struct.unpack_from("<127I", data, 0):
+        checksum ^= dword
+    if checksum == 0xFFFFFFFF:
+        return 0xFFFFFFFE
+    if checksum == 0:
+        return 1
+    return checksum
+
+
+class HiveFile:
+    """
+    Memory-mapped regf hive file. Cells are addressed by offsets relative to the first hive bin, like the hive
+    format does, key nodes are identified by their cell offsets
+    """
+    def __init__(self, path, writable=True):
+        """
+        :param path: hive file path
+        :param writable: open for modification
+        """
+        self.path = path
+        self.writable = writable
+        self.hive_file = open(path, "r+b" if writable else "rb")
+        self.map = mmap.mmap(self.hive_file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.modified = False
+        try:
+            self._check_base_block()
+            self._scan_bins()
+        except Exception:
+            self.close()
+            raise
+
+    #############################################################################
+    # Structure
+
+    def _check_base_block(self):
+        if len(self.map) < BASE_BLOCK_SIZE + HBIN_HEADER_SIZE or self.map[0:4] != b"regf":
+            raise RegistryError(ERROR_BADDB, "{0} is not a registry hive file".format(self.path))
+        sequence1, sequence2 = struct.unpack_from("<II", self.map, 4)
+        self.major, self.minor = struct.unpack_from("<II", self.map, 20)
+        if self.major != 1 or self.minor < 3:
+            raise RegistryError(ERROR_BADDB, "Unsupported hive format version {0}.{1}".format(self.major, self.minor))
+        if sequence1 != sequence2:
+            raise RegistryError(ERROR_BADDB, "Hive {0} is dirty: it was not unloaded cleanly by Windows or by "
+                                             "an interrupted offline run".format(self.path))
+        if _base_block_checksum(self.map) != struct.unpack_from("<I", self.map, 508)[0]:
+            raise RegistryError(ERROR_BADDB, "Base block checksum mismatch in {0}".format(self.path))
+        self.root_offset = struct.unpack_from("<I", self.map, 36)[0]
+        self.bins_size = struct.unpack_from("<I", self.map, 40)[0]
+
+    def _scan_bins(self):
+        """
+        Walk hive bins and their cells once to collect bin boundaries and free cells
+        """
+        self.bins = []
+        self.free_cells = {}
+        bin_offset = 0
+        while bin_offset < self.bins_size:
+            position = BASE_BLOCK_SIZE + bin_offset
+            if self.map[position:position + 4] != b"hbin":
+                raise RegistryError(ERROR_BADDB, "Damaged hive bin at offset 0x{0:X}".format(bin_offset))
+            bin_size = struct.unpack_from("<I", self.map, position + 8)[0]
+            self.bins.append(bin_offset)
+            cell_offset = bin_offset + HBIN_HEADER_SIZE
+            while cell_offset < bin_offset + bin_size:
+                cell_size = struct.unpack_from("<i", self.map, BASE_BLOCK_SIZE + cell_offset)[0]
+                if cell_size == 0:
+                    raise RegistryError(ERROR_BADDB, "Damaged cell at offset 0x{0:X}".format(cell_offset))
+                if cell_size > 0:
+                    self.free_cells[cell_offset] = cell_size
+                cell_offset += abs(cell_size)
+            bin_offset += bin_size
+        self.bin_ends = self.bins[1:] + [self.bins_size]
+
+    def _bin_end(self, cell_offset):
+        return self.bin_ends[bisect.bisect_right(self.bins, cell_offset) - 1]
+
+    def cell_size(self, cell_offset):
+        """
+        :return: allocated cell size including the 4-byte size field
+        """
+        return -struct.unpack_from("<i", self.map, BASE_BLOCK_SIZE + cell_offset)[0]
+
+    def cell(self, cell_offset, length=None):
+        """
+        :return: cell data bytes, without the size field
+        """
+        position = BASE_BLOCK_SIZE + cell_offset + 4
+        if length is None:
+            length = self.cell_size(cell_offset) - 4
+        return self.map[position:position + length]
+
+    def _unpack(self, fmt, cell_offset, field_offset):
+        return struct.unpack_from(fmt, self.map, BASE_BLOCK_SIZE + cell_offset + 4 + field_offset)
+
+    def _pack(self, fmt, cell_offset, field_offset, *values):
+        self._touch()
+        struct.pack_into(fmt, self.map, BASE_BLOCK_SIZE + cell_offset + 4 + field_offset, *values)
+
+    def _write(self, cell_offset, field_offset, data):
+        self._touch()
+        position = BASE_BLOCK_SIZE + cell_offset + 4 + field_offset
+        self.map[position:position + len(data)] = data
+
+    def _touch(self):
+        if not self.writable:
+            raise RegistryError(registry_backend.ERROR_ACCESS_DENIED, "Hive {0} is read-only".format(self.path))
+        if not self.modified:
+            # Primary sequence number is incremented before the first change, the secondary one on flush
+            sequence1 = struct.unpack_from("<I", self.map, 4)[0]
+            struct.pack_into("<I", self.map, 4, (sequence1 + 1) & 0xFFFFFFFF)
+            struct.pack_into("<I", self.map, 508, _base_block_checksum(self.map))
+            self.modified = True
+
+    #############################################################################
+    # Cell allocation
+
+    def allocate(self, data_size):
+        """
+        Allocate cell for data_size bytes from free cells, append new hive bin if none fits
+        :return: cell offset
+        """
+        size = _align(data_size + 4, CELL_ALIGNMENT)
+        for cell_offset, free_size in self.free_cells.items():
+            if free_size >= size:
+                break
+        else:
+            cell_offset = self._append_bin(size)
+            free_size = self.free_cells[cell_offset]
+        del self.free_cells[cell_offset]
+        self._touch()
+        if free_size - size >= CELL_ALIGNMENT:
+            self.free_cells[cell_offset + size] = free_size - size
+            struct.pack_into("<i", self.map, BASE_BLOCK_SIZE + cell_offset + size, free_size - size)
+        else:
+            size = free_size
+        struct.pack_into("<i", self.map, BASE_BLOCK_SIZE + cell_offset, -size)
+        return cell_offset
+
+    def free(self, cell_offset):
+        """
+        Mark cell as free and merge it with the following free cell of the same bin
+        """
+        if cell_offset == NO_OFFSET:
+            return
+        size = self.cell_size(cell_offset)
+        next_offset = cell_offset + size
+        if next_offset < self._bin_end(cell_offset) and next_offset in self.free_cells:
+            size += self.free_cells.pop(next_offset)
+        self._touch()
+        struct.pack_into("<i", self.map, BASE_BLOCK_SIZE + cell_offset, size)
+        self.free_cells[cell_offset] = size
+
+    def _append_bin(self, cell_size):
+        bin_offset = self.bins_size
+        bin_size = _align(cell_size + HBIN_HEADER_SIZE, HBIN_ALIGNMENT)
+        self._touch()
+        self.map.flush()
+        self.map.close()
+        self.hive_file.truncate(BASE_BLOCK_SIZE + bin_offset + bin_size)
+        self.map = mmap.mmap(self.hive_file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        position = BASE_BLOCK_SIZE + bin_offset
+        self.map[position:position + HBIN_HEADER_SIZE] = struct.pack("<4sIIQQI", b"hbin", bin_offset, bin_size, 0,
+                                                                     _filetime_now(), 0)
+        struct.pack_into("<i", self.map, position + HBIN_HEADER_SIZE, bin_size - HBIN_HEADER_SIZE)
+        self.bins.append(bin_offset)
+        self.bins_size += bin_size
+        self.bin_ends = self.bins[1:] + [self.bins_size]
+        self.free_cells[bin_offset + HBIN_HEADER_SIZE] = bin_size - HBIN_HEADER_SIZE
+        return bin_offset + HBIN_HEADER_SIZE
+
+    def _store(self, cell_offset, data):
+        """
+        Store data to the cell if it fits, otherwise free the cell and allocate the new one
+        :return: offset of the cell with data
+        """
+        if cell_offset != NO_OFFSET and self.cell_size(cell_offset) - 4 >= len(data):
+            self._write(cell_offset, 0, data)
+            return cell_offset
+        new_offset = self.allocate(len(data))
+        self._write(new_offset, 0, data)
+        self.free(cell_offset)
+        return new_offset
+
+    #############################################################################
+    # Key nodes
+
+    def key_name(self, key_offset):
+        flags, = self._unpack("<H", key_offset, 2)
+        name_length, = self._unpack("<H", key_offset, 72)
+        raw = self.cell(key_offset, 76 + name_length)[76:]
+        return raw.decode("latin-1") if flags & KEY_COMP_NAME else raw.decode("utf-16-le")
+
+    def _check_key(self, key_offset):
+        if self.cell(key_offset, 2) != b"nk":
+            raise RegistryError(ERROR_BADDB, "Damaged key node at offset 0x{0:X}".format(key_offset))
+
+    def key_info(self, key_offset):
+        """
+        :return: tuple (subkeys count, values count, last written FILETIME)
+        """
+        subkeys, = self._unpack("<I", key_offset, 20)
+        values, = self._unpack("<I", key_offset, 36)
+        last_written, = self._unpack("<Q", key_offset, 4)
+        return subkeys, values, last_written
+
+    def _leaf_entries(self, list_offset):
+        """
+        :return: list of (key offset, list cell offset) of the subkey index, "ri" lists are flattened
+        """
+        signature = self.cell(list_offset, 2)
+        count, = self._unpack("<H", list_offset, 2)
+        if signature == b"ri":
+            result = []
+            for leaf_offset in self._unpack("<{0}I".format(count), list_offset, 4):
+                result.extend(self._leaf_entries(leaf_offset))
+            return result
+        if signature == b"li":
+            return [(key_offset, list_offset) for key_offset in self._unpack("<{0}I".format(count), list_offset, 4)]
+        if signature in (b"lf", b"lh"):
+            items = self._unpack("<{0}I".format(count * 2), list_offset, 4)
+            return [(items[index], list_offset) for index in range(0, count * 2, 2)]
+        raise RegistryError(ERROR_BADDB, "Damaged subkey list at offset 0x{0:X}".format(list_offset))
+
+    def subkey_offsets(self, key_offset):
+        """
+        :return: list of subkey node offsets in index order
+        """
+        list_offset, = self._unpack("<I", key_offset, 28)
+        if list_offset == NO_OFFSET:
+            return []
+        return [entry[0] for entry in self._leaf_entries(list_offset)]
+
+    def find_subkey(self, key_offset, name):
+        """
+        Find direct subkey by name, "lh" hashes and "lf" hints are compared first to avoid reading names
+        :return: subkey node offset, None if not found
+        """
+        list_offset, = self._unpack("<I", key_offset, 28)
+        if list_offset == NO_OFFSET:
+            return None
+        return self._find_in_list(list_offset, name.upper(), name_hash(name))
+
+    def _find_in_list(self, list_offset, upper_name, hash_value):
+        signature = self.cell(list_offset, 2)
+        count, = self._unpack("<H", list_offset, 2)
+        if signature == b"ri":
+            for leaf_offset in self._unpack("<{0}I".format(count), list_offset, 4):
+                found = self._find_in_list(leaf_offset, upper_name, hash_value)
+                if found is not None:
+                    return found
+            return None
+        if signature == b"li":
+            candidates = self._unpack("<{0}I".format(count), list_offset, 4)
+        elif signature in (b"lf", b"lh"):
+            items = self._unpack("<{0}I".format(count * 2), list_offset, 4)
+            if signature == b"lh":
+                candidates = [items[index] for index in range(0, count * 2, 2) if items[index + 1] == hash_value]
+            else:
+                candidates = [items[index] for index in range(0, count * 2, 2)]
+        else:
+            raise RegistryError(ERROR_BADDB, "Damaged subkey list at offset 0x{0:X}".format(list_offset))
+        for candidate in candidates:
+            if self.key_name(candidate).upper() == upper_name:
+                return candidate
+        return None
+
+    def resolve(self, key_offset, parts):
+        """
+        :param key_offset: node offset to start from
+        :param parts: list of key path components
+        :return: node offset, None if any component is not found
+        """
+        for part in parts:
+            key_offset = self.find_subkey(key_offset, part)
+            if key_offset is None:
+                return None
+        return key_offset
+
+    def create_subkey(self, parent_offset, name):
+        """
+        Create subkey node, sharing the security descriptor of the parent, and insert it to the parent index
+        :return: new node offset
+        """
+        name_bytes, compressed = _encode_name(name)
+        security_offset, = self._unpack("<I", parent_offset, 44)
+        key_offset = self.allocate(76 + len(name_bytes))
+        self._write(key_offset, 0, struct.pack("<2sHQ15IHH", b"nk", KEY_COMP_NAME if compressed else 0,
+                                               _filetime_now(), 0, parent_offset, 0, 0, NO_OFFSET, NO_OFFSET, 0,
+                                               NO_OFFSET, security_offset, NO_OFFSET, 0, 0, 0, 0, 0,
+                                               len(name_bytes), 0) + name_bytes)
+        if security_offset != NO_OFFSET:
+            reference_count, = self._unpack("<I", security_offset, 12)
+            self._pack("<I", security_offset, 12, reference_count + 1)
+
+        self._insert_subkey(parent_offset, key_offset, name)
+        subkeys, = self._unpack("<I", parent_offset, 20)
+        max_name, = self._unpack("<I", parent_offset, 52)
+        self._pack("<I", parent_offset, 20, subkeys + 1)
+        self._pack("<I", parent_offset, 52, max(max_name & 0xFFFF, len(name) * 2) | (max_name & 0xFFFF0000))
+        self._pack("<Q", parent_offset, 4, _filetime_now())
+        return key_offset
+
+    def _leaf_item(self, signature, key_offset, name):
+        if signature == b"lh":
+            return struct.pack("<II", key_offset, name_hash(name))
+        if signature == b"lf":
+            return struct.pack("<I", key_offset) + name[:4].encode("latin-1", "replace").ljust(4, b"\0")
+        return struct.pack("<I", key_offset)
+
+    def _insert_subkey(self, parent_offset, key_offset, name):
+        list_offset, = self._unpack("<I", parent_offset, 28)
+        if list_offset == NO_OFFSET:
+            signature = b"lh" if self.minor >= 5 else b"lf"
+            self._pack("<I", parent_offset, 28, self._write_leaf(NO_OFFSET, signature, [(key_offset, name)]))
+            return
+
+        if self.cell(list_offset, 2) != b"ri":
+            self._pack("<I", parent_offset, 28, self._insert_into_leaf(list_offset, key_offset, name))
+            return
+
+        # Index root: insert into the first leaf which last key sorts after the new one
+        count, = self._unpack("<H", list_offset, 2)
+        leaves = list(self._unpack("<{0}I".format(count), list_offset, 4))
+        target = len(leaves) - 1
+        for index, leaf_offset in enumerate(leaves):
+            last_key = self._leaf_entries(leaf_offset)[-1][0]
+            if self.key_name(last_key).upper() > name.upper():
+                target = index
+                break
+        leaves[target] = self._insert_into_leaf(leaves[target], key_offset, name)
+        self._pack("<{0}I".format(count), list_offset, 4, *leaves)
+
+    def _insert_into_leaf(self, list_offset, key_offset, name):
+        signature = self.cell(list_offset, 2)
+        entries = [(offset, self.key_name(offset)) for offset, _ in self._leaf_entries(list_offset)]
+        upper_name = name.upper()
+        position = len(entries)
+        for index, (_, entry_name) in enumerate(entries):
+            if entry_name.upper() > upper_name:
+                position = index
+                break
+        entries.insert(position, (key_offset, name))
+        return self._write_leaf(list_offset, signature, entries)
+
+    def _write_leaf(self, list_offset, signature, entries):
+        data = struct.pack("<2sH", signature, len(entries)) + b"".join(
+            self._leaf_item(signature, offset, entry_name) for offset, entry_name in entries)
+        return self._store(list_offset, data)
+
+    #############################################################################
+    # Values
+
+    def _value_offsets(self, key_offset):
+        count, = self._unpack("<I", key_offset, 36)
+        list_offset, = self._unpack("<I", key_offset, 40)
+        if count == 0 or list_offset == NO_OFFSET:
+            return []
+        return list(self._unpack("<{0}I".format(count), list_offset, 0))
+
+    def value_name(self, value_offset):
+        name_length, flags = self._unpack("<H", value_offset, 2)[0], self._unpack("<H", value_offset, 16)[0]
+        raw = self.cell(value_offset, 20 + name_length)[20:]
+        return raw.decode("latin-1") if flags & VALUE_COMP_NAME else raw.decode("utf-16-le")
+
+    def _find_value(self, key_offset, name):
+        upper_name = (name or "").upper()
+        for index, value_offset in enumerate(self._value_offsets(key_offset)):
+            if self.value_name(value_offset).upper() == upper_name:
+                return index, value_offset
+        return None, None
+
+    def value_data(self, value_offset):
+        """
+        :return: tuple (raw data bytes, value type)
+        """
+        data_size, data_offset, value_type = self._unpack("<III", value_offset, 4)
+        if data_size & DATA_RESIDENT:
+            return struct.pack("<I", data_offset)[:data_size & ~DATA_RESIDENT], value_type
+        if data_size == 0:
+            return b"", value_type
+        if data_size > BIG_DATA_THRESHOLD and self.minor >= 4 and self.cell(data_offset, 2) == b"db":
+            segments_count, segments_list = self._unpack("<HI", data_offset, 2)
+            chunks = [self.cell(segment)[:BIG_DATA_THRESHOLD]
+                      for segment in self._unpack("<{0}I".format(segments_count), segments_list, 0)]
+            return b"".join(chunks)[:data_size], value_type
+        return self.cell(data_offset, data_size), value_type
+
+    def enum_value(self, key_offset, index):
+        """
+        :return: tuple (value name, raw data bytes, value type), None if index is out of range
+        """
+        offsets = self._value_offsets(key_offset)
+        if index >= len(offsets):
+            return None
+        raw, value_type = self.value_data(offsets[index])
+        return self.value_name(offsets[index]), raw, value_type
+
+    def query_value(self, key_offset, name):
+        """
+        :return: tuple (raw data bytes, value type), None if value does not exist
+        """
+        value_offset = self._find_value(key_offset, name)[1]
+        if value_offset is None:
+            return None
+        return self.value_data(value_offset)
+
+    def _free_value_data(self, value_offset):
+        data_size, data_offset = self._unpack("<II", value_offset, 4)
+        if data_size & DATA_RESIDENT or data_size == 0:
+            return
+        if data_size > BIG_DATA_THRESHOLD and self.minor >= 4 and self.cell(data_offset, 2) == b"db":
+            segments_count, segments_list = self._unpack("<HI", data_offset, 2)
+            for segment in self._unpack("<{0}I".format(segments_count), segments_list, 0):
+                self.free(segment)
+            self.free(segments_list)
+        self.free(data_offset)
+
+    def set_value(self, key_offset, name, value_type, raw):
+        """
+        Create or overwrite value. Existing value and data cells are reused in place when the new data fits
+        """
+        name = name or ""
+        if len(raw) > BIG_DATA_THRESHOLD:
+            raise RegistryError(ERROR_NOT_SUPPORTED, "Values larger than {0} bytes are not supported for offline "
+                                                     "hives".format(BIG_DATA_THRESHOLD))
+        value_offset = self._find_value(key_offset, name)[1]
+        if value_offset is None:
+            name_bytes, compressed = _encode_name(name)
+            value_offset = self.allocate(20 + len(name_bytes))
+            self._write(value_offset, 0, struct.pack("<2sHIIIHH", b"vk", len(name_bytes), 0, NO_OFFSET, value_type,
+                                                     VALUE_COMP_NAME if compressed and name_bytes else 0, 0) +
+                        name_bytes)
+            count, = self._unpack("<I", key_offset, 36)
+            list_offset, = self._unpack("<I", key_offset, 40)
+            offsets = self._value_offsets(key_offset) + [value_offset]
+            self._pack("<I", key_offset, 40, self._store(list_offset if count else NO_OFFSET,
+                                                         struct.pack("<{0}I".format(len(offsets)), *offsets)))
+            self._pack("<I", key_offset, 36, count + 1)
+            max_name, = self._unpack("<I", key_offset, 60)
+            self._pack("<I", key_offset, 60, max(max_name, len(name) * 2))
+
+        data_size, data_offset = self._unpack("<II", value_offset, 4)
+        if len(raw) <= 4:
+            self._free_value_data(value_offset)
+            self._pack("<II", value_offset, 4, len(raw) | DATA_RESIDENT, struct.unpack("<I", raw.ljust(4, b"\0"))[0])
+        else:
+            stored = data_size & DATA_RESIDENT == 0 and data_size != 0 and data_size <= BIG_DATA_THRESHOLD
+            new_offset = self._store(data_offset if stored else NO_OFFSET, raw)
+            if not stored:
+                self._free_value_data(value_offset)
+            self._pack("<II", value_offset, 4, len(raw), new_offset)
+        self._pack("<I", value_offset, 12, value_type)
+
+        max_data, = self._unpack("<I", key_offset, 64)
+        self._pack("<I", key_offset, 64, max(max_data, len(raw)))
+        self._pack("<Q", key_offset, 4, _filetime_now())
+
+    def delete_value(self, key_offset, name):
+        """
+        :return: True if value was deleted, False if it does not exist
+        """
+        index, value_offset = self._find_value(key_offset, name)
+        if value_offset is None:
+            return False
+        offsets = self._value_offsets(key_offset)
+        del offsets[index]
+        list_offset, = self._unpack("<I", key_offset, 40)
+        if offsets:
+            self._write(list_offset, 0, struct.pack("<{0}I".format(len(offsets)), *offsets))
+        else:
+            self.free(list_offset)
+            self._pack("<I", key_offset, 40, NO_OFFSET)
+        self._pack("<I", key_offset, 36, len(offsets))
+        self._free_value_data(value_offset)
+        self.free(value_offset)
+        self._pack("<Q", key_offset, 4, _filetime_now())
+        return True
+
+    #############################################################################
+    # File
+
+    def flush(self):
+        """
+        Complete the change: update hive bins size, secondary sequence number, timestamp and checksum
+        """
+        if not self.modified:
+            return
+        sequence1 = struct.unpack_from("<I", self.map, 4)[0]
+        struct.pack_into("<IIQ", self.map, 4, sequence1, sequence1, _filetime_now())
+        struct.pack_into("<I", self.map, 40, self.bins_size)
+        struct.pack_into("<I", self.map, 508, _base_block_checksum(self.map))
+        self.map.flush()
+        self.modified = False
+
+    def close(self, flush=True):
+        """
+        :param flush: complete the change before closing, without it a changed hive is left dirty
+        """
+        if not self.map.closed:
+            if self.writable and flush:
+                self.flush()
+            self.map.close()
+        self.hive_file.close()
+
+
+def create_hive(path, root_name="ROOT", minor_version=5):
+    """
+    Create empty hive file with the root key, e.g. to prepare synthetic hives for tests and benchmarks
+    :param path: hive file path
+    :param root_name: root key name
+    :param minor_version: hive format minor version, 3 to 6
+    """
+    name_bytes = root_name.encode("latin-1")
+    # Self-relative security descriptor without owner, group and ACLs
+    descriptor = struct.pack("<BBHIIII", 1, 0, 0x8000, 0, 0, 0, 0)
+    root_cell_size = _align(4 + 76 + len(name_bytes), CELL_ALIGNMENT)
+    security_cell_size = _align(4 + 20 + len(descriptor), CELL_ALIGNMENT)
+    root_offset = HBIN_HEADER_SIZE
+    security_offset = root_offset + root_cell_size
+
+    hive_bin = bytearray(HBIN_ALIGNMENT)
+    struct.pack_into("<4sIIQQI", hive_bin, 0, b"hbin", 0, HBIN_ALIGNMENT, 0, _filetime_now(), 0)
+    struct.pack_into("<i", hive_bin, root_offset, -root_cell_size)
+    struct.pack_into("<2sHQ15IHH", hive_bin, root_offset + 4, b"nk",
+                     KEY_HIVE_ENTRY | KEY_NO_DELETE | KEY_COMP_NAME, _filetime_now(), 0, 0, 0, 0, NO_OFFSET, NO_OFFSET,
+                     0, NO_OFFSET, security_offset, NO_OFFSET, 0, 0, 0, 0, 0, len(name_bytes), 0)
+    hive_bin[root_offset + 4 + 76:root_offset + 4 + 76 + len(name_bytes)] = name_bytes
+    struct.pack_into("<i", hive_bin, security_offset, -security_cell_size)
+    struct.pack_into("<2sHIIII", hive_bin, security_offset + 4, b"sk", 0, security_offset, security_offset, 1,
+                     len(descriptor))
+    hive_bin[security_offset + 24:security_offset + 24 + len(descriptor)] = descriptor
+    free_offset = security_offset + security_cell_size
+    struct.pack_into("<i", hive_bin, free_offset, HBIN_ALIGNMENT - free_offset)
+
+    base_block = bytearray(BASE_BLOCK_SIZE)
+    struct.pack_into("<4sIIQIIIIIII", base_block, 0, b"regf", 1, 1, _filetime_now(), 1, minor_version, 0, 1,
+                     root_offset, HBIN_ALIGNMENT, 1)
+    file_name = os.path.basename(path).encode("utf-16-le")[:62]
+    base_block[48:48 + len(file_name)] = file_name
+    struct.pack_into("<I", base_block, 508, _base_block_checksum(base_block))
+
+    with open(path, "wb") as hive_file:
+        hive_file.write(base_block)
+        hive_file.write(hive_bin)
+
+
+class StagedCommitError(OSError):
+    """
+    Staged hives were partially swapped in and the original hives could not be put back: the hive directory holds
+    a mix of changed and original hives and has to be restored
+    """
+
+
+class OfflineKeyHandle:
+    """
+    Open key handle of OfflineRegistry
+    """
+    __slots__ = ("hive", "key_offset", "closed")
+
+    def __init__(self, hive, key_offset):
+        self.hive = hive
+        self.key_offset = key_offset
+        self.closed = False
+
+    def Close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class OfflineRegistry:
+    """
+    Registry backend with the winreg-compatible interface over hive files mounted under HKEY_LOCAL_MACHINE.
+    HKLM\\SYSTEM\\CurrentControlSet is resolved through SYSTEM\\Select\\Current, the 32-bit view of HKLM\\SOFTWARE
+    is resolved to SOFTWARE\\WOW6432Node if the hive has one
+    """
+    def __init__(self, hives):
+        """
+        :param hives: dictionary mount name -> HiveFile, e.g. {"SYSTEM": HiveFile(...), "SOFTWARE": HiveFile(...)}
+        """
+        self.hives = dict((name.upper(), hive) for name, hive in hives.items())
+        self.operations = 0
+        self._control_set = None
+        # Original hive file path -> path of its staged copy, see open_staged()
+        self.staged = {}
+
+    @staticmethod
+    def _open_files(paths, writable):
+        hives = {}
+        try:
+            for name, path in paths.items():
+                hives[name] = HiveFile(path, writable)
+        except Exception:
+            for hive in hives.values():
+                hive.close()
+            raise
+        return hives
+
+    @staticmethod
+    def _hive_paths(config_dir):
+        paths = dict((name, os.path.join(config_dir, name)) for name in HIVE_FILES)
+        paths = dict((name, path) for name, path in paths.items() if os.path.exists(path))
+        if not paths:
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "No hive files found in {0}".format(config_dir))
+        return paths
+
+    @classmethod
+    def open_directory(cls, config_dir, writable=True):
+        """
+        Mount SYSTEM and SOFTWARE hive files from directory, e.g. Windows\\System32\\config of a mounted image
+        :return: OfflineRegistry object
+        """
+        hives = cls._open_files(cls._hive_paths(config_dir), writable)
+        logger.info("Mounted offline hives {0} from {1}".format(", ".join(sorted(hives)), config_dir))
+        return cls(hives)
+
+    @classmethod
+    def open_staged(cls, config_dir):
+        """
+        Mount copies of SYSTEM and SOFTWARE hive files from directory, so the original hives stay untouched until
+        commit() swaps the changed copies in. discard() drops the copies, e.g. after a failed run
+        :return: OfflineRegistry object
+        """
+        paths = cls._hive_paths(config_dir)
+        staged = {}
+        try:
+            for path in paths.values():
+                staged[path] = path + STAGED_SUFFIX
+                shutil.copyfile(path, staged[path])
+            hives = cls._open_files(dict((name, staged[path]) for name, path in paths.items()), True)
+        except Exception:
+            for staged_path in staged.values():
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+            raise
+        logger.info("Mounted staged copies of offline hives {0} from {1}".format(", ".join(sorted(hives)),
+                                                                                  config_dir))
+        registry = cls(hives)
+        registry.staged = staged
+        return registry
+
+    def flush(self):
+        for hive in self.hives.values():
+            hive.flush()
+
+    def close(self, flush=True):
+        """
+        :param flush: complete the change of every hive before closing, see HiveFile.close()
+        """
+        for hive in self.hives.values():
+            hive.close(flush)
+
+    def commit(self):
+        """
+        Flush and close the staged copies and swap them in place of the original hive files. If a swap fails,
+        the hives swapped before it are put back, so the directory keeps either all changed or all original hives
+        :raises StagedCommitError: if the original hives could not be put back
+        """
+        self.close()
+        swapped = []
+        try:
+            for path, staged_path in sorted(self.staged.items()):
+                os.replace(path, path + BACKUP_SUFFIX)
+                swapped.append(path)
+                os.replace(staged_path, path)
+        except OSError as e:
+            kept = []
+            for path in reversed(swapped):
+                try:
+                    os.replace(path + BACKUP_SUFFIX, path)
+                except OSError:
+                    kept.append(path + BACKUP_SUFFIX)
+            self.discard()
+            if kept:
+                raise StagedCommitError(e.errno, "Unable to put back the original hives after the failed swap ({0}), "
+                                                 "they are kept in {1}".format(e, ", ".join(kept)))
+            raise
+        for path in swapped:
+            os.remove(path + BACKUP_SUFFIX)
+        self.staged = {}
+
+    def discard(self):
+        """
+        Close the staged copies without completing the change and remove them, the original hives are not touched
+        """
+        self.close(flush=False)
+        for staged_path in self.staged.values():
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        self.staged = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #############################################################################
+    # Helpers
+
+    def _current_control_set(self):
+        if self._control_set is None:
+            self._control_set = "ControlSet001"
+            hive = self.hives.get("SYSTEM")
+            select = hive.resolve(hive.root_offset, ["Select"]) if hive is not None else None
+            current = hive.query_value(select, "Current") if select is not None else None
+            if current is not None and current[1] == registry_backend.REG_DWORD:
+                self._control_set = "ControlSet{0:03d}".format(registry_backend.decode_data(*current[::-1]))
+        return self._control_set
+
+    def _map_path(self, mount, parts, access):
+        if mount == "SYSTEM" and parts and parts[0].upper() == "CURRENTCONTROLSET":
+            return [self._current_control_set()] + parts[1:]
+        redirected = parts and parts[0].upper() == registry_backend.WOW64_NODE.upper()
+        if mount == "SOFTWARE" and access & KEY_WOW64_32KEY and not redirected:
+            hive = self.hives[mount]
+            if hive.find_subkey(hive.root_offset, registry_backend.WOW64_NODE) is not None:
+                return [registry_backend.WOW64_NODE] + parts
+        return parts
+
+    def _open(self, key, sub_key, access, create):
+        parts = registry_backend.split_path(sub_key or "")
+        if isinstance(key, OfflineKeyHandle):
+            if key.closed:
+                raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+            hive, key_offset = key.hive, key.key_offset
+        elif key == registry_backend.HKEY_LOCAL_MACHINE and parts and parts[0].upper() in self.hives:
+            mount = parts[0].upper()
+            hive = self.hives[mount]
+            key_offset = hive.root_offset
+            parts = self._map_path(mount, parts[1:], access)
+        else:
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+
+        for part in parts:
+            subkey_offset = hive.find_subkey(key_offset, part)
+            if subkey_offset is None:
+                if not create:
+                    raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+                subkey_offset = hive.create_subkey(key_offset, part)
+            key_offset = subkey_offset
+        return OfflineKeyHandle(hive, key_offset)
+
+    def _resolve(self, key):
+        if not isinstance(key, OfflineKeyHandle) or key.closed:
+            raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+        return key.hive, key.key_offset
+
+    def system_info(self):
+        """
+        Describe the offline system from its hives instead of probing the running one
+        :return: system_utils.SystemInfo object
+        """
+        def query(path, name):
+            try:
+                handle = self._open(registry_backend.HKEY_LOCAL_MACHINE, path, 0, create=False)
+                return self.QueryValueEx(handle, name)[0]
+            except OSError:
+                return None
+
+        version_path = "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion"
+        major = query(version_path, "CurrentMajorVersionNumber")
+        if major is None:
+            major = {"6.1": 7, "6.2": 8, "6.3": 8}.get(query(version_path, "CurrentVersion"), 0)
+        build = query(version_path, "CurrentBuild") or "0"
+        architecture = query("SYSTEM\\CurrentControlSet\\Control\\Session Manager\\Environment",
+                             "PROCESSOR_ARCHITECTURE")
+        if architecture is None:
+            software = self.hives.get("SOFTWARE")
+            x64 = software is not None and software.find_subkey(software.root_offset,
+                                                                 registry_backend.WOW64_NODE) is not None
+            architecture = "AMD64" if x64 else "x86"
+        return system_utils.SystemInfo.windows(os_major=major, os_build=int(build) if build.isdigit() else 0,
+                                               architecture=architecture)
+
+    #############################################################################
+    # winreg-compatible interface
+
+    def OpenKey(self, key, sub_key, reserved=0, access=registry_backend.KEY_READ):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=False)
+
+    OpenKeyEx = OpenKey
+
+    def CreateKeyEx(self, key, sub_key, reserved=0, access=registry_backend.KEY_WRITE):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=True)
+
+    def CreateKey(self, key, sub_key):
+        return self.CreateKeyEx(key, sub_key)
+
+    def CloseKey(self, handle):
+        if isinstance(handle, OfflineKeyHandle):
+            handle.Close()
+
+    def QueryValueEx(self, key, value_name):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        value = hive.query_value(key_offset, value_name)
+        if value is None:
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+        return registry_backend.decode_data(value[1], value[0]), value[1]
+
+    def SetValueEx(self, key, value_name, reserved, value_type, value):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        hive.set_value(key_offset, value_name, value_type, registry_backend.encode_data(value_type, value))
+
+    def DeleteValue(self, key, value_name):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        if not hive.delete_value(key_offset, value_name):
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+
+    def DeleteKeyEx(self, key, sub_key, access=registry_backend.KEY_WOW64_64KEY, reserved=0):
+        raise RegistryError(ERROR_NOT_SUPPORTED, "Key deletion is not supported for offline hives")
+
+    def DeleteKey(self, key, sub_key):
+        self.DeleteKeyEx(key, sub_key)
+
+    def EnumKey(self, key, index):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        subkeys = hive.subkey_offsets(key_offset)
+        if index >= len(subkeys):
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return hive.key_name(subkeys[index])
+
+    def EnumValue(self, key, index):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        value = hive.enum_value(key_offset, index)
+        if value is None:
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return value[0], registry_backend.decode_data(value[2], value[1]), value[2]
+
+    def QueryInfoKey(self, key):
+        self.operations += 1
+        hive, key_offset = self._resolve(key)
+        subkeys, values, last_written = hive.key_info(key_offset)
+        return subkeys, values, last_written
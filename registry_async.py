@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import functools
+import collections
+import concurrent.futures
+import log_helper
+import system_utils
+import registry_helper
+import registry_backend
+import registry_plan
+import registry_verify
+import volume_serial
+import generate_fingerprint
+
+logger = log_helper.setup_logger(name="registry_async", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """asyncio interface to plan application, snapshot restore and verification.
+Blocking registry calls run on a bounded thread pool, so the event loop stays responsive during the run. Every
+AsyncTarget has its own registry backend and system description, which are bound to the worker thread only for
+the duration of the call, so many targets (e.g. offline hives of different images) can be handled concurrently
+from one loop. Coroutines must run in a running event loop, e.g. under asyncio.run(), which needs Python 3.7.
+Progress is reported as ProgressEvent objects through the events() async iterator:
+
+    target = AsyncTarget(regf_hive.OfflineRegistry.open_directory(path), name="vm01")
+    consumer = asyncio.ensure_future(print_events(target.events()))
+    result = await target.apply(plan)
+    report = await target.verify(plan)
+    target.close()
+"""
+
+# Default number of worker threads of the target's own executor
+DEFAULT_WORKERS = 4
+
+# Number of operations applied with a single executor call when no journal is given
+DEFAULT_BATCH_SIZE = 16
+
+STAGE_APPLY = "apply"
+STAGE_RESTORE = "restore"
+STAGE_VERIFY = "verify"
+STAGE_VOLUME_ID = "volume_id"
+
+
+class ProgressEvent(collections.namedtuple("ProgressEvent", ["target", "stage", "done", "total", "failed"])):
+    """
+    Progress of the stage: number of processed and failed items out of the total
+    """
+    __slots__ = ()
+
+
+class AsyncTarget:
+    """
+    Registry target driven from asyncio code
+    """
+    def __init__(self, backend=None, system_info=None, executor=None, max_workers=DEFAULT_WORKERS, name=None):
+        """
+        :param backend: winreg-compatible registry backend, current registry_helper backend if None
+        :param system_info: system_utils.SystemInfo of the target, process-wide system info if None
+        :param executor: executor to share between targets, own thread pool of max_workers threads if None
+        :param max_workers: number of threads of the own thread pool
+        :param name: target name reported in progress events
+        """
+        self.backend = backend if backend is not None else registry_helper.get_backend()
+        self.system_info = system_info
+        self.name = name
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._own_executor = executor is None
+        self._queue = None
+
+    def _call(self, function, *args):
+        with registry_helper.use_backend(self.backend), system_utils.use_system_info(self.system_info):
+            return function(*args)
+
+    def _run(self, function, *args):
+        """
+        :return: future of the function result, executed on the executor with the target backend
+        """
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, functools.partial(self._call, function, *args))
+
+    def _events_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def _emit(self, stage, done, total, failed):
+        self._events_queue().put_nowait(ProgressEvent(self.name, stage, done, total, failed))
+
+    async def events(self):
+        """
+        Async iterator of ProgressEvent objects, ends when the target is closed
+        """
+        queue = self._events_queue()
+        while True:
+            event = await queue.get()
+            if event is None:
+                return
+            yield event
+
+    async def apply(self, plan, journal=None):
+        """
+        Apply the plan in batches, one executor call per batch. Batches are journaled if journal is given
+        :param plan: iterable of RegistryOperation
+        :param journal: optional registry_journal.WriteAheadJournal
+        :return: registry_plan.ApplyResult
+        """
+        operations = await self._run(registry_plan.expand_operations, list(plan))
+        batch_size = journal.batch_size if journal is not None else DEFAULT_BATCH_SIZE
+        written = failed = 0
+        for batch_start in range(0, len(operations), batch_size):
+            result = await self._run(registry_plan.apply_plan, operations[batch_start:batch_start + batch_size],
+                                     journal)
+            written += result.written
+            failed += result.failed
+            self._emit(STAGE_APPLY, written + failed, len(operations), failed)
+        return registry_plan.ApplyResult(written=written, failed=failed)
+
+    async def restore(self, snapshot):
+        """
+        Restore snapshot entries in reverse order, in batches
+        :param snapshot: list of SnapshotEntry
+        :return: registry_plan.ApplyResult
+        """
+        entries = list(reversed(snapshot))
+        written = failed = 0
+        for batch_start in range(0, len(entries), DEFAULT_BATCH_SIZE):
+            batch = entries[batch_start:batch_start + DEFAULT_BATCH_SIZE]
+            restored = await self._run(lambda: [registry_plan.restore_entry(entry) for entry in batch])
+            written += restored.count(True)
+            failed += restored.count(False)
+            self._emit(STAGE_RESTORE, written + failed, len(entries), failed)
+        return registry_plan.ApplyResult(written=written, failed=failed)
+
+    async def verify(self, plan):
+        """
+        Read back planned values, keys are verified concurrently on the executor
+        :param plan: iterable of RegistryOperation
+        :return: registry_verify.VerifyReport
+        """
+        groups = await self._run(registry_verify.group_by_key, list(plan))
+        total = sum(len(group) for group in groups)
+        progress = {"done": 0, "failed": 0}
+
+        async def verify_group(group):
+            results = await self._run(registry_verify.verify_key, self.backend, group)
+            progress["done"] += len(results)
+            progress["failed"] += sum(1 for result in results if not result.ok)
+            self._emit(STAGE_VERIFY, progress["done"], total, progress["failed"])
+            return results
+
+        key_results = await asyncio.gather(*[verify_group(group) for group in groups])
+        return registry_verify.build_report(key_results)
+
+    async def change_volume_id(self, volume_id, volume_image=None, volume_index=None):
+        """
+        Change Volume ID in the disk image, or of the system drive with VolumeID helper subprocess
+        if the target is the live registry
+        :param volume_id: new Volume ID, XXXX-XXXX
+        :param volume_image: optional raw disk image or partition file
+        :param volume_index: index of the volume in the image, None for the Windows system volume
+        :return: True if succeed, False otherwise
+        """
+        if volume_image is not None:
+            await self._run(volume_serial.write_volume_serial, volume_image, volume_id, volume_index)
+            success = True
+        elif registry_backend.is_live(self.backend):
+            helper_path = await self._run(generate_fingerprint.volume_id_helper_path)
+            process = await asyncio.create_subprocess_exec(helper_path, "C:", volume_id)
+            success = await process.wait() == 0
+        else:
+            logger.warning("Volume ID change is available for the live Windows registry or disk image only")
+            success = False
+        self._emit(STAGE_VOLUME_ID, 1, 1, 0 if success else 1)
+        return success
+
+    def close(self):
+        """
+        End the events() iterator and shut down the own executor
+        """
+        self._events_queue().put_nowait(None)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,327 @@
+import sys
+import time
+import logging
+import argparse
+import queue
+import threading
+import collections
+import log_helper
+import registry_helper
+import registry_plan
+import registry_backend
+import regf_hive
+import system_utils
+
+from registry_helper import Wow64RegistryEntry, HIVES_MAP, WOW64_MAP
+from registry_plan import SnapshotEntry
+
+logger = log_helper.setup_logger(name="registry_audit", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Read-only audit of the registry areas fingerprint sections manage.
+Subtrees are walked concurrently on a thread pool: every key is a separate task, which opens the key once, reads
+all its values and subkey names on that handle and submits its subkeys as new tasks. The number of keys open at once
+is capped independently of the number of threads. Results stream out in order of completion, as the keys are read,
+and are saved in the snapshot format, so audits are diffed and compared across machines with snapshot_diff
+"""
+
+# Number of worker threads
+DEFAULT_WORKERS = 8
+
+# Maximum number of registry keys open at once
+DEFAULT_MAX_OPEN_KEYS = 16
+
+
+class AuditArea(collections.namedtuple("AuditArea", ["key_hive", "key_path", "access_type", "max_depth"])):
+    """
+    Audited subtree. access_type KEY_WOW32_64 audits both registry views on 64-bit systems,
+    max_depth limits subkey levels, None to walk the whole subtree
+    """
+    __slots__ = ()
+
+
+class AuditKey(collections.namedtuple("AuditKey", ["key_hive", "key_path", "access_type", "values", "subkeys",
+                                                   "error"])):
+    """
+    Audited key: list of (RegValue, Data, Type) tuples and subkey names read so far,
+    error is (LastError, message) tuple if reading the key failed, None otherwise
+    """
+    __slots__ = ()
+
+    def snapshot_entries(self):
+        """
+        :return: list of SnapshotEntry of the key values
+        """
+        return [SnapshotEntry(self.key_hive, self.key_path, value_name, self.access_type, value_type, value)
+                for value_name, value, value_type in self.values]
+
+
+class AuditReport(collections.namedtuple("AuditReport", ["keys", "values", "missing", "errors", "seconds"])):
+    """
+    Audit summary: numbers of read keys and values, list of AuditArea which do not exist,
+    list of AuditKey which failed to read and duration of the audit
+    """
+    __slots__ = ()
+
+    def format(self):
+        """
+        :return: list of report lines
+        """
+        lines = ["Audited {0} keys, {1} values in {2:.3f} s, {3} errors".format(self.keys, self.values, self.seconds,
+                                                                               len(self.errors))]
+        for area in self.missing:
+            lines.append("  MISSING [{0}] {1}\\{2}".format(Wow64RegistryEntry(area.access_type).name, area.key_hive,
+                                                           area.key_path))
+        for key in self.errors:
+            lines.append("  ERROR [{0}] {1}\\{2}: LastError={3} [{4}]".format(
+                Wow64RegistryEntry(key.access_type).name, key.key_hive, key.key_path, key.error[0], key.error[1]))
+        return lines
+
+
+AUDIT_AREAS = (
+    # Only the key itself: its subkeys (Fonts, Winlogon, AppCompatFlags...) hold no identifiers and are huge
+    AuditArea("HKEY_LOCAL_MACHINE", "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion",
+              Wow64RegistryEntry.KEY_WOW32_64, 0),
+    AuditArea("HKEY_LOCAL_MACHINE", "SOFTWARE\\Microsoft\\Cryptography", Wow64RegistryEntry.KEY_WOW32_64, None),
+    AuditArea("HKEY_LOCAL_MACHINE", "SOFTWARE\\Microsoft\\SQMClient", Wow64RegistryEntry.KEY_WOW32_64, None),
+    AuditArea("HKEY_LOCAL_MACHINE",
+              "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Diagnostics\\DiagTrack\\SettingsRequests",
+              Wow64RegistryEntry.KEY_WOW64, None),
+    AuditArea("HKEY_LOCAL_MACHINE", "SYSTEM\\CurrentControlSet\\Control\\IDConfigDB",
+              Wow64RegistryEntry.KEY_WOW64, None),
+    AuditArea("HKEY_LOCAL_MACHINE", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate",
+              Wow64RegistryEntry.KEY_WOW64, None),
+    AuditArea("HKEY_LOCAL_MACHINE", "SYSTEM\\CurrentControlSet\\services\\Tcpip\\Parameters",
+              Wow64RegistryEntry.KEY_WOW64, None),
+    AuditArea("HKEY_LOCAL_MACHINE", "SYSTEM\\CurrentControlSet\\Control\\ComputerName",
+              Wow64RegistryEntry.KEY_WOW64, None),
+)
+
+
+def expand_areas(areas):
+    """
+    Split KEY_WOW32_64 areas into separate views on 64-bit systems, like registry_plan.expand_operations() does
+    :return: list of AuditArea
+    """
+    x64 = system_utils.is_x64os()
+    result = []
+    for area in areas:
+        if area.access_type != Wow64RegistryEntry.KEY_WOW32_64:
+            result.append(area)
+        elif x64:
+            result.append(area._replace(access_type=Wow64RegistryEntry.KEY_WOW32))
+            result.append(area._replace(access_type=Wow64RegistryEntry.KEY_WOW64))
+        else:
+            result.append(area._replace(access_type=Wow64RegistryEntry.KEY_WOW64))
+    return result
+
+
+def read_key(backend, key_hive, key_path, access_type, open_keys):
+    """
+    Read all values and subkey names of the key on a single handle. Entry counts are taken from QueryInfoKey,
+    so enumeration does not end with ERROR_NO_MORE_ITEMS exceptions
+    :param backend: registry backend
+    :param open_keys: semaphore limiting keys open at once
+    :return: AuditKey
+    """
+    values = []
+    subkeys = []
+    with open_keys:
+        try:
+            registry_key = backend.OpenKey(HIVES_MAP[key_hive], key_path, 0,
+                                           WOW64_MAP[access_type] | registry_backend.KEY_READ)
+        except OSError as e:
+            return AuditKey(key_hive, key_path, access_type, values, subkeys, (e.winerror, e.strerror))
+        try:
+            subkey_count, value_count, _ = backend.QueryInfoKey(registry_key)
+            for index in range(value_count):
+                values.append(backend.EnumValue(registry_key, index))
+            for index in range(subkey_count):
+                subkeys.append(backend.EnumKey(registry_key, index))
+        except OSError as e:
+            # Key changed while being read, partial results are kept
+            if e.winerror != registry_backend.ERROR_NO_MORE_ITEMS:
+                return AuditKey(key_hive, key_path, access_type, values, subkeys, (e.winerror, e.strerror))
+        finally:
+            backend.CloseKey(registry_key)
+    return AuditKey(key_hive, key_path, access_type, values, subkeys, None)
+
+
+class _Scan:
+    """
+    Worker threads sharing the queue of keys to read. Every worker reads the key, queues its subkeys and passes
+    the result on; the last worker to finish stops the others
+    """
+    def __init__(self, backend, workers, max_open_keys):
+        self.backend = backend
+        self.workers = workers
+        self.open_keys = threading.BoundedSemaphore(max_open_keys)
+        self.keys = queue.Queue()
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name="audit-{0}".format(index), daemon=True)
+                         for index in range(workers)]
+
+    def _add(self, tasks):
+        with self._lock:
+            self._outstanding += len(tasks)
+        for task in tasks:
+            self.keys.put(task)
+
+    def _done(self):
+        with self._lock:
+            self._outstanding -= 1
+            finished = self._outstanding == 0
+        if finished:
+            self.stop()
+
+    def _work(self):
+        while True:
+            task = self.keys.get()
+            if task is None:
+                return
+            area, key_path, depth = task
+            try:
+                if self.stopped.is_set():
+                    continue
+                key = read_key(self.backend, area.key_hive, key_path, area.access_type, self.open_keys)
+                if key.error is None and (area.max_depth is None or depth < area.max_depth):
+                    self._add([(area, "{0}\\{1}".format(key_path, subkey_name), depth + 1)
+                               for subkey_name in key.subkeys])
+                self.results.put((area, depth, key))
+            except Exception as e:
+                self.results.put((area, depth, e))
+            finally:
+                self._done()
+
+    def start(self, areas):
+        # Areas are queued before workers start, so the count of outstanding keys can not drop to 0 in between
+        self._add([(area, area.key_path, 0) for area in areas])
+        if not areas:
+            self.stop()
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            for _ in self._threads:
+                self.keys.put(None)
+            self.results.put(None)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+
+def iter_audit(areas=AUDIT_AREAS, workers=DEFAULT_WORKERS, max_open_keys=DEFAULT_MAX_OPEN_KEYS, missing=None):
+    """
+    Walk audited subtrees concurrently with the current registry backend
+    :param areas: iterable of AuditArea
+    :param workers: number of worker threads
+    :param max_open_keys: maximum number of registry keys open at once
+    :param missing: optional list to collect AuditArea which do not exist
+    :return: generator of AuditKey in order of completion
+    """
+    scan = _Scan(registry_helper.get_backend(), workers, max_open_keys)
+    scan.start(expand_areas(areas))
+    try:
+        while True:
+            result = scan.results.get()
+            if result is None:
+                break
+            area, depth, key = result
+            if isinstance(key, Exception):
+                raise key
+            if depth == 0 and key.error is not None and key.error[0] == registry_backend.ERROR_FILE_NOT_FOUND:
+                if missing is not None:
+                    missing.append(area)
+                continue
+            yield key
+    finally:
+        # Consumer stopped early or failed: queued keys are not read
+        scan.stop()
+        scan.join()
+
+
+def audit(areas=AUDIT_AREAS, workers=DEFAULT_WORKERS, max_open_keys=DEFAULT_MAX_OPEN_KEYS, snapshot=None):
+    """
+    Audit the areas and summarize the result
+    :param snapshot: optional list to collect SnapshotEntry of all read values
+    :return: AuditReport
+    """
+    start_time = time.perf_counter()
+    missing = []
+    errors = []
+    keys = values = 0
+    for key in iter_audit(areas, workers, max_open_keys, missing):
+        keys += 1
+        values += len(key.values)
+        if key.error is not None:
+            errors.append(key)
+        if snapshot is not None:
+            snapshot.extend(key.snapshot_entries())
+    return AuditReport(keys=keys, values=values, missing=missing, errors=errors,
+                       seconds=time.perf_counter() - start_time)
+
+
+def log_report(report):
+    for line in report.format():
+        if line.startswith("  "):
+            logger.warning(line)
+        else:
+            logger.info(line)
+
+
+def main(argv=None):
+    """
+    Audit the current identity state of the registry into a snapshot file
+    :return: Exec return code
+    """
+    parser = argparse.ArgumentParser(description='Read-only audit of fingerprint-related registry areas')
+
+    parser.add_argument('output',
+                        help='Snapshot JSON lines file of all audited values')
+
+    parser.add_argument('--hive-dir',
+                        help='Audit offline SYSTEM and SOFTWARE hive files in this directory',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--workers',
+                        help='Number of worker threads',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_WORKERS)
+
+    parser.add_argument('--max-open-keys',
+                        help='Maximum number of registry keys open at once',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_MAX_OPEN_KEYS)
+
+    args = parser.parse_args(argv)
+
+    snapshot = []
+    if args.hive_dir:
+        offline_registry = regf_hive.OfflineRegistry.open_directory(args.hive_dir, writable=False)
+        try:
+            with registry_helper.use_backend(offline_registry), \
+                    system_utils.use_system_info(offline_registry.system_info()):
+                report = audit(workers=args.workers, max_open_keys=args.max_open_keys, snapshot=snapshot)
+        finally:
+            offline_registry.close()
+    else:
+        system_utils.load_system_info()
+        report = audit(workers=args.workers, max_open_keys=args.max_open_keys, snapshot=snapshot)
+    registry_plan.save_snapshot(snapshot, args.output)
+    log_report(report)
+    logger.info("Snapshot of {0} values written to {1}".format(len(snapshot), args.output))
+    return 1 if report.errors else 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+try:
+    import winreg
+except ImportError:
+    winreg = None
+
+
+__doc__ = """Registry backends used by registry_helper.
+A backend is any object with the winreg-compatible function set: OpenKey, CreateKeyEx, CloseKey, QueryValueEx,
+SetValueEx, DeleteValue, DeleteKeyEx, EnumKey, EnumValue and QueryInfoKey. Errors are reported as OSError with
+winerror and strerror attributes, like winreg does. The live backend is the winreg module itself, available on
+Windows only; MemoryRegistry is an in-memory stand-in which works on any platform
+"""
+
+# Predefined keys, access rights and value types. Values are the same as winreg ones
+if winreg is not None:
+    HKEY_CLASSES_ROOT = winreg.HKEY_CLASSES_ROOT
+    HKEY_CURRENT_USER = winreg.HKEY_CURRENT_USER
+    HKEY_LOCAL_MACHINE = winreg.HKEY_LOCAL_MACHINE
+    HKEY_USERS = winreg.HKEY_USERS
+    HKEY_PERFORMANCE_DATA = winreg.HKEY_PERFORMANCE_DATA
+    HKEY_CURRENT_CONFIG = winreg.HKEY_CURRENT_CONFIG
+    HKEY_DYN_DATA = winreg.HKEY_DYN_DATA
+else:
+    HKEY_CLASSES_ROOT = 0x80000000
+    HKEY_CURRENT_USER = 0x80000001
+    HKEY_LOCAL_MACHINE = 0x80000002
+    HKEY_USERS = 0x80000003
+    HKEY_PERFORMANCE_DATA = 0x80000004
+    HKEY_CURRENT_CONFIG = 0x80000005
+    HKEY_DYN_DATA = 0x80000006
+
+KEY_QUERY_VALUE = 0x0001
+KEY_SET_VALUE = 0x0002
+KEY_CREATE_SUB_KEY = 0x0004
+KEY_ENUMERATE_SUB_KEYS = 0x0008
+KEY_READ = 0x20019
+KEY_WRITE = 0x20006
+KEY_ALL_ACCESS = 0xF003F
+KEY_WOW64_64KEY = 0x0100
+KEY_WOW64_32KEY = 0x0200
+
+REG_NONE = 0
+REG_SZ = 1
+REG_EXPAND_SZ = 2
+REG_BINARY = 3
+REG_DWORD = 4
+REG_DWORD_LITTLE_ENDIAN = 4
+REG_DWORD_BIG_ENDIAN = 5
+REG_LINK = 6
+REG_MULTI_SZ = 7
+REG_RESOURCE_LIST = 8
+REG_FULL_RESOURCE_DESCRIPTOR = 9
+REG_RESOURCE_REQUIREMENTS_LIST = 10
+REG_QWORD = 11
+REG_QWORD_LITTLE_ENDIAN = 11
+
+# Windows error codes
+ERROR_FILE_NOT_FOUND = 2
+ERROR_ACCESS_DENIED = 5
+ERROR_INVALID_HANDLE = 6
+ERROR_SHARING_VIOLATION = 32
+ERROR_LOCK_VIOLATION = 33
+ERROR_NOT_SUPPORTED = 50
+ERROR_BUSY = 170
+ERROR_NO_MORE_ITEMS = 259
+ERROR_BADDB = 1009
+ERROR_KEY_HAS_CHILDREN = 1020
+ERROR_RETRY = 1237
+ERROR_NO_SYSTEM_RESOURCES = 1450
+ERROR_TIMEOUT = 1460
+
+PREDEFINED_KEYS = {
+    HKEY_CLASSES_ROOT: "HKEY_CLASSES_ROOT",
+    HKEY_CURRENT_USER: "HKEY_CURRENT_USER",
+    HKEY_LOCAL_MACHINE: "HKEY_LOCAL_MACHINE",
+    HKEY_USERS: "HKEY_USERS",
+    HKEY_PERFORMANCE_DATA: "HKEY_PERFORMANCE_DATA",
+    HKEY_CURRENT_CONFIG: "HKEY_CURRENT_CONFIG",
+    HKEY_DYN_DATA: "HKEY_DYN_DATA"
+}
+
+# 32-bit view of HKLM\SOFTWARE is redirected to this subkey on 64-bit Windows
+WOW64_NODE = "WOW6432Node"
+
+
+class RegistryError(OSError):
+    """
+    Registry operation error with Windows error code, raised by non-winreg backends
+    """
+    def __init__(self, winerror, strerror):
+        super(RegistryError, self).__init__(winerror, strerror)
+        self.winerror = winerror
+        self.strerror = strerror
+
+
+def live_backend():
+    """
+    :return: winreg module, None if not available on this platform
+    """
+    return winreg
+
+
+def is_live(backend):
+    """
+    :return: True if backend changes the registry of the running system. Wrapping backends,
+    e.g. run_metrics.InstrumentedRegistry, are checked by the backend they wrap
+    """
+    while hasattr(backend, "wrapped"):
+        backend = backend.wrapped
+    return backend is not None and backend is winreg
+
+
+def encode_data(value_type, value):
+    """
+    Convert value data, as winreg.SetValueEx() accepts it, to raw registry bytes
+    :param value_type: winreg value type
+    :param value: str, list of str, int or bytes-like object depending on the type
+    :return: bytes
+    """
+    if value_type in (REG_SZ, REG_EXPAND_SZ, REG_LINK) and isinstance(value, str):
+        return (value + "\0").encode("utf-16-le")
+    if value_type == REG_MULTI_SZ and isinstance(value, (list, tuple)):
+        return "".join(item + "\0" for item in value).encode("utf-16-le") + b"\0\0"
+    if value_type == REG_DWORD and isinstance(value, int):
+        return (value & 0xFFFFFFFF).to_bytes(4, "little")
+    if value_type == REG_DWORD_BIG_ENDIAN and isinstance(value, int):
+        return (value & 0xFFFFFFFF).to_bytes(4, "big")
+    if value_type == REG_QWORD and isinstance(value, int):
+        return (value & 0xFFFFFFFFFFFFFFFF).to_bytes(8, "little")
+    if value is None:
+        return b""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    raise TypeError("Unsupported data {0!r} of registry type {1}".format(value, value_type))
+
+
+def decode_data(value_type, raw):
+    """
+    Convert raw registry bytes to value data, as winreg.QueryValueEx() returns it
+    :param value_type: winreg value type
+    :param raw: bytes
+    :return: str, list of str, int, bytes or None depending on the type
+    """
+    if value_type in (REG_SZ, REG_EXPAND_SZ, REG_LINK):
+        text = raw[:len(raw) & ~1].decode("utf-16-le", "replace")
+        return text.split("\0", 1)[0]
+    if value_type == REG_MULTI_SZ:
+        text = raw[:len(raw) & ~1].decode("utf-16-le", "replace")
+        items = text.split("\0")
+        while items and not items[-1]:
+            items.pop()
+        return items
+    if value_type == REG_DWORD:
+        return int.from_bytes(raw[:4].ljust(4, b"\0"), "little")
+    if value_type == REG_QWORD:
+        return int.from_bytes(raw[:8].ljust(8, b"\0"), "little")
+    return bytes(raw) if raw else None
+
+
+def split_path(key_path):
+    """
+    :return: list of non-empty key path components
+    """
+    return [part for part in key_path.split("\\") if part]
+
+
+def wow64_redirect(hive_name, parts, access):
+    """
+    Apply 32-bit registry view redirection of HKLM\\SOFTWARE for backends that store both views in one tree
+    :param hive_name: predefined key name, like "HKEY_LOCAL_MACHINE"
+    :param parts: list of key path components
+    :param access: access mask passed to OpenKey/CreateKeyEx
+    :return: list of key path components
+    """
+    if (access & KEY_WOW64_32KEY and hive_name == "HKEY_LOCAL_MACHINE" and parts and
+            parts[0].upper() == "SOFTWARE" and (len(parts) < 2 or parts[1].upper() != WOW64_NODE.upper())):
+        return parts[:1] + [WOW64_NODE] + parts[1:]
+    return parts
+
+
+class _MemoryKey:
+    __slots__ = ("name", "subkeys", "values", "_subkey_list", "_value_list")
+
+    def __init__(self, name):
+        self.name = name
+        # lower-case name -> _MemoryKey, insertion ordered
+        self.subkeys = {}
+        # lower-case name -> (name, data, type), insertion ordered
+        self.values = {}
+        # Index caches of EnumKey/EnumValue, rebuilt on the first enumeration after a write
+        self._subkey_list = None
+        self._value_list = None
+
+    def subkey_list(self):
+        if self._subkey_list is None:
+            self._subkey_list = list(self.subkeys.values())
+        return self._subkey_list
+
+    def value_list(self):
+        if self._value_list is None:
+            self._value_list = list(self.values.values())
+        return self._value_list
+
+    def subkeys_changed(self):
+        self._subkey_list = None
+
+    def values_changed(self):
+        self._value_list = None
+
+
+class MemoryKeyHandle:
+    """
+    Open key handle of MemoryRegistry
+    """
+    __slots__ = ("node", "hive_name", "parts", "closed")
+
+    def __init__(self, node, hive_name, parts):
+        self.node = node
+        self.hive_name = hive_name
+        self.parts = parts
+        self.closed = False
+
+    def Close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class MemoryRegistry:
+    """
+    In-memory registry stand-in with the winreg-compatible interface. Names are case-insensitive and case-preserving,
+    the 32-bit view of HKLM\\SOFTWARE is stored under WOW6432Node like on 64-bit Windows
+    """
+    def __init__(self):
+        self.roots = dict((hkey, _MemoryKey(name)) for hkey, name in PREDEFINED_KEYS.items())
+        self.operations = 0
+
+    #############################################################################
+    # Helpers
+
+    def _resolve(self, key):
+        if isinstance(key, MemoryKeyHandle):
+            if key.closed:
+                raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+            return key.node, key.hive_name, key.parts
+        if key not in self.roots:
+            raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+        return self.roots[key], PREDEFINED_KEYS[key], []
+
+    def _open(self, key, sub_key, access, create):
+        node, hive_name, parts = self._resolve(key)
+        sub_parts = split_path(sub_key or "")
+        if not parts:
+            sub_parts = wow64_redirect(hive_name, sub_parts, access)
+        elif len(parts) == 1:
+            sub_parts = wow64_redirect(hive_name, parts + sub_parts, access)[1:]
+        for part in sub_parts:
+            child = node.subkeys.get(part.lower())
+            if child is None:
+                if not create:
+                    raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+                child = _MemoryKey(part)
+                node.subkeys[part.lower()] = child
+                node.subkeys_changed()
+            node = child
+        return MemoryKeyHandle(node, hive_name, parts + sub_parts)
+
+    def create_keys(self, key, key_paths, access=KEY_WRITE):
+        """
+        Create keys with all their parents, e.g. to prepare the stand-in for the fingerprint run
+        :param key: predefined key, e.g. HKEY_LOCAL_MACHINE
+        :param key_paths: iterable of key paths
+        :param access: access mask, KEY_WOW64_32KEY flag selects 32-bit registry view
+        """
+        for key_path in key_paths:
+            self._open(key, key_path, access, create=True)
+
+    #############################################################################
+    # winreg-compatible interface
+
+    def OpenKey(self, key, sub_key, reserved=0, access=KEY_READ):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=False)
+
+    OpenKeyEx = OpenKey
+
+    def CreateKeyEx(self, key, sub_key, reserved=0, access=KEY_WRITE):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=True)
+
+    def CreateKey(self, key, sub_key):
+        return self.CreateKeyEx(key, sub_key)
+
+    def CloseKey(self, handle):
+        if isinstance(handle, MemoryKeyHandle):
+            handle.Close()
+
+    def QueryValueEx(self, key, value_name):
+        self.operations += 1
+        node = self._resolve(key)[0]
+        value = node.values.get((value_name or "").lower())
+        if value is None:
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+        return value[1], value[2]
+
+    def SetValueEx(self, key, value_name, reserved, value_type, value):
+        self.operations += 1
+        node = self._resolve(key)[0]
+        if isinstance(value, bytearray):
+            value = bytes(value)
+        node.values[(value_name or "").lower()] = (value_name or "", value, value_type)
+        node.values_changed()
+
+    def DeleteValue(self, key, value_name):
+        self.operations += 1
+        node = self._resolve(key)[0]
+        if node.values.pop((value_name or "").lower(), None) is None:
+            raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+        node.values_changed()
+
+    def DeleteKeyEx(self, key, sub_key, access=KEY_WOW64_64KEY, reserved=0):
+        self.operations += 1
+        handle = self._open(key, sub_key, access, create=False)
+        if handle.node.subkeys:
+            raise RegistryError(ERROR_ACCESS_DENIED, "Access is denied")
+        parent = self._open(key, "\\".join(split_path(sub_key)[:-1]), access, create=False)
+        del parent.node.subkeys[handle.node.name.lower()]
+        parent.node.subkeys_changed()
+
+    def DeleteKey(self, key, sub_key):
+        self.DeleteKeyEx(key, sub_key)
+
+    def EnumKey(self, key, index):
+        self.operations += 1
+        subkeys = self._resolve(key)[0].subkey_list()
+        if index >= len(subkeys):
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return subkeys[index].name
+
+    def EnumValue(self, key, index):
+        self.operations += 1
+        values = self._resolve(key)[0].value_list()
+        if index >= len(values):
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return values[index]
+
+    def QueryInfoKey(self, key):
+        self.operations += 1
+        node = self._resolve(key)[0]
+        return len(node.subkeys), len(node.values), 0
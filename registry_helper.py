@@ -1,26 +1,82 @@
 import logging
 import log_helper
-import winreg
+import registry_backend
 import enum
+import threading
+import contextlib
+import collections
 
 from system_utils import is_x64os
+from registry_backend import ERROR_FILE_NOT_FOUND, ERROR_NO_MORE_ITEMS
 
 logger = log_helper.setup_logger(name="registry_helper", level=logging.DEBUG, log_to_file=False)
 
 
 __doc__ = """File contains registry-related functions, for creating, enumerating, editing and removing Windows 
 registry keys and values. enums and dictionaries with registry-related integer values, imported from winreg module
-Also is_x64os() helper function provided
+Also is_x64os() helper function provided.
+All the functions work with the current registry backend, which is the live winreg module by default and can be
+replaced with set_backend(), e.g. with registry_backend.MemoryRegistry on non-Windows hosts
 """
 
+try:
+    WindowsError
+except NameError:
+    # Non-Windows host, registry backends raise OSError with winerror attribute
+    WindowsError = OSError
+
+_backend = registry_backend.live_backend()
+
+# Per-thread backend overrides of use_backend()
+_thread_backend = threading.local()
+
+
+def get_backend():
+    """
+    :return: Current registry backend, winreg-compatible object. Backend of use_backend() if the current thread
+    is inside it, process-wide backend otherwise
+    """
+    backend = getattr(_thread_backend, "backend", None)
+    if backend is not None:
+        return backend
+    if _backend is None:
+        raise RuntimeError("winreg is not available on this platform, use registry_helper.set_backend()")
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace current registry backend
+    :param backend: winreg-compatible object, e.g. registry_backend.MemoryRegistry
+    :return: previous registry backend
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    return previous
+
+
+@contextlib.contextmanager
+def use_backend(backend):
+    """
+    Use the backend in the current thread only, e.g. to work with different targets from worker threads
+    :param backend: winreg-compatible object
+    """
+    previous = getattr(_thread_backend, "backend", None)
+    _thread_backend.backend = backend
+    try:
+        yield backend
+    finally:
+        _thread_backend.backend = previous
+
 HIVES_MAP = {
-    "HKEY_CLASSES_ROOT": winreg.HKEY_CLASSES_ROOT,
-    "HKEY_CURRENT_USER": winreg.HKEY_CURRENT_USER,
-    "HKEY_LOCAL_MACHINE": winreg.HKEY_LOCAL_MACHINE,
-    "HKEY_USERS": winreg.HKEY_USERS,
-    "HKEY_PERFORMANCE_DATA": winreg.HKEY_PERFORMANCE_DATA,
-    "HKEY_CURRENT_CONFIG": winreg.HKEY_CURRENT_CONFIG,
-    "HKEY_DYN_DATA": winreg.HKEY_DYN_DATA
+    "HKEY_CLASSES_ROOT": registry_backend.HKEY_CLASSES_ROOT,
+    "HKEY_CURRENT_USER": registry_backend.HKEY_CURRENT_USER,
+    "HKEY_LOCAL_MACHINE": registry_backend.HKEY_LOCAL_MACHINE,
+    "HKEY_USERS": registry_backend.HKEY_USERS,
+    "HKEY_PERFORMANCE_DATA": registry_backend.HKEY_PERFORMANCE_DATA,
+    "HKEY_CURRENT_CONFIG": registry_backend.HKEY_CURRENT_CONFIG,
+    "HKEY_DYN_DATA": registry_backend.HKEY_DYN_DATA
 }
 
 
@@ -70,20 +126,20 @@ class RegistryKeyType(enum.IntEnum):
 
 
 TYPES_MAP = {
-    RegistryKeyType.REG_BINARY: winreg.REG_BINARY,
-    RegistryKeyType.REG_DWORD: winreg.REG_DWORD,
-    RegistryKeyType.REG_DWORD_LITTLE_ENDIAN: winreg.REG_DWORD_LITTLE_ENDIAN,
-    RegistryKeyType.REG_DWORD_BIG_ENDIAN: winreg.REG_DWORD_BIG_ENDIAN,
-    RegistryKeyType.REG_EXPAND_SZ: winreg.REG_EXPAND_SZ,
-    RegistryKeyType.REG_LINK: winreg.REG_LINK,
-    RegistryKeyType.REG_MULTI_SZ: winreg.REG_MULTI_SZ,
-    RegistryKeyType.REG_NONE: winreg.REG_NONE,
-    RegistryKeyType.REG_QWORD: winreg.REG_QWORD,
-    RegistryKeyType.REG_QWORD_LITTLE_ENDIAN: winreg.REG_QWORD_LITTLE_ENDIAN,
-    RegistryKeyType.REG_RESOURCE_LIST: winreg.REG_RESOURCE_LIST,
-    RegistryKeyType.REG_FULL_RESOURCE_DESCRIPTOR: winreg.REG_FULL_RESOURCE_DESCRIPTOR,
-    RegistryKeyType.REG_RESOURCE_REQUIREMENTS_LIST: winreg.REG_RESOURCE_REQUIREMENTS_LIST,
-    RegistryKeyType.REG_SZ: winreg.REG_SZ
+    RegistryKeyType.REG_BINARY: registry_backend.REG_BINARY,
+    RegistryKeyType.REG_DWORD: registry_backend.REG_DWORD,
+    RegistryKeyType.REG_DWORD_LITTLE_ENDIAN: registry_backend.REG_DWORD_LITTLE_ENDIAN,
+    RegistryKeyType.REG_DWORD_BIG_ENDIAN: registry_backend.REG_DWORD_BIG_ENDIAN,
+    RegistryKeyType.REG_EXPAND_SZ: registry_backend.REG_EXPAND_SZ,
+    RegistryKeyType.REG_LINK: registry_backend.REG_LINK,
+    RegistryKeyType.REG_MULTI_SZ: registry_backend.REG_MULTI_SZ,
+    RegistryKeyType.REG_NONE: registry_backend.REG_NONE,
+    RegistryKeyType.REG_QWORD: registry_backend.REG_QWORD,
+    RegistryKeyType.REG_QWORD_LITTLE_ENDIAN: registry_backend.REG_QWORD_LITTLE_ENDIAN,
+    RegistryKeyType.REG_RESOURCE_LIST: registry_backend.REG_RESOURCE_LIST,
+    RegistryKeyType.REG_FULL_RESOURCE_DESCRIPTOR: registry_backend.REG_FULL_RESOURCE_DESCRIPTOR,
+    RegistryKeyType.REG_RESOURCE_REQUIREMENTS_LIST: registry_backend.REG_RESOURCE_REQUIREMENTS_LIST,
+    RegistryKeyType.REG_SZ: registry_backend.REG_SZ
 }
 
 
@@ -100,12 +156,22 @@ class Wow64RegistryEntry(enum.IntEnum):
 
 
 WOW64_MAP = {
-    Wow64RegistryEntry.KEY_WOW32: winreg.KEY_WOW64_32KEY,
-    Wow64RegistryEntry.KEY_WOW64: winreg.KEY_WOW64_64KEY,
+    Wow64RegistryEntry.KEY_WOW32: registry_backend.KEY_WOW64_32KEY,
+    Wow64RegistryEntry.KEY_WOW64: registry_backend.KEY_WOW64_64KEY,
     Wow64RegistryEntry.KEY_WOW32_64: 0
 }
 
 
+class SubkeyValues(collections.namedtuple("SubkeyValues", ["values", "skipped", "failed"])):
+    """
+    Result of read_subkeys_value()
+    values - list of (subkey name, value name as stored, value data) tuples of subkeys which have the value
+    skipped - number of subkeys where the value is absent or has unexpected type
+    failed - number of subkeys which could not be opened or read
+    """
+    __slots__ = ()
+
+
 def is_key_exist(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
     """
     Check if registry key exist
@@ -117,10 +183,11 @@ def is_key_exist(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
         raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with create_key()")
 
+    backend = get_backend()
     try:
         key_hive_value = HIVES_MAP[key_hive]
         wow64_flags = WOW64_MAP[access_type]
-        winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_READ))
+        backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_READ))
         return True
     except WindowsError as e:
         # FileNotFound = 2
@@ -130,55 +197,156 @@ def is_key_exist(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
         return False
 
 
-def enumerate_key_values(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
+class EnumerationProgress:
     """
-    Enumerate Windows Registry key (only subkeys, no values)
-    :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
-    :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
-    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
-    :return: List of registry subkeys
+    Progress of streaming enumeration, may be shared by several generators to collect partial results
+    keys - number of opened keys
+    values - number of yielded values
+    subkeys - number of yielded subkey names
+    errors - list of (key_hive, key_path, entry, LastError, message) tuples of enumerations ended by an error
     """
-    if access_type == Wow64RegistryEntry.KEY_WOW32_64:
-        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with enumerate_key_values()")
-
+    def __init__(self):
+        self.keys = 0
+        self.values = 0
+        self.subkeys = 0
+        self.errors = []
+
+    @property
+    def complete(self):
+        """
+        :return: True if no enumeration was ended by an error
+        """
+        return not self.errors
+
+
+def _iter_key_entries(key_hive, key_path, access_type, progress, enumerate_values):
+    backend = get_backend()
     entry_num = 0
+    registry_key = None
+    enum_function = backend.EnumValue if enumerate_values else backend.EnumKey
     try:
         key_hive_value = HIVES_MAP[key_hive]
         wow64_flags = WOW64_MAP[access_type]
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_READ))
-        result = []
-        for entry_num in range(0, winreg.QueryInfoKey(registry_key)[1]):
-            result.append(winreg.EnumValue(registry_key, entry_num))
-        return result
+        registry_key = backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_READ))
+        if progress is not None:
+            progress.keys += 1
+        while True:
+            try:
+                entry = enum_function(registry_key, entry_num)
+            except WindowsError as e:
+                if e.winerror == ERROR_NO_MORE_ITEMS:
+                    return
+                raise
+            entry_num += 1
+            if progress is not None:
+                if enumerate_values:
+                    progress.values += 1
+                else:
+                    progress.subkeys += 1
+            yield entry
     except WindowsError as e:
-        logger.error("Unable to enumerate registry key subkeys %s\\%s with LastError=%d [%s], entry=%d",
-                     key_hive, key_path, e.winerror, e.strerror, entry_num)
-        return None
+        logger.error("Unable to enumerate registry key %s %s\\%s with LastError=%d [%s], entry=%d",
+                     "values" if enumerate_values else "subkeys", key_hive, key_path, e.winerror, e.strerror, entry_num)
+        if progress is not None:
+            progress.errors.append((key_hive, key_path, entry_num, e.winerror, e.strerror))
+    finally:
+        if registry_key is not None:
+            backend.CloseKey(registry_key)
 
 
-def enumerate_key_subkeys(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
+def iter_key_values(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64, progress=None):
     """
-    Enumerate Windows Registry key (only values, no subkeys)
+    Lazily enumerate Windows Registry key values (no subkeys). The key stays open until the generator is exhausted
+    or closed, so the caller may stop early. Enumeration error ends the generator and is recorded in progress
     :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
     :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
     :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
-    :return: List of tuples (RegValue, Data, Type)
+    :param progress: optional EnumerationProgress object to collect counters and errors
+    :return: Generator of tuples (RegValue, Data, Type)
     """
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
-        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with enumerate_key_subkeys()")
-    entry_num = 0
+        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with iter_key_values()")
+    return _iter_key_entries(key_hive, key_path, access_type, progress, enumerate_values=True)
+
+
+def iter_key_subkeys(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64, progress=None):
+    """
+    Lazily enumerate Windows Registry key subkeys (no values). The key stays open until the generator is exhausted
+    or closed, so the caller may stop early. Enumeration error ends the generator and is recorded in progress
+    :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
+    :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
+    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
+    :param progress: optional EnumerationProgress object to collect counters and errors
+    :return: Generator of subkey names
+    """
+    if access_type == Wow64RegistryEntry.KEY_WOW32_64:
+        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with iter_key_subkeys()")
+    return _iter_key_entries(key_hive, key_path, access_type, progress, enumerate_values=False)
+
+
+def walk_key(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64, progress=None, max_depth=None):
+    """
+    Recursively walk Windows Registry key, depth-first, parent keys first.
+    Only one subkey enumeration per tree level is kept open, so memory is bounded by the tree depth and the number
+    of values in a single key, not by the size of the subtree
+    :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
+    :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
+    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
+    :param progress: optional EnumerationProgress object to collect counters and errors
+    :param max_depth: optional limit of subkey levels to descend, 0 visits the key itself only
+    :return: Generator of tuples (key path, list of tuples (RegValue, Data, Type))
+    """
+    if access_type == Wow64RegistryEntry.KEY_WOW32_64:
+        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with walk_key()")
+    return _walk_key(key_hive, key_path, access_type, progress, max_depth)
+
+
+def _walk_key(key_hive, key_path, access_type, progress, max_depth):
+    stack = []
     try:
-        key_hive_value = HIVES_MAP[key_hive]
-        wow64_flags = WOW64_MAP[access_type]
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_READ))
-        result = []
-        for entry_num in range(0, winreg.QueryInfoKey(registry_key)[0]):
-            result.append(winreg.EnumKey(registry_key, entry_num))
-        return result
-    except WindowsError as e:
-        logger.error("Unable to enumerate registry key values %s\\%s with LastError=%d [%s], entry=%d",
-                     key_hive, key_path, e.winerror, e.strerror, entry_num)
-        return None
+        yield key_path, list(iter_key_values(key_hive, key_path, access_type, progress))
+        if max_depth is None or max_depth > 0:
+            stack.append((key_path, iter_key_subkeys(key_hive, key_path, access_type, progress)))
+        while stack:
+            parent_path, subkeys = stack[-1]
+            subkey_name = next(subkeys, None)
+            if subkey_name is None:
+                stack.pop()
+                continue
+            subkey_path = "{0}\\{1}".format(parent_path, subkey_name)
+            yield subkey_path, list(iter_key_values(key_hive, subkey_path, access_type, progress))
+            if max_depth is None or len(stack) < max_depth:
+                stack.append((subkey_path, iter_key_subkeys(key_hive, subkey_path, access_type, progress)))
+    finally:
+        for _, subkeys in stack:
+            subkeys.close()
+
+
+def enumerate_key_values(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
+    """
+    Enumerate Windows Registry key (only values, no subkeys)
+    :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
+    :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
+    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
+    :return: List of tuples (RegValue, Data, Type), None if enumeration failed. Use iter_key_values() to keep
+    partial results
+    """
+    progress = EnumerationProgress()
+    result = list(iter_key_values(key_hive, key_path, access_type, progress))
+    return result if progress.complete else None
+
+
+def enumerate_key_subkeys(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
+    """
+    Enumerate Windows Registry key (only subkeys, no values)
+    :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
+    :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
+    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
+    :return: List of registry subkeys, None if enumeration failed. Use iter_key_subkeys() to keep partial results
+    """
+    progress = EnumerationProgress()
+    result = list(iter_key_subkeys(key_hive, key_path, access_type, progress))
+    return result if progress.complete else None
 
 
 def create_key(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
@@ -192,10 +360,12 @@ def create_key(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
         raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with create_key()")
 
+    backend = get_backend()
     try:
         key_hive_value = HIVES_MAP[key_hive]
         wow64_flags = WOW64_MAP[access_type]
-        registry_key = winreg.CreateKeyEx(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_WRITE))
+        registry_key = backend.CreateKeyEx(key_hive_value, key_path, 0,
+                                           (wow64_flags | registry_backend.KEY_WRITE))
         return registry_key
     except WindowsError as e:
         logger.error("Unable to create registry key %s\\%s with LastError=%d [%s]",
@@ -214,10 +384,11 @@ def delete_key(key_hive, key_path, access_type=Wow64RegistryEntry.KEY_WOW64):
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
         raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with delete_key()")
 
+    backend = get_backend()
     try:
         key_hive_value = HIVES_MAP[key_hive]
         wow64_flags = WOW64_MAP[access_type]
-        winreg.DeleteKeyEx(key_hive_value, key_path, (wow64_flags | winreg.KEY_WRITE), 0)
+        backend.DeleteKeyEx(key_hive_value, key_path, (wow64_flags | registry_backend.KEY_WRITE), 0)
         return True
     except WindowsError as e:
         logger.error("Unable to delete registry key %s\\%s with LastError=%d [%s]",
@@ -239,6 +410,7 @@ def create_value(key_hive, key_path, value_name, value_type, key_value, access_t
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
         raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with create_value()")
 
+    backend = get_backend()
     registry_key = None
     wow64_flags = WOW64_MAP[access_type]
     try:
@@ -247,15 +419,15 @@ def create_value(key_hive, key_path, value_name, value_type, key_value, access_t
         if isinstance(value_type, RegistryKeyType):
             value_type = TYPES_MAP[value_type]
 
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_WRITE))
-        winreg.SetValueEx(registry_key, value_name, 0, value_type, key_value)
-        winreg.CloseKey(registry_key)
+        registry_key = backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_WRITE))
+        backend.SetValueEx(registry_key, value_name, 0, value_type, key_value)
+        backend.CloseKey(registry_key)
         return True
     except WindowsError as e:
         logger.error("Unable to write to registry path %s\\%s with LastError=%d [%s]",
                      key_hive, key_path, e.winerror, e.strerror)
         if registry_key is not None:
-            winreg.CloseKey(registry_key)
+            backend.CloseKey(registry_key)
         return False
 
 
@@ -271,46 +443,50 @@ def delete_value(key_hive, key_path, value_name, access_type=Wow64RegistryEntry.
     if access_type == Wow64RegistryEntry.KEY_WOW32_64:
         raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with delete_value()")
 
+    backend = get_backend()
     try:
         key_hive_value = HIVES_MAP[key_hive]
         wow64_flags = WOW64_MAP[access_type]
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_WRITE))
-        winreg.DeleteValue(registry_key, value_name)
+        registry_key = backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_WRITE))
+        backend.DeleteValue(registry_key, value_name)
         return True
     except WindowsError as e:
         logger.error("Unable to delete registry value %s\\%s with LastError=%d [%s]",
                      key_hive, key_path, e.winerror, e.strerror)
-        return None
+        return False
 
 
-def read_value(key_hive, key_path, value_name, access_type=Wow64RegistryEntry.KEY_WOW64):
+def read_value(key_hive, key_path, value_name, access_type=Wow64RegistryEntry.KEY_WOW64, missing_ok=False):
     """
     :param key_hive: Windows registry hive to edit, e.g. HKEY_CURRENT_USER
     :param key_path: Path Windows registry key inside the hive, for example "SOFTWARE\Microsoft\Windows"
     :param value_name: Value name we want to read
     :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE and HKCU/SOFTWARE keys.
     Exclusively 32/64 bit, or both. Does not affect 32-bit system and in other cases which are not applicable
+    :param missing_ok: Do not log an error if the key or value does not exist
     :return: Tuple if succeed, 4 values (2 tuples by 2) if both WOW64_32 and WOW64_64 registry entries requested,
     2 values otherwise. None if read operation failed
     """
     if is_x64os() and access_type == Wow64RegistryEntry.KEY_WOW32_64:
-        value32, regtype32 = read_value(key_hive, key_path, value_name, Wow64RegistryEntry.KEY_WOW32)
-        value64, regtype64 = read_value(key_hive, key_path, value_name, Wow64RegistryEntry.KEY_WOW64)
+        value32, regtype32 = read_value(key_hive, key_path, value_name, Wow64RegistryEntry.KEY_WOW32, missing_ok)
+        value64, regtype64 = read_value(key_hive, key_path, value_name, Wow64RegistryEntry.KEY_WOW64, missing_ok)
         return (value32, regtype32), (value64, regtype64)
 
+    backend = get_backend()
     wow64_flags = WOW64_MAP[access_type]
     registry_key = None
     try:
         key_hive_value = HIVES_MAP[key_hive]
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_READ))
-        value, regtype = winreg.QueryValueEx(registry_key, value_name)
-        winreg.CloseKey(registry_key)
+        registry_key = backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_READ))
+        value, regtype = backend.QueryValueEx(registry_key, value_name)
+        backend.CloseKey(registry_key)
         return value, regtype
     except WindowsError as e:
-        logger.error("Unable to read from registry path %s\\%s with LastError=%d [%s]",
-                     key_hive, key_path, e.winerror, e.strerror)
+        if not (missing_ok and e.winerror == ERROR_FILE_NOT_FOUND):
+            logger.error("Unable to read from registry path %s\\%s with LastError=%d [%s]",
+                         key_hive, key_path, e.winerror, e.strerror)
         if registry_key is not None:
-            winreg.CloseKey(registry_key)
+            backend.CloseKey(registry_key)
         return None
 
 
@@ -326,10 +502,11 @@ def write_value(key_hive, key_path, value_name, value_type, key_value, access_ty
     :return: Boolean success flag, True if succeed, False otherwise
     """
     if is_x64os() and access_type == Wow64RegistryEntry.KEY_WOW32_64:
-        write_value(key_hive, key_path, value_name, value_type, key_value, Wow64RegistryEntry.KEY_WOW32)
-        write_value(key_hive, key_path, value_name, value_type, key_value, Wow64RegistryEntry.KEY_WOW64)
-        return
+        result32 = write_value(key_hive, key_path, value_name, value_type, key_value, Wow64RegistryEntry.KEY_WOW32)
+        result64 = write_value(key_hive, key_path, value_name, value_type, key_value, Wow64RegistryEntry.KEY_WOW64)
+        return result32 and result64
 
+    backend = get_backend()
     registry_key = None
     wow64_flags = WOW64_MAP[access_type]
     try:
@@ -337,13 +514,89 @@ def write_value(key_hive, key_path, value_name, value_type, key_value, access_ty
         if isinstance(value_type, RegistryKeyType):
             value_type = TYPES_MAP[value_type]
 
-        registry_key = winreg.OpenKey(key_hive_value, key_path, 0, (wow64_flags | winreg.KEY_WRITE))
-        winreg.SetValueEx(registry_key, value_name, 0, value_type, key_value)
-        winreg.CloseKey(registry_key)
+        registry_key = backend.OpenKey(key_hive_value, key_path, 0, (wow64_flags | registry_backend.KEY_WRITE))
+        backend.SetValueEx(registry_key, value_name, 0, value_type, key_value)
+        backend.CloseKey(registry_key)
         return True
     except WindowsError as e:
         logger.error("Unable to write to registry path %s\\%s with LastError=%d [%s]",
                      key_hive, key_path, e.winerror, e.strerror)
         if registry_key is not None:
-            winreg.CloseKey(registry_key)
+            backend.CloseKey(registry_key)
         return False
+
+
+def read_subkeys_value(key_hive, key_path, value_name, value_type, access_type=Wow64RegistryEntry.KEY_WOW64):
+    """
+    Read the same value of every direct subkey of the key in a single enumeration pass, e.g. to plan its rewrite.
+    Every subkey is opened once and its values are enumerated on that handle. Failures are counted per subkey and do
+    not stop the enumeration
+    :param key_hive: Windows registry hive to read, e.g. HKEY_CURRENT_USER
+    :param key_path: Path Windows registry key inside the hive, which subkeys contain the value
+    :param value_name: Value name to read in every subkey
+    :param value_type: Expected value type, values of other types are skipped. RegistryKeyType or winreg type
+    :param access_type: Access type for 32/64 bit registry sub-entries in HKLM/SOFTWARE key.
+    :return: SubkeyValues, None if the key itself can't be enumerated
+    """
+    if access_type == Wow64RegistryEntry.KEY_WOW32_64:
+        raise RuntimeError("Use either KEY_WOW64 or KEY_WOW32 with read_subkeys_value()")
+
+    backend = get_backend()
+    if isinstance(value_type, RegistryKeyType):
+        value_type = TYPES_MAP[value_type]
+    wow64_flags = WOW64_MAP[access_type]
+    try:
+        parent_key = backend.OpenKey(HIVES_MAP[key_hive], key_path, 0, (wow64_flags | registry_backend.KEY_READ))
+    except WindowsError as e:
+        logger.error("Unable to open registry key %s\\%s with LastError=%d [%s]",
+                     key_hive, key_path, e.winerror, e.strerror)
+        return None
+
+    values = []
+    skipped = failed = 0
+    value_name_lower = value_name.lower()
+    subkey_num = 0
+    try:
+        while True:
+            try:
+                subkey_name = backend.EnumKey(parent_key, subkey_num)
+            except WindowsError as e:
+                if e.winerror != ERROR_NO_MORE_ITEMS:
+                    logger.error("Unable to enumerate registry key subkeys %s\\%s with LastError=%d [%s], entry=%d",
+                                 key_hive, key_path, e.winerror, e.strerror, subkey_num)
+                break
+            subkey_num += 1
+
+            subkey = None
+            try:
+                subkey = backend.OpenKey(parent_key, subkey_name, 0, (wow64_flags | registry_backend.KEY_READ))
+                current = None
+                value_num = 0
+                while current is None:
+                    try:
+                        entry = backend.EnumValue(subkey, value_num)
+                    except WindowsError as e:
+                        if e.winerror != ERROR_NO_MORE_ITEMS:
+                            raise
+                        break
+                    value_num += 1
+                    if entry[0].lower() == value_name_lower:
+                        current = entry
+
+                if current is None or current[2] != value_type:
+                    logger.warning("Skip %s\\%s\\%s Value:%s Type:%s", key_hive, key_path, subkey_name, value_name,
+                                   "missing" if current is None else current[2])
+                    skipped += 1
+                    continue
+                values.append((subkey_name, current[0], current[1]))
+            except WindowsError as e:
+                logger.error("Unable to read registry path %s\\%s\\%s with LastError=%d [%s]",
+                             key_hive, key_path, subkey_name, e.winerror, e.strerror)
+                failed += 1
+            finally:
+                if subkey is not None:
+                    backend.CloseKey(subkey)
+    finally:
+        backend.CloseKey(parent_key)
+
+    return SubkeyValues(values=values, skipped=skipped, failed=failed)
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import logging
+import log_helper
+import registry_plan
+
+logger = log_helper.setup_logger(name="registry_journal", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Write-ahead journal of registry plan application.
+Before a batch of planned operations is written to the registry, the operations and the original values are appended
+to the journal file and fsync'd. Completion markers are appended after every write and the journal is closed with
+a commit record. A journal without the final record means the run died halfway; such journal can be rolled forward
+(re-apply the remaining operations) or back (restore the original values). The begin record names the target of the
+run, the live registry or the offline hive directory, and a journal is recovered only against the same target
+"""
+
+JOURNAL_SUFFIX = ".journal"
+
+# Number of operations flushed to disk with a single fsync
+DEFAULT_BATCH_SIZE = 16
+
+RECOVER_FORWARD = "forward"
+RECOVER_BACK = "back"
+
+# Target of runs against the registry of the running system
+LIVE_TARGET = "live"
+
+
+class WriteAheadJournal:
+    """
+    Append-only JSON lines journal file. Records:
+    {"event": "begin", "target": ...} - journal opened, target is LIVE_TARGET or offline_target() of the hive directory
+    {"event": "plan", "seq": N, "operation": {...}, "original": {...}} - operation is going to be applied
+    {"event": "done", "seq": N, "success": bool} - operation has been applied
+    {"event": "commit"} / {"event": "recovered"} - journal is complete
+    {"event": "discarded"} - journal is complete, the changes were made to a copy which was dropped
+    """
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, target=LIVE_TARGET):
+        """
+        :param path: journal file path, created if does not exist
+        :param batch_size: number of planned operations to flush to disk with a single fsync
+        :param target: LIVE_TARGET or offline_target() of the hive directory the changes are written to
+        """
+        self.path = path
+        self.batch_size = max(int(batch_size), 1)
+        self.sequence = 0
+        self.journal_file = open(path, "a", encoding="utf-8")
+        self._append({"event": "begin", "time": time.time(), "pid": os.getpid(), "target": target})
+        self.sync()
+
+    @classmethod
+    def create(cls, journal_dir, batch_size=DEFAULT_BATCH_SIZE, target=LIVE_TARGET):
+        """
+        Create new journal file with unique name in the journal directory
+        :return: WriteAheadJournal object
+        """
+        os.makedirs(journal_dir, exist_ok=True)
+        name = "antios-{0}-{1}{2}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid(), JOURNAL_SUFFIX)
+        return cls(os.path.join(journal_dir, name), batch_size, target)
+
+    def _append(self, record):
+        self.journal_file.write(json.dumps(record, sort_keys=True))
+        self.journal_file.write("\n")
+
+    def sync(self):
+        """
+        Flush journal records to disk
+        """
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def log_planned(self, operations, originals):
+        """
+        Append planned operations with original values and flush them to disk
+        :param operations: list of registry_plan.RegistryOperation
+        :param originals: list of registry_plan.SnapshotEntry, one per operation
+        :return: list of sequence numbers to pass to log_done()
+        """
+        sequence = []
+        for operation, original in zip(operations, originals):
+            self.sequence += 1
+            self._append({"event": "plan",
+                          "seq": self.sequence,
+                          "operation": registry_plan.operation_to_dict(operation),
+                          "original": registry_plan.entry_to_dict(original)})
+            sequence.append(self.sequence)
+        self.sync()
+        return sequence
+
+    def log_done(self, sequence, success):
+        """
+        Append completion marker. Markers are not flushed separately, they are written with the next batch
+        """
+        self._append({"event": "done", "seq": sequence, "success": bool(success)})
+
+    def close(self, event="commit"):
+        """
+        Append the final record, flush and close the journal
+        :param event: final record event, None to close the journal incomplete
+        """
+        if event is not None:
+            self._append({"event": event, "time": time.time()})
+        self.sync()
+        self.journal_file.close()
+
+    def commit(self):
+        self.close("commit")
+
+
+class JournalState:
+    """
+    Parsed journal content
+    planned - list of (sequence, RegistryOperation, SnapshotEntry) tuples in order of appearance
+    done - set of sequence numbers of applied operations
+    complete - True if the journal has the final record
+    target - target of the journal, None if it has no begin record
+    """
+    def __init__(self, path):
+        self.path = path
+        self.target = None
+        self.planned = []
+        self.done = set()
+        self.complete = False
+
+    @property
+    def pending(self):
+        """
+        :return: list of (sequence, RegistryOperation, SnapshotEntry) tuples without completion marker
+        """
+        return [planned for planned in self.planned if planned[0] not in self.done]
+
+
+def load_journal(path):
+    """
+    Parse journal file. Torn trailing record, left by the crash in the middle of write, is ignored
+    :return: JournalState object
+    """
+    state = JournalState(path)
+    with open(path, encoding="utf-8") as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skip damaged journal record in {0}".format(path))
+                continue
+            event = record.get("event")
+            if event == "begin":
+                state.target = record.get("target")
+            elif event == "plan":
+                state.planned.append((record["seq"],
+                                      registry_plan.operation_from_dict(record["operation"]),
+                                      registry_plan.entry_from_dict(record["original"])))
+            elif event == "done":
+                state.done.add(record["seq"])
+            elif event in ("commit", "recovered", "discarded"):
+                state.complete = True
+    return state
+
+
+def offline_target(hive_dir):
+    """
+    :param hive_dir: offline hive directory
+    :return: journal target of runs against the hive directory
+    """
+    return os.path.normcase(os.path.abspath(hive_dir))
+
+
+def read_target(path):
+    """
+    :param path: journal file path
+    :return: target from the begin record of the journal, None if it has none
+    """
+    with open(path, encoding="utf-8") as journal_file:
+        try:
+            record = json.loads(journal_file.readline())
+        except ValueError:
+            return None
+    return record.get("target") if record.get("event") == "begin" else None
+
+
+def find_incomplete(journal_dir):
+    """
+    :param journal_dir: directory with journal files
+    :return: sorted list of paths of journals without the final record
+    """
+    if not os.path.isdir(journal_dir):
+        return []
+    result = []
+    for name in sorted(os.listdir(journal_dir)):
+        path = os.path.join(journal_dir, name)
+        if name.endswith(JOURNAL_SUFFIX) and not load_journal(path).complete:
+            result.append(path)
+    return result
+
+
+def recover(path, mode, target=LIVE_TARGET):
+    """
+    Recover registry state recorded in the incomplete journal
+    :param path: journal file path
+    :param mode: RECOVER_FORWARD to apply operations without completion marker,
+    RECOVER_BACK to restore original values of all planned operations in reverse order
+    :param target: target of the current registry backend, LIVE_TARGET or offline_target() of the hive directory
+    :return: registry_plan.ApplyResult
+    :raises ValueError: if the journal was written for another target
+    """
+    state = load_journal(path)
+    if state.target != target:
+        raise ValueError("Journal {0} was written for {1}, not for {2}".format(path, state.target or "unknown target",
+                                                                            target))
+    if mode == RECOVER_FORWARD:
+        written = failed = 0
+        for _, operation, _ in state.pending:
+            if registry_plan.apply_operation(operation):
+                written += 1
+            else:
+                failed += 1
+        result = registry_plan.ApplyResult(written=written, failed=failed)
+    elif mode == RECOVER_BACK:
+        result = registry_plan.restore_snapshot([original for _, _, original in state.planned])
+    else:
+        raise ValueError("Unknown recovery mode {0}".format(mode))
+
+    logger.info("Journal {0} rolled {1}: {2} restored, {3} failed".format(path, mode, result.written, result.failed))
+    with open(path, "rb") as journal_file:
+        journal_file.seek(0, os.SEEK_END)
+        torn = False
+        if journal_file.tell() > 0:
+            journal_file.seek(-1, os.SEEK_END)
+            torn = journal_file.read(1) != b"\n"
+    with open(path, "a", encoding="utf-8") as journal_file:
+        if torn:
+            journal_file.write("\n")
+        journal_file.write(json.dumps({"event": "recovered", "mode": mode, "time": time.time()}, sort_keys=True))
+        journal_file.write("\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    return result
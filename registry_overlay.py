@@ -0,0 +1,444 @@
+import json
+import collections
+import registry_backend
+import registry_plan
+import snapshot_diff
+
+from registry_backend import RegistryError, PREDEFINED_KEYS, KEY_WOW64_32KEY, ERROR_FILE_NOT_FOUND, \
+    ERROR_NO_MORE_ITEMS, ERROR_INVALID_HANDLE, ERROR_ACCESS_DENIED
+from registry_helper import Wow64RegistryEntry
+from registry_plan import RegistryOperation, SnapshotEntry
+
+
+__doc__ = """Copy-on-write overlay backend for what-if runs.
+OverlayRegistry wraps any registry backend, e.g. the live winreg module: reads pass through to it, while writes,
+deletions and created keys are staged in memory and seen by later reads through the overlay, so read-modify-write
+code such as the telemetry query rewrite behaves exactly like in a real run. The wrapped backend is never written.
+Staged values are kept in a dictionary per key, so staging is O(1) per value; keys without staged changes are
+enumerated directly by the wrapped backend. At the end, staged_plan() returns the staged writes as a plan and
+changes() compares them with the wrapped backend, as snapshot_diff changes
+"""
+
+# Value type of staged value deletions, (name, None, _DELETED)
+_DELETED = None
+
+
+class _StagedKey:
+    """
+    Staged state of the single key: values by lower-case name, created and deleted subkeys
+    """
+    __slots__ = ("hive_name", "key_path", "access_type", "values", "created", "deleted", "subkeys")
+
+    def __init__(self, hive_name, key_path, access_type):
+        self.hive_name = hive_name
+        self.key_path = key_path
+        self.access_type = access_type
+        # lower-case name -> (name, data, type), type is _DELETED for deletions, in order of staging
+        self.values = collections.OrderedDict()
+        # Key did not exist in the wrapped backend
+        self.created = False
+        # Key was deleted in the overlay
+        self.deleted = False
+        # lower-case name -> name of subkeys created in the overlay
+        self.subkeys = collections.OrderedDict()
+
+    @property
+    def touched(self):
+        return bool(self.values or self.subkeys or self.created or self.deleted)
+
+
+class OverlayKeyHandle:
+    """
+    Open key handle of OverlayRegistry. base is the handle of the wrapped backend, None if the key exists
+    in the overlay only
+    """
+    __slots__ = ("root", "hive_name", "parts", "access", "identity", "base", "closed", "cache")
+
+    def __init__(self, root, hive_name, parts, access, identity, base):
+        self.root = root
+        self.hive_name = hive_name
+        self.parts = parts
+        self.access = access
+        self.identity = identity
+        self.base = base
+        self.closed = False
+        # (overlay version, values, subkeys) of the merged key, so enumeration does not merge once per index
+        self.cache = None
+
+    def Close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class OverlayRegistry:
+    """
+    winreg-compatible backend which stages all changes in memory on top of the wrapped backend.
+    It is not live even if the wrapped backend is, so registry_backend.is_live() returns False for it
+    """
+    def __init__(self, base):
+        """
+        :param base: wrapped registry backend, only read
+        """
+        self.base = base
+        self.operations = 0
+        # (root, lower-case canonical path components) -> _StagedKey
+        self._keys = collections.OrderedDict()
+        # Identities of keys with subkeys deleted in the overlay
+        self._parents_of_deleted = set()
+        # Incremented on every staged change, invalidates merged enumerations of open handles
+        self._version = 0
+
+    #############################################################################
+    # Helpers
+
+    def _resolve(self, key):
+        """
+        :return: tuple (predefined key, hive name, path components, access mask) of an open handle or predefined key
+        """
+        if isinstance(key, OverlayKeyHandle):
+            if key.closed:
+                raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+            return key.root, key.hive_name, key.parts, key.access
+        if key not in PREDEFINED_KEYS:
+            raise RegistryError(ERROR_INVALID_HANDLE, "The handle is invalid")
+        return key, PREDEFINED_KEYS[key], [], 0
+
+    @staticmethod
+    def _identity(root, hive_name, parts, access):
+        # Both registry views of HKLM\SOFTWARE are told apart like MemoryRegistry stores them
+        canonical = registry_backend.wow64_redirect(hive_name, parts, access)
+        return root, tuple(part.lower() for part in canonical)
+
+    def _staged(self, identity, hive_name, parts, access):
+        staged = self._keys.get(identity)
+        if staged is None:
+            access_type = Wow64RegistryEntry.KEY_WOW32 if access & KEY_WOW64_32KEY else Wow64RegistryEntry.KEY_WOW64
+            staged = self._keys[identity] = _StagedKey(hive_name, "\\".join(parts), access_type)
+        return staged
+
+    def _deleted(self, identity):
+        # Only keys without subkeys can be deleted, so a deleted key has no subkeys to check
+        staged = self._keys.get(identity)
+        return staged is not None and staged.deleted
+
+    def _open_base(self, root, parts, access):
+        try:
+            return self.base.OpenKey(root, "\\".join(parts), 0, access)
+        except OSError as e:
+            if getattr(e, "winerror", None) == ERROR_FILE_NOT_FOUND:
+                return None
+            raise
+
+    def _open(self, key, sub_key, access, create):
+        root, hive_name, parent_parts, parent_access = self._resolve(key)
+        # Keys opened relative to a handle stay in its registry view
+        if not access & (KEY_WOW64_32KEY | registry_backend.KEY_WOW64_64KEY):
+            access |= parent_access & (KEY_WOW64_32KEY | registry_backend.KEY_WOW64_64KEY)
+        parts = parent_parts + registry_backend.split_path(sub_key or "")
+        identity = self._identity(root, hive_name, parts, access)
+        base = None
+        if not self._deleted(identity):
+            staged = self._keys.get(identity)
+            if staged is not None and staged.created:
+                return OverlayKeyHandle(root, hive_name, parts, access, identity, None)
+            base = self._open_base(root, parts, access)
+        if base is None:
+            if not create:
+                raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+            self._create(root, hive_name, parts, access)
+        return OverlayKeyHandle(root, hive_name, parts, access, identity, base)
+
+    def _create(self, root, hive_name, parts, access):
+        """
+        Stage creation of the key and its missing parents
+        """
+        for length in range(1, len(parts) + 1):
+            identity = self._identity(root, hive_name, parts[:length], access)
+            staged = self._keys.get(identity)
+            if staged is not None and staged.created and not staged.deleted:
+                continue
+            if staged is None or not staged.deleted:
+                base = self._open_base(root, parts[:length], access) if not self._deleted(identity) else None
+                if base is not None:
+                    self.base.CloseKey(base)
+                    continue
+            self._version += 1
+            staged = self._staged(identity, hive_name, parts[:length], access)
+            staged.created = True
+            staged.deleted = False
+            staged.values.clear()
+            staged.subkeys.clear()
+            if length > 1:
+                parent = self._staged(self._identity(root, hive_name, parts[:length - 1], access), hive_name,
+                                      parts[:length - 1], access)
+                parent.subkeys[parts[length - 1].lower()] = parts[length - 1]
+
+    def _merged(self, handle):
+        """
+        :return: tuple (list of (name, data, type), list of subkey names) of the key with staged changes
+        """
+        if handle.cache is None or handle.cache[0] != self._version:
+            handle.cache = (self._version, self._values(handle), self._subkeys(handle))
+        return handle.cache[1], handle.cache[2]
+
+    def _values(self, handle):
+        staged = self._keys.get(handle.identity)
+        values = collections.OrderedDict()
+        if handle.base is not None and not (staged is not None and staged.created):
+            index = 0
+            while True:
+                try:
+                    value = self.base.EnumValue(handle.base, index)
+                except OSError as e:
+                    if getattr(e, "winerror", None) == ERROR_NO_MORE_ITEMS:
+                        break
+                    raise
+                values[value[0].lower()] = value
+                index += 1
+        if staged is not None:
+            for name, value in staged.values.items():
+                if value[2] is _DELETED:
+                    values.pop(name, None)
+                else:
+                    values[name] = value
+        return list(values.values())
+
+    def _subkeys(self, handle):
+        staged = self._keys.get(handle.identity)
+        subkeys = collections.OrderedDict()
+        if handle.base is not None and not (staged is not None and staged.created):
+            index = 0
+            while True:
+                try:
+                    name = self.base.EnumKey(handle.base, index)
+                except OSError as e:
+                    if getattr(e, "winerror", None) == ERROR_NO_MORE_ITEMS:
+                        break
+                    raise
+                subkeys[name.lower()] = name
+                index += 1
+        if staged is not None:
+            subkeys.update(staged.subkeys)
+        root, path = handle.identity
+        return [name for lower_name, name in subkeys.items() if not self._deleted((root, path + (lower_name,)))]
+
+    def _untouched(self, handle):
+        """
+        :return: True if neither the key nor its subkeys have staged changes, so the wrapped backend answers as is
+        """
+        if handle.base is None:
+            return False
+        staged = self._keys.get(handle.identity)
+        if staged is not None and staged.touched:
+            return False
+        return handle.identity not in self._parents_of_deleted
+
+    #############################################################################
+    # winreg-compatible interface
+
+    def OpenKey(self, key, sub_key, reserved=0, access=registry_backend.KEY_READ):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=False)
+
+    OpenKeyEx = OpenKey
+
+    def CreateKeyEx(self, key, sub_key, reserved=0, access=registry_backend.KEY_WRITE):
+        self.operations += 1
+        return self._open(key, sub_key, access, create=True)
+
+    def CreateKey(self, key, sub_key):
+        return self.CreateKeyEx(key, sub_key)
+
+    def CloseKey(self, handle):
+        if isinstance(handle, OverlayKeyHandle):
+            if handle.base is not None and not handle.closed:
+                self.base.CloseKey(handle.base)
+            handle.Close()
+
+    def QueryValueEx(self, key, value_name):
+        self.operations += 1
+        self._resolve(key)
+        staged = self._keys.get(key.identity) if isinstance(key, OverlayKeyHandle) else None
+        if staged is not None:
+            value = staged.values.get((value_name or "").lower())
+            if value is not None:
+                if value[2] is _DELETED:
+                    raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+                return value[1], value[2]
+            if staged.created:
+                raise RegistryError(ERROR_FILE_NOT_FOUND, "The system cannot find the file specified")
+        return self.base.QueryValueEx(key.base if isinstance(key, OverlayKeyHandle) else key, value_name)
+
+    def SetValueEx(self, key, value_name, reserved, value_type, value):
+        self.operations += 1
+        root, hive_name, parts, access = self._resolve(key)
+        if not parts:
+            raise RegistryError(ERROR_ACCESS_DENIED, "Access is denied")
+        if isinstance(value, bytearray):
+            value = bytes(value)
+        staged = self._staged(key.identity, hive_name, parts, access)
+        staged.values[(value_name or "").lower()] = (value_name or "", value, value_type)
+        self._version += 1
+
+    def DeleteValue(self, key, value_name):
+        self.operations += 1
+        root, hive_name, parts, access = self._resolve(key)
+        if not parts:
+            raise RegistryError(ERROR_ACCESS_DENIED, "Access is denied")
+        # Raises ERROR_FILE_NOT_FOUND if there is no such value
+        self.QueryValueEx(key, value_name)
+        self._staged(key.identity, hive_name, parts, access).values[(value_name or "").lower()] = \
+            (value_name or "", None, _DELETED)
+        self._version += 1
+
+    def DeleteKeyEx(self, key, sub_key, access=registry_backend.KEY_WOW64_64KEY, reserved=0):
+        self.operations += 1
+        handle = self._open(key, sub_key, access, create=False)
+        try:
+            if self._merged(handle)[1]:
+                raise RegistryError(ERROR_ACCESS_DENIED, "Access is denied")
+        finally:
+            self.CloseKey(handle)
+        staged = self._staged(handle.identity, handle.hive_name, handle.parts, handle.access)
+        created = staged.created
+        staged.values.clear()
+        staged.subkeys.clear()
+        staged.created = False
+        staged.deleted = True
+        root, path = handle.identity
+        self._parents_of_deleted.add((root, path[:-1]))
+        if created:
+            parent = self._keys.get((root, path[:-1]))
+            if parent is not None:
+                parent.subkeys.pop(path[-1], None)
+        self._version += 1
+
+    def DeleteKey(self, key, sub_key):
+        self.DeleteKeyEx(key, sub_key)
+
+    def EnumKey(self, key, index):
+        self.operations += 1
+        self._resolve(key)
+        if not isinstance(key, OverlayKeyHandle):
+            return self.base.EnumKey(key, index)
+        if self._untouched(key):
+            return self.base.EnumKey(key.base, index)
+        subkeys = self._merged(key)[1]
+        if index >= len(subkeys):
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return subkeys[index]
+
+    def EnumValue(self, key, index):
+        self.operations += 1
+        self._resolve(key)
+        if not isinstance(key, OverlayKeyHandle):
+            return self.base.EnumValue(key, index)
+        if self._untouched(key):
+            return self.base.EnumValue(key.base, index)
+        values = self._merged(key)[0]
+        if index >= len(values):
+            raise RegistryError(ERROR_NO_MORE_ITEMS, "No more data is available")
+        return values[index]
+
+    def QueryInfoKey(self, key):
+        self.operations += 1
+        self._resolve(key)
+        if not isinstance(key, OverlayKeyHandle):
+            return self.base.QueryInfoKey(key)
+        if self._untouched(key):
+            return self.base.QueryInfoKey(key.base)
+        values, subkeys = self._merged(key)
+        return len(subkeys), len(values), 0
+
+    #############################################################################
+    # Staged changes
+
+    @property
+    def staged_values(self):
+        """
+        :return: number of staged value writes and deletions
+        """
+        return sum(len(staged.values) for staged in self._keys.values())
+
+    def staged_plan(self):
+        """
+        :return: list of RegistryOperation of staged value writes, in order of staging by key.
+        Deletions are not part of plans, they are reported by changes()
+        """
+        plan = []
+        for staged in self._keys.values():
+            for value in staged.values.values():
+                if value[2] is not _DELETED:
+                    plan.append(RegistryOperation(key_hive=staged.hive_name,
+                                                  key_path=staged.key_path,
+                                                  value_name=value[0],
+                                                  value_type=value[2],
+                                                  key_value=value[1],
+                                                  access_type=staged.access_type))
+        return plan
+
+    def _original(self, staged, value_name):
+        """
+        :return: SnapshotEntry of the value in the wrapped backend
+        """
+        access = registry_backend.KEY_READ
+        if staged.access_type == Wow64RegistryEntry.KEY_WOW32:
+            access |= KEY_WOW64_32KEY
+        value = None
+        hive = next(hkey for hkey, name in PREDEFINED_KEYS.items() if name == staged.hive_name)
+        if not staged.created:
+            base = self._open_base(hive, registry_backend.split_path(staged.key_path), access)
+            if base is not None:
+                try:
+                    value = self.base.QueryValueEx(base, value_name)
+                except OSError as e:
+                    if getattr(e, "winerror", None) != ERROR_FILE_NOT_FOUND:
+                        raise
+                finally:
+                    self.base.CloseKey(base)
+        if value is None:
+            return SnapshotEntry(staged.hive_name, staged.key_path, value_name, staged.access_type, None, None)
+        return SnapshotEntry(staged.hive_name, staged.key_path, value_name, staged.access_type, value[1], value[0])
+
+    def changes(self):
+        """
+        Compare staged values with the wrapped backend. Values written with the data they already had are not changes
+        :return: list of snapshot_diff.SnapshotChange sorted like snapshots
+        """
+        result = []
+        for staged in self._keys.values():
+            for value in staged.values.values():
+                old = self._original(staged, value[0])
+                if value[2] is _DELETED:
+                    if old.exists:
+                        result.append(snapshot_diff.SnapshotChange(snapshot_diff.CHANGE_REMOVED, old, None))
+                    continue
+                new = SnapshotEntry(staged.hive_name, staged.key_path, value[0], staged.access_type, value[2],
+                                    value[1])
+                if not old.exists:
+                    result.append(snapshot_diff.SnapshotChange(snapshot_diff.CHANGE_ADDED, None, new))
+                elif (old.value_type != new.value_type or
+                      registry_backend.encode_data(old.value_type, old.key_value) !=
+                      registry_backend.encode_data(new.value_type, new.key_value)):
+                    result.append(snapshot_diff.SnapshotChange(snapshot_diff.CHANGE_CHANGED, old, new))
+        result.sort(key=lambda change: registry_plan.snapshot_sort_key(change.entry))
+        return result
+
+
+def save_changes(changes, path):
+    """
+    Write changes to JSON lines file, one SnapshotChange per line, like snapshot_diff prints them
+    :return: number of changes
+    """
+    count = 0
+    with open(path, "w", encoding="utf-8") as changes_file:
+        for change in changes:
+            changes_file.write(json.dumps(change.to_dict(), sort_keys=True))
+            changes_file.write("\n")
+            count += 1
+    return count
@@ -0,0 +1,317 @@
+import json
+import logging
+import collections
+import log_helper
+import registry_helper
+import run_metrics
+
+from registry_helper import RegistryKeyType, Wow64RegistryEntry, TYPES_MAP
+from system_utils import is_x64os
+
+logger = log_helper.setup_logger(name="registry_plan", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Registry write plans and snapshots.
+A plan is a list of RegistryOperation objects, built by fingerprint sections before anything is written, so it can be
+journaled, exported or verified. A snapshot is a list of SnapshotEntry objects with the values the plan is going
+to overwrite, and can be used to restore the original state
+"""
+
+
+class RegistryOperation(collections.namedtuple("RegistryOperation", ["key_hive", "key_path", "value_name",
+                                                                     "value_type", "key_value", "access_type"])):
+    """
+    Planned registry value write, arguments are the same as registry_helper.write_value() has.
+    value_type and key_value are None for the value deletion, like in SnapshotEntry of an absent value
+    """
+    __slots__ = ()
+
+    def __new__(cls, key_hive, key_path, value_name, value_type, key_value,
+                access_type=Wow64RegistryEntry.KEY_WOW64):
+        return super(RegistryOperation, cls).__new__(cls, key_hive, key_path, value_name, value_type, key_value,
+                                                     access_type)
+
+    def describe(self):
+        """
+        :return: Short human readable description, like "HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\Cryptography Value"
+        """
+        return "{0}\\{1} {2}".format(self.key_hive, self.key_path, self.value_name)
+
+    @property
+    def deletes(self):
+        return self.value_type is None
+
+
+class SnapshotEntry(collections.namedtuple("SnapshotEntry", ["key_hive", "key_path", "value_name", "access_type",
+                                                             "value_type", "key_value"])):
+    """
+    Registry value state captured before the plan is applied. value_type and key_value are None if value is absent
+    """
+    __slots__ = ()
+
+    @property
+    def exists(self):
+        return self.value_type is not None
+
+
+class ApplyResult(collections.namedtuple("ApplyResult", ["written", "failed"])):
+    """
+    Number of successful and failed writes of the applied plan
+    """
+    __slots__ = ()
+
+
+def expand_operations(plan):
+    """
+    Split KEY_WOW32_64 operations into separate 32-bit and 64-bit view operations on 64-bit systems,
+    and use the only view on 32-bit systems, so every operation targets exactly one registry entry
+    :param plan: iterable of RegistryOperation
+    :return: list of RegistryOperation
+    """
+    x64 = is_x64os()
+    result = []
+    for operation in plan:
+        if operation.access_type != Wow64RegistryEntry.KEY_WOW32_64:
+            result.append(operation)
+        elif x64:
+            result.append(operation._replace(access_type=Wow64RegistryEntry.KEY_WOW32))
+            result.append(operation._replace(access_type=Wow64RegistryEntry.KEY_WOW64))
+        else:
+            result.append(operation._replace(access_type=Wow64RegistryEntry.KEY_WOW64))
+    return result
+
+
+def read_state(key_hive, key_path, value_name, access_type):
+    """
+    Read current value state of the single registry entry
+    :return: SnapshotEntry object
+    """
+    current = registry_helper.read_value(key_hive, key_path, value_name, access_type, missing_ok=True)
+    if current is None:
+        return SnapshotEntry(key_hive, key_path, value_name, access_type, None, None)
+    return SnapshotEntry(key_hive, key_path, value_name, access_type, current[1], current[0])
+
+
+def capture_snapshot(plan):
+    """
+    Read the values which the plan is going to overwrite
+    :param plan: iterable of RegistryOperation
+    :return: list of SnapshotEntry
+    """
+    return [read_state(operation.key_hive, operation.key_path, operation.value_name, operation.access_type)
+            for operation in expand_operations(plan)]
+
+
+def apply_operation(operation):
+    """
+    Write or delete the single planned value
+    :param operation: RegistryOperation
+    :return: True if succeed, False otherwise
+    """
+    if operation.deletes:
+        logger.debug("Delete {0}".format(operation.describe()))
+        return restore_entry(SnapshotEntry(operation.key_hive, operation.key_path, operation.value_name,
+                                           operation.access_type, None, None))
+    logger.debug("Write {0}".format(operation.describe()))
+    return registry_helper.write_value(key_hive=operation.key_hive,
+                                       key_path=operation.key_path,
+                                       value_name=operation.value_name,
+                                       value_type=operation.value_type,
+                                       key_value=operation.key_value,
+                                       access_type=operation.access_type) is True
+
+
+def restore_entry(entry):
+    """
+    Restore the single snapshot entry: write the original value back or delete the value if it did not exist
+    :param entry: SnapshotEntry
+    :return: True if succeed, False otherwise
+    """
+    if entry.exists:
+        return registry_helper.write_value(key_hive=entry.key_hive,
+                                           key_path=entry.key_path,
+                                           value_name=entry.value_name,
+                                           value_type=entry.value_type,
+                                           key_value=entry.key_value,
+                                           access_type=entry.access_type) is True
+    if read_state(entry.key_hive, entry.key_path, entry.value_name, entry.access_type).exists:
+        return registry_helper.delete_value(key_hive=entry.key_hive,
+                                            key_path=entry.key_path,
+                                            value_name=entry.value_name,
+                                            access_type=entry.access_type) is True
+    return True
+
+
+def apply_plan(plan, journal=None):
+    """
+    Apply the plan. If journal is given, original values and planned operations are recorded and flushed to disk
+    in batches of journal.batch_size before the batch is written, and completion markers are recorded after
+    :param plan: iterable of RegistryOperation
+    :param journal: optional registry_journal.WriteAheadJournal
+    :return: ApplyResult
+    """
+    operations = expand_operations(plan)
+    batch_size = journal.batch_size if journal is not None else len(operations)
+    written = failed = 0
+    for batch_start in range(0, len(operations), max(batch_size, 1)):
+        batch = operations[batch_start:batch_start + batch_size]
+        sequence = None
+        if journal is not None:
+            originals = [read_state(operation.key_hive, operation.key_path, operation.value_name,
+                                    operation.access_type) for operation in batch]
+            sequence = journal.log_planned(batch, originals)
+        for index, operation in enumerate(batch):
+            success = apply_operation(operation)
+            if success:
+                written += 1
+            else:
+                failed += 1
+            if journal is not None:
+                journal.log_done(sequence[index], success)
+    run_metrics.add(run_metrics.VALUES_WRITTEN, written)
+    run_metrics.add(run_metrics.VALUES_FAILED, failed)
+    return ApplyResult(written=written, failed=failed)
+
+
+def restore_snapshot(snapshot):
+    """
+    Restore snapshot entries in reverse order
+    :param snapshot: list of SnapshotEntry
+    :return: ApplyResult
+    """
+    written = failed = 0
+    for entry in reversed(snapshot):
+        if restore_entry(entry):
+            written += 1
+        else:
+            failed += 1
+    return ApplyResult(written=written, failed=failed)
+
+
+#############################################################################
+# Serialization
+
+def encode_value(key_value):
+    """
+    :return: JSON-compatible representation of the registry value data
+    """
+    if isinstance(key_value, (bytes, bytearray)):
+        return {"hex": bytes(key_value).hex()}
+    return key_value
+
+
+def decode_value(encoded_value):
+    """
+    :return: registry value data from encode_value() representation
+    """
+    if isinstance(encoded_value, dict):
+        return bytes.fromhex(encoded_value["hex"])
+    return encoded_value
+
+
+def winreg_type(value_type):
+    """
+    :return: winreg value type of RegistryKeyType or winreg value type
+    """
+    if isinstance(value_type, RegistryKeyType):
+        return TYPES_MAP[value_type]
+    return value_type
+
+
+def operation_to_dict(operation):
+    return {"hive": operation.key_hive,
+            "path": operation.key_path,
+            "name": operation.value_name,
+            "type": winreg_type(operation.value_type),
+            "value": encode_value(operation.key_value),
+            "access": int(operation.access_type)}
+
+
+def operation_from_dict(record):
+    return RegistryOperation(key_hive=record["hive"],
+                             key_path=record["path"],
+                             value_name=record["name"],
+                             value_type=record["type"],
+                             key_value=decode_value(record["value"]),
+                             access_type=Wow64RegistryEntry(record["access"]))
+
+
+def entry_to_dict(entry):
+    return {"hive": entry.key_hive,
+            "path": entry.key_path,
+            "name": entry.value_name,
+            "access": int(entry.access_type),
+            "type": winreg_type(entry.value_type),
+            "value": encode_value(entry.key_value)}
+
+
+def entry_from_dict(record):
+    return SnapshotEntry(key_hive=record["hive"],
+                         key_path=record["path"],
+                         value_name=record["name"],
+                         access_type=Wow64RegistryEntry(record["access"]),
+                         value_type=record["type"],
+                         key_value=decode_value(record["value"]))
+
+
+def snapshot_sort_key(entry):
+    """
+    Snapshot files are sorted case-insensitively by hive, key path, value name and registry view
+    """
+    return entry.key_hive.upper(), entry.key_path.upper(), entry.value_name.upper(), int(entry.access_type)
+
+
+def save_snapshot(snapshot, path):
+    """
+    Save snapshot to JSON lines file, one entry per line, sorted by snapshot_sort_key()
+    """
+    with open(path, "w", encoding="utf-8") as snapshot_file:
+        for entry in sorted(snapshot, key=snapshot_sort_key):
+            snapshot_file.write(json.dumps(entry_to_dict(entry), sort_keys=True))
+            snapshot_file.write("\n")
+
+
+def iter_snapshot(path):
+    """
+    Stream snapshot entries from JSON lines file
+    :return: generator of SnapshotEntry
+    """
+    with open(path, encoding="utf-8") as snapshot_file:
+        for line in snapshot_file:
+            if line.strip():
+                yield entry_from_dict(json.loads(line))
+
+
+def load_snapshot(path):
+    """
+    :return: list of SnapshotEntry from JSON lines file
+    """
+    return list(iter_snapshot(path))
+
+
+def save_plan(plan, path):
+    """
+    Save plan to JSON lines file, one operation per line in order of application
+    """
+    with open(path, "w", encoding="utf-8") as plan_file:
+        for operation in plan:
+            plan_file.write(json.dumps(operation_to_dict(operation), sort_keys=True))
+            plan_file.write("\n")
+
+
+def iter_plan(path):
+    """
+    Stream plan operations from JSON lines file
+    :return: generator of RegistryOperation
+    """
+    with open(path, encoding="utf-8") as plan_file:
+        for line in plan_file:
+            if line.strip():
+                yield operation_from_dict(json.loads(line))
+
+
+def load_plan(path):
+    """
+    :return: list of RegistryOperation from JSON lines file
+    """
+    return list(iter_plan(path))
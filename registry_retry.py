@@ -0,0 +1,150 @@
+import time
+import random
+import logging
+import collections
+import log_helper
+import registry_backend
+import run_metrics
+
+logger = log_helper.setup_logger(name="registry_retry", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Bounded retry of registry backend calls which fail transiently.
+On busy machines a service or an antivirus scanner may hold a key for a moment, e.g. Tcpip\\Parameters or
+WindowsUpdate, and calls on it fail with a sharing or lock violation. RetryingRegistry wraps any winreg-compatible
+backend and repeats such calls with exponential backoff; all other errors, e.g. access denied or a missing key, are
+raised at once. Every call has its own deadline, so one slow key costs the run at most that much time, and the run
+has a deadline of its own, after which transient errors are not retried any more and the run finishes with whatever
+it could write. Deadlines bound waiting between attempts only: a backend call which blocks is not interrupted
+"""
+
+# Error codes of conditions which go away by themselves: the key is held by another process or resources are short
+TRANSIENT_ERRORS = frozenset((
+    registry_backend.ERROR_SHARING_VIOLATION,
+    registry_backend.ERROR_LOCK_VIOLATION,
+    registry_backend.ERROR_BUSY,
+    registry_backend.ERROR_RETRY,
+    registry_backend.ERROR_NO_SYSTEM_RESOURCES,
+    registry_backend.ERROR_TIMEOUT,
+))
+
+# Backend functions which are retried, closing a handle is not
+RETRIED_OPERATIONS = ("OpenKey", "CreateKeyEx", "QueryValueEx", "SetValueEx", "DeleteValue", "DeleteKeyEx",
+                      "EnumKey", "EnumValue", "QueryInfoKey")
+
+_KEY_OPERATIONS = ("OpenKey", "CreateKeyEx", "DeleteKeyEx")
+_VALUE_OPERATIONS = ("QueryValueEx", "SetValueEx", "DeleteValue")
+
+DEFAULT_ATTEMPTS = 6
+DEFAULT_INITIAL_DELAY = 0.05
+DEFAULT_MAX_DELAY = 1.0
+DEFAULT_OPERATION_TIMEOUT = 5.0
+DEFAULT_RUN_TIMEOUT = 60.0
+
+
+class RetryPolicy(collections.namedtuple("RetryPolicy", ["attempts", "initial_delay", "max_delay",
+                                                         "operation_timeout", "run_timeout"])):
+    """
+    attempts - maximum number of attempts of a single call, 1 disables retries
+    initial_delay, max_delay - delay before the first retry, doubled after every retry up to max_delay, seconds
+    operation_timeout - deadline of a single call with all its retries, seconds, None for no deadline
+    run_timeout - deadline of the whole run, after which transient errors are not retried, seconds, None for no deadline
+    """
+    __slots__ = ()
+
+    def __new__(cls, attempts=DEFAULT_ATTEMPTS, initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                operation_timeout=DEFAULT_OPERATION_TIMEOUT, run_timeout=DEFAULT_RUN_TIMEOUT):
+        return super(RetryPolicy, cls).__new__(cls, attempts, initial_delay, max_delay, operation_timeout,
+                                               run_timeout)
+
+    def delay(self, retry, jitter):
+        """
+        :param retry: number of the retry, 0 for the first one
+        :param jitter: random factor in range [0.5, 1], so callers held up by the same key do not retry in step
+        :return: delay before the retry, seconds
+        """
+        return min(self.max_delay, self.initial_delay * (2 ** retry)) * jitter
+
+
+def _describe(name, args):
+    if name in _KEY_OPERATIONS and len(args) > 1:
+        return "{0} key {1}".format(name, args[1])
+    if name in _VALUE_OPERATIONS and len(args) > 1:
+        return "{0} value {1}".format(name, args[1])
+    return name
+
+
+class RetryingRegistry:
+    """
+    winreg-compatible backend wrapper, which retries calls failed with TRANSIENT_ERRORS according to RetryPolicy.
+    The run deadline starts when the wrapper is created. Retries and calls which gave up on the deadline are counted
+    in run_metrics
+    """
+    def __init__(self, wrapped, policy=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param wrapped: registry backend
+        :param policy: RetryPolicy, default one if None
+        :param clock: monotonic clock function, seconds
+        :param sleep: sleep function, seconds
+        """
+        self.wrapped = wrapped
+        self.policy = RetryPolicy() if policy is None else policy
+        self._clock = clock
+        self._sleep = sleep
+        self.run_deadline = None if self.policy.run_timeout is None else clock() + self.policy.run_timeout
+        # Jitter is not drawn from entropy.get_source(): seeded runs must generate the same identities
+        self._jitter = random.Random()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if name not in RETRIED_OPERATIONS:
+            return attribute
+
+        def retried(*args, **kwargs):
+            return self._call(name, attribute, args, kwargs)
+        return retried
+
+    def _deadline(self, start_time):
+        deadline = self.run_deadline
+        if self.policy.operation_timeout is not None:
+            operation_deadline = start_time + self.policy.operation_timeout
+            deadline = operation_deadline if deadline is None else min(deadline, operation_deadline)
+        return deadline
+
+    def _call(self, name, function, args, kwargs):
+        start_time = self._clock()
+        deadline = self._deadline(start_time)
+        attempt = 1
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except OSError as e:
+                if getattr(e, "winerror", None) not in TRANSIENT_ERRORS:
+                    raise
+                if attempt >= self.policy.attempts:
+                    logger.warning("{0} failed {1} times in {2:.3f} s, LastError={3} [{4}]".format(
+                        _describe(name, args), attempt, self._clock() - start_time, e.winerror, e.strerror))
+                    raise
+                delay = self.policy.delay(attempt - 1, self._jitter.uniform(0.5, 1.0))
+                if deadline is not None and self._clock() + delay > deadline:
+                    logger.warning("{0} gave up on the deadline after {1} attempts in {2:.3f} s, "
+                                   "LastError={3} [{4}]".format(_describe(name, args), attempt,
+                                                                self._clock() - start_time, e.winerror, e.strerror))
+                    run_metrics.observe_retry(name, timed_out=True)
+                    raise
+                logger.debug("{0} failed with LastError={1}, retry in {2:.3f} s".format(
+                    _describe(name, args), e.winerror, delay))
+                run_metrics.observe_retry(name)
+                self._sleep(delay)
+                attempt += 1
+
+
+def retrying(backend, policy=None):
+    """
+    :param backend: registry backend
+    :param policy: RetryPolicy, default one if None
+    :return: RetryingRegistry of the backend, the backend itself if retries are disabled by the policy
+    """
+    if backend is None or (policy is not None and policy.attempts <= 1):
+        return backend
+    return RetryingRegistry(backend, policy)
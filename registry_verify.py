@@ -0,0 +1,166 @@
+import logging
+import collections
+import concurrent.futures
+import log_helper
+import registry_helper
+import registry_plan
+import registry_backend
+
+from registry_helper import Wow64RegistryEntry, HIVES_MAP, WOW64_MAP
+
+logger = log_helper.setup_logger(name="registry_verify", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Read-back verification of applied plans.
+Planned values are grouped by key, every key is opened once and all its planned values are queried on that handle.
+Type and raw bytes of every value are compared with the plan, a planned deletion passes if the value is absent.
+Keys are verified concurrently on a small thread pool
+"""
+
+# Maximum number of keys verified at once
+DEFAULT_WORKERS = 4
+
+STATUS_OK = "ok"
+STATUS_MISSING = "missing"
+STATUS_TYPE = "type"
+STATUS_DATA = "data"
+STATUS_ERROR = "error"
+# The value planned for deletion still exists
+STATUS_PRESENT = "present"
+
+
+class VerifyResult(collections.namedtuple("VerifyResult", ["operation", "status", "value_type", "key_value"])):
+    """
+    Verification outcome of the single planned value. value_type and key_value are the values read back,
+    None if the value could not be read
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+
+class VerifyReport(collections.namedtuple("VerifyReport", ["passed", "failed", "mismatches"])):
+    """
+    Number of verified and mismatched values, and VerifyResult list of the mismatches
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.failed == 0
+
+    def format(self):
+        """
+        :return: list of report lines, the summary line first and one line per mismatch
+        """
+        lines = ["Verified {0} values: {1} passed, {2} failed".format(self.passed + self.failed, self.passed,
+                                                                   self.failed)]
+        for result in self.mismatches:
+            view = Wow64RegistryEntry(result.operation.access_type).name
+            lines.append("  {0} [{1}] {2}".format(result.status.upper(), view, result.operation.describe()))
+        return lines
+
+
+def _compare(operation, value, value_type):
+    if operation.deletes:
+        return VerifyResult(operation, STATUS_PRESENT, value_type, value)
+    expected_type = registry_plan.winreg_type(operation.value_type)
+    if value_type != expected_type:
+        return VerifyResult(operation, STATUS_TYPE, value_type, value)
+    if registry_backend.encode_data(value_type, value) != registry_backend.encode_data(expected_type,
+                                                                                       operation.key_value):
+        return VerifyResult(operation, STATUS_DATA, value_type, value)
+    return VerifyResult(operation, STATUS_OK, value_type, value)
+
+
+def _absent(operation, error):
+    if error.winerror != registry_backend.ERROR_FILE_NOT_FOUND:
+        return VerifyResult(operation, STATUS_ERROR, None, None)
+    return VerifyResult(operation, STATUS_OK if operation.deletes else STATUS_MISSING, None, None)
+
+
+def verify_key(backend, operations):
+    """
+    Verify planned values of the single key on one handle
+    :param backend: registry backend
+    :param operations: list of RegistryOperation of the same key and registry view
+    :return: list of VerifyResult
+    """
+    first = operations[0]
+    try:
+        registry_key = backend.OpenKey(HIVES_MAP[first.key_hive], first.key_path, 0,
+                                       WOW64_MAP[first.access_type] | registry_backend.KEY_READ)
+    except OSError as e:
+        return [_absent(operation, e) for operation in operations]
+
+    results = []
+    try:
+        for operation in operations:
+            try:
+                value, value_type = backend.QueryValueEx(registry_key, operation.value_name)
+            except OSError as e:
+                results.append(_absent(operation, e))
+                continue
+            results.append(_compare(operation, value, value_type))
+    finally:
+        backend.CloseKey(registry_key)
+    return results
+
+
+def group_by_key(plan):
+    """
+    :param plan: iterable of RegistryOperation
+    :return: list of operation lists, one per key and registry view, in order of first appearance.
+    A value planned more than once is verified against its last planned data
+    """
+    groups = collections.OrderedDict()
+    for operation in registry_plan.expand_operations(plan):
+        key = (operation.key_hive.upper(), operation.key_path.upper(), int(operation.access_type))
+        groups.setdefault(key, collections.OrderedDict())[operation.value_name.upper()] = operation
+    return [list(values.values()) for values in groups.values()]
+
+
+def verify_plan(plan, workers=DEFAULT_WORKERS):
+    """
+    Read back all planned values and compare their type and data with the plan
+    :param plan: iterable of RegistryOperation
+    :param workers: maximum number of keys verified at once, 1 to verify sequentially
+    :return: VerifyReport
+    """
+    backend = registry_helper.get_backend()
+    groups = group_by_key(plan)
+    if workers <= 1 or len(groups) <= 1:
+        key_results = [verify_key(backend, group) for group in groups]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+            key_results = list(executor.map(lambda group: verify_key(backend, group), groups))
+    return build_report(key_results)
+
+
+def build_report(key_results):
+    """
+    :param key_results: iterable of verify_key() results
+    :return: VerifyReport
+    """
+    passed = failed = 0
+    mismatches = []
+    for results in key_results:
+        for result in results:
+            if result.ok:
+                passed += 1
+            else:
+                failed += 1
+                mismatches.append(result)
+    return VerifyReport(passed=passed, failed=failed, mismatches=mismatches)
+
+
+def log_report(report):
+    """
+    Log verification report, mismatches as errors
+    """
+    lines = report.format()
+    logger.info(lines[0])
+    for line in lines[1:]:
+        logger.error(line)
@@ -0,0 +1,383 @@
+import os
+import math
+import time
+import array
+import bisect
+import threading
+import contextlib
+import collections
+import registry_backend
+
+__doc__ = """Run metrics in the Prometheus text exposition format, for the node_exporter textfile collector.
+Collection is opt-in: counters, timers and the registry backend wrapper do nothing unless start_collecting() was
+called. At the end of the run write_textfile() replaces the .prom file atomically, so the collector never reads
+a partially written file. Collected metrics:
+antios_run_duration_seconds, antios_run_success, antios_run_timestamp_seconds - the whole run
+antios_section_duration_seconds{section} - every fingerprint section and verification
+antios_registry_operations_total{op}, antios_registry_operation_errors_total{op},
+antios_registry_operation_duration_seconds{op} histogram - winreg-level calls by function, e.g. SetValueEx
+antios_registry_operation_latency_quantile_seconds{op,quantile} - tail latency: median, 90th and 99th percentiles
+and maximum of the calls
+antios_registry_operation_retries_total{op}, antios_registry_operation_timeouts_total{op} - retries of transient
+errors and calls which gave up on the deadline, see registry_retry
+antios_values_written_total, antios_values_skipped_total, antios_values_failed_total - planned values
+antios_identity_tables_load_seconds - import of the identity tables
+"""
+
+METRIC_PREFIX = "antios_"
+
+# Upper bounds of registry operation latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Reported latency quantiles of registry operations, 1.0 is the maximum
+LATENCY_QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+# winreg-compatible backend functions which are timed and counted
+REGISTRY_OPERATIONS = ("OpenKey", "CreateKeyEx", "CloseKey", "QueryValueEx", "SetValueEx", "DeleteValue",
+                       "DeleteKeyEx", "EnumKey", "EnumValue", "QueryInfoKey")
+
+VALUES_WRITTEN = "values_written_total"
+VALUES_SKIPPED = "values_skipped_total"
+VALUES_FAILED = "values_failed_total"
+IDENTITY_TABLES_LOAD = "identity_tables_load_seconds"
+
+# Error codes of conditions which are expected during normal runs
+_EXPECTED_ERRORS = (registry_backend.ERROR_FILE_NOT_FOUND, registry_backend.ERROR_NO_MORE_ITEMS)
+
+_HELP = {
+    "run_duration_seconds": "Duration of the whole run",
+    "run_success": "1 if the run succeeded, 0 otherwise",
+    "run_timestamp_seconds": "Unix time of the end of the run",
+    "section_duration_seconds": "Duration of fingerprint sections",
+    "registry_operations_total": "Registry backend calls by function",
+    "registry_operation_errors_total": "Failed registry backend calls by function",
+    "registry_operation_duration_seconds": "Latency of registry backend calls by function",
+    "registry_operation_latency_quantile_seconds": "Latency quantiles of registry backend calls by function",
+    "registry_operation_retries_total": "Retries of registry backend calls failed with transient errors",
+    "registry_operation_timeouts_total": "Registry backend calls which gave up retrying on the deadline",
+    VALUES_WRITTEN: "Planned values written",
+    VALUES_SKIPPED: "Values left as they were: unchanged, absent or of unexpected type",
+    VALUES_FAILED: "Planned values which could not be written",
+    IDENTITY_TABLES_LOAD: "Time to import the identity tables",
+}
+
+
+class OperationStats:
+    """
+    Count, errors, retries, latency histogram and latencies of all calls of the single registry backend function.
+    A run makes thousands of calls at most, so latencies are kept to compute exact quantiles
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latencies = array.array("d")
+
+    def observe(self, seconds, failed):
+        self.count += 1
+        self.seconds += seconds
+        if failed:
+            self.errors += 1
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if index < len(self.buckets):
+            self.buckets[index] += 1
+        self.latencies.append(seconds)
+
+    def quantiles(self, quantiles=LATENCY_QUANTILES):
+        """
+        :param quantiles: iterable of quantiles in range [0, 1]
+        :return: list of nearest-rank latencies, seconds, empty if there were no calls
+        """
+        if not self.latencies:
+            return []
+        latencies = sorted(self.latencies)
+        return [latencies[max(int(math.ceil(quantile * len(latencies))) - 1, 0)] for quantile in quantiles]
+
+
+class RunMetrics:
+    """
+    Metrics of the single run, safe to update from many threads
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.values = collections.OrderedDict()
+        self.sections = collections.OrderedDict()
+        self.operations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def add_section_time(self, section, seconds):
+        with self._lock:
+            self.sections[section] = self.sections.get(section, 0.0) + seconds
+
+    def observe_operation(self, operation, seconds, failed):
+        with self._lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.observe(seconds, failed)
+
+    def observe_retry(self, operation, timed_out):
+        with self._lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            if timed_out:
+                stats.timeouts += 1
+            else:
+                stats.retries += 1
+
+    def timing(self):
+        """
+        :return: dictionary of run, section and registry operation durations, for JSON reports
+        """
+        with self._lock:
+            return {"run_seconds": time.time() - self.start_time,
+                    "sections": dict(self.sections),
+                    "registry_operations": dict((name, _operation_timing(stats))
+                                                for name, stats in self.operations.items())}
+
+
+def _quantile_name(quantile):
+    return "max" if quantile == 1.0 else "p{0:g}".format(quantile * 100)
+
+
+def _operation_timing(stats):
+    timing = {"count": stats.count, "errors": stats.errors, "retries": stats.retries, "timeouts": stats.timeouts,
+              "seconds": stats.seconds}
+    timing.update(zip([_quantile_name(quantile) for quantile in LATENCY_QUANTILES], stats.quantiles()))
+    return timing
+
+
+class InstrumentedRegistry:
+    """
+    winreg-compatible backend wrapper, which records count, errors and latency of every call.
+    Missing registry entries are expected during normal runs, so only errors other than ERROR_FILE_NOT_FOUND and
+    ERROR_NO_MORE_ITEMS are counted as failures
+    """
+    def __init__(self, wrapped, metrics):
+        """
+        :param wrapped: registry backend
+        :param metrics: RunMetrics object
+        """
+        self.wrapped = wrapped
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if name not in REGISTRY_OPERATIONS:
+            return attribute
+
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            failed = False
+            try:
+                return attribute(*args, **kwargs)
+            except OSError as e:
+                failed = getattr(e, "winerror", None) not in _EXPECTED_ERRORS
+                raise
+            finally:
+                self._metrics.observe_operation(name, time.perf_counter() - start_time, failed)
+        return timed
+
+
+_metrics = None
+
+
+def start_collecting():
+    """
+    :return: new RunMetrics object, collected until stop_collecting()
+    """
+    global _metrics
+    _metrics = RunMetrics()
+    return _metrics
+
+
+def stop_collecting():
+    """
+    :return: collected RunMetrics object, None if collection was not started
+    """
+    global _metrics
+    metrics = _metrics
+    _metrics = None
+    return metrics
+
+
+def add(name, amount=1):
+    """
+    Increase the counter if metrics are collected
+    """
+    if _metrics is not None and amount:
+        _metrics.add(name, amount)
+
+
+def set_value(name, value):
+    """
+    Set the gauge if metrics are collected
+    """
+    if _metrics is not None:
+        _metrics.set(name, value)
+
+
+@contextlib.contextmanager
+def section(name):
+    """
+    Time the code inside the context as the section if metrics are collected
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _metrics is not None:
+            _metrics.add_section_time(name, time.perf_counter() - start_time)
+
+
+def observe_retry(operation, timed_out=False):
+    """
+    Count the retry of the registry backend function, or the call which gave up on the deadline,
+    if metrics are collected
+    """
+    if _metrics is not None:
+        _metrics.observe_retry(operation, timed_out)
+
+
+def instrument(backend):
+    """
+    :return: InstrumentedRegistry of the backend if metrics are collected, the backend itself otherwise
+    """
+    if _metrics is None or backend is None:
+        return backend
+    return InstrumentedRegistry(backend, _metrics)
+
+
+#############################################################################
+# Exposition
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{0}=\"{1}\"".format(name, _escape(value)) for name, value in labels) + "}"
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _family(name, metric_type, samples):
+    """
+    :param samples: list of (suffix, labels, value) tuples, labels is a list of (name, value) tuples
+    :return: generator of exposition lines of the metric family
+    """
+    full_name = METRIC_PREFIX + name
+    yield "# HELP {0} {1}".format(full_name, _HELP.get(name, name))
+    yield "# TYPE {0} {1}".format(full_name, metric_type)
+    for suffix, labels, value in samples:
+        yield "{0}{1}{2} {3}".format(full_name, suffix, _labels(labels), _number(value))
+
+
+def iter_exposition(metrics, success, end_time=None):
+    """
+    :param metrics: RunMetrics object
+    :param success: True if the run succeeded
+    :param end_time: Unix time of the end of the run, current time if None
+    :return: generator of exposition format lines
+    """
+    end_time = time.time() if end_time is None else end_time
+    for line in _family("run_duration_seconds", "gauge", [("", [], end_time - metrics.start_time)]):
+        yield line
+    for line in _family("run_success", "gauge", [("", [], 1 if success else 0)]):
+        yield line
+    for line in _family("run_timestamp_seconds", "gauge", [("", [], end_time)]):
+        yield line
+    if metrics.sections:
+        for line in _family("section_duration_seconds", "gauge",
+                            [("", [("section", name)], seconds) for name, seconds in metrics.sections.items()]):
+            yield line
+
+    operations = sorted(metrics.operations.items())
+    if operations:
+        for line in _family("registry_operations_total", "counter",
+                            [("", [("op", name)], stats.count) for name, stats in operations]):
+            yield line
+        for line in _family("registry_operation_errors_total", "counter",
+                            [("", [("op", name)], stats.errors) for name, stats in operations]):
+            yield line
+        samples = []
+        for name, stats in operations:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                samples.append(("_bucket", [("op", name), ("le", _number(float(bound)))], cumulative))
+            samples.append(("_bucket", [("op", name), ("le", "+Inf")], stats.count))
+            samples.append(("_sum", [("op", name)], stats.seconds))
+            samples.append(("_count", [("op", name)], stats.count))
+        for line in _family("registry_operation_duration_seconds", "histogram", samples):
+            yield line
+        for line in _family("registry_operation_latency_quantile_seconds", "gauge",
+                            [("", [("op", name), ("quantile", _number(quantile))], seconds)
+                             for name, stats in operations
+                             for quantile, seconds in zip(LATENCY_QUANTILES, stats.quantiles())]):
+            yield line
+        for line in _family("registry_operation_retries_total", "counter",
+                            [("", [("op", name)], stats.retries) for name, stats in operations]):
+            yield line
+        for line in _family("registry_operation_timeouts_total", "counter",
+                            [("", [("op", name)], stats.timeouts) for name, stats in operations]):
+            yield line
+
+    for name in (VALUES_WRITTEN, VALUES_SKIPPED, VALUES_FAILED):
+        for line in _family(name, "counter", [("", [], metrics.values.get(name, 0))]):
+            yield line
+    if IDENTITY_TABLES_LOAD in metrics.values:
+        for line in _family(IDENTITY_TABLES_LOAD, "gauge", [("", [], metrics.values[IDENTITY_TABLES_LOAD])]):
+            yield line
+
+
+def format_report(metrics):
+    """
+    :param metrics: RunMetrics object
+    :return: list of report lines: tail latency, retries and timeouts of registry operations, slowest first
+    """
+    lines = ["Registry operations, slowest first:"] if metrics.operations else []
+    operations = sorted(metrics.operations.items(), key=lambda item: item[1].quantiles((1.0,)) or [0.0],
+                        reverse=True)
+    for name, stats in operations:
+        if not stats.count:
+            continue
+        latencies = " ".join("{0} {1:.3f} ms".format(_quantile_name(quantile), seconds * 1e3)
+                             for quantile, seconds in zip(LATENCY_QUANTILES, stats.quantiles()))
+        lines.append("  {0:<14} {1:6d} calls  {2}  {3} errors, {4} retries, {5} timeouts".format(
+            name, stats.count, latencies, stats.errors, stats.retries, stats.timeouts))
+    return lines
+
+
+def write_textfile(metrics, path, success):
+    """
+    Write metrics to the .prom file atomically: to the temporary file in the same directory first,
+    which is then renamed over the target
+    :param metrics: RunMetrics object
+    :param path: .prom file path
+    :param success: True if the run succeeded
+    """
+    temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp_path, "w", encoding="utf-8", newline="\n") as prom_file:
+        for line in iter_exposition(metrics, success):
+            prom_file.write(line)
+            prom_file.write("\n")
+        prom_file.flush()
+        os.fsync(prom_file.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import collections
+import log_helper
+
+logger = log_helper.setup_logger(name="run_profiler", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Profiling of the whole run without editing the scripts.
+The run is traced with cProfile and at the same time sampled by a background thread, which records the call stack
+of the profiled thread at a fixed interval. The cProfile data is saved as a pstats file (python -m pstats, snakeviz),
+the samples as collapsed stacks, one "frame;frame;frame count" line per distinct stack, which flamegraph.pl,
+speedscope and inferno read directly
+"""
+
+# Interval between two stack samples, seconds
+DEFAULT_SAMPLE_INTERVAL = 0.001
+
+# Suffix of the collapsed stacks file written next to the pstats file
+COLLAPSED_SUFFIX = ".collapsed"
+
+
+def frame_label(code):
+    """
+    :return: collapsed stack frame label, "file.py:function"
+    """
+    return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler:
+    """
+    Background thread counting call stacks of the single thread
+    """
+    def __init__(self, thread_id, interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        :param thread_id: identifier of the sampled thread, e.g. threading.get_ident()
+        :param interval: interval between two samples, seconds
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path):
+        """
+        Write collapsed stacks, most frequent first
+        :return: number of samples
+        """
+        with open(path, "w", encoding="utf-8") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write("{0} {1}\n".format(stack, count))
+        return sum(self.stacks.values())
+
+
+@contextlib.contextmanager
+def profile_to(path, interval=DEFAULT_SAMPLE_INTERVAL):
+    """
+    Profile the code inside the context of the current thread. On exit the pstats file is written to path and
+    collapsed stacks to path + COLLAPSED_SUFFIX
+    :param path: pstats file path
+    :param interval: stack sampling interval, seconds
+    """
+    sampler = StackSampler(threading.get_ident(), interval)
+    profiler = cProfile.Profile()
+    start_time = time.time()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(path)
+        samples = sampler.save(path + COLLAPSED_SUFFIX)
+        logger.info("Profile of {0:.3f} s run written to {1}, {2} stack samples to {3}".format(
+            time.time() - start_time, path, samples, path + COLLAPSED_SUFFIX))
+        for line in top_functions(path):
+            logger.debug(line)
+
+
+def top_functions(path, limit=10):
+    """
+    :param path: pstats file path
+    :param limit: number of functions
+    :return: list of lines describing functions with the largest cumulative time
+    """
+    stats = pstats.Stats(path).stats
+    functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return ["{0:10.6f} s {1:8d} calls  {2}:{3}({4})".format(timing[3], timing[1], os.path.basename(function[0]),
+                                                           function[1], function[2])
+            for function, timing in functions]
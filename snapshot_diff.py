@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import collections
+import log_helper
+import registry_plan
+
+logger = log_helper.setup_logger(name="snapshot_diff", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Comparison of snapshot files of many machines without loading them into memory.
+Two snapshots of the same machine are diffed by a streaming merge of both files, which are sorted by
+registry_plan.snapshot_sort_key() when saved. Accidental duplicates of identifiers across the pool, e.g. two VMs
+with the same MachineGuid, are found by streaming every snapshot once and keeping only a hash of every identifier
+value with the machines it was seen on. Lines which can not hold an identifier are skipped before JSON decoding.
+Snapshot files are named after their machines: vm01.jsonl is the snapshot of vm01
+"""
+
+CHANGE_ADDED = "added"
+CHANGE_REMOVED = "removed"
+CHANGE_CHANGED = "changed"
+
+# Size of identifier value hashes, bytes
+DIGEST_SIZE = 16
+
+
+class IdentityValue(collections.namedtuple("IdentityValue", ["identifier", "key_path", "value_name"])):
+    """
+    Registry value which has to be unique per machine. key_path is the case-insensitive key path suffix,
+    None to match the value name under any key
+    """
+    __slots__ = ()
+
+    def matches(self, key_path, value_name):
+        if value_name.upper() != self.value_name.upper():
+            return False
+        return self.key_path is None or key_path.upper().endswith(self.key_path.upper())
+
+
+IDENTITY_VALUES = (
+    IdentityValue("MachineGuid", "SOFTWARE\\Microsoft\\Cryptography", "MachineGuid"),
+    IdentityValue("SusClientId", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate", "SusClientId"),
+    IdentityValue("ProductId", "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion", "ProductId"),
+    # MAC address override of network adapters, Class\{4d36e972-e325-11ce-bfc1-08002be10318}\NNNN
+    IdentityValue("MAC", None, "NetworkAddress"),
+)
+
+
+class SnapshotChange(collections.namedtuple("SnapshotChange", ["kind", "old", "new"])):
+    """
+    Difference of two snapshots of the same machine: kind is CHANGE_ADDED, CHANGE_REMOVED or CHANGE_CHANGED,
+    old and new are SnapshotEntry objects, None on the side where the value is absent
+    """
+    __slots__ = ()
+
+    @property
+    def entry(self):
+        return self.new if self.new is not None else self.old
+
+    def to_dict(self):
+        return {"change": self.kind,
+                "old": registry_plan.entry_to_dict(self.old) if self.old is not None else None,
+                "new": registry_plan.entry_to_dict(self.new) if self.new is not None else None}
+
+
+class Duplicate(collections.namedtuple("Duplicate", ["identifier", "value", "machines"])):
+    """
+    Identifier value found on more than one machine, machines is the sorted list of machine names
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return {"identifier": self.identifier, "value": self.value, "machines": self.machines}
+
+
+def machine_name(path):
+    """
+    :return: machine name of the snapshot file, its file name without extension
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def snapshot_paths(paths):
+    """
+    :param paths: snapshot files and directories of snapshot files
+    :return: sorted list of snapshot file paths
+    """
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(os.path.join(path, name) for name in os.listdir(path)
+                          if os.path.isfile(os.path.join(path, name)))
+        else:
+            result.append(path)
+    return sorted(result)
+
+
+def _record_key(record):
+    # Same order as registry_plan.snapshot_sort_key(), computed from the decoded JSON record
+    return record["hive"].upper(), record["path"].upper(), record["name"].upper(), record["access"]
+
+
+def _iter_sorted_records(path):
+    """
+    Stream raw lines of the snapshot file with their sort keys
+    :return: generator of (sort key, line, JSON record) tuples
+    :raises ValueError: if the file is not sorted
+    """
+    previous = None
+    with open(path, encoding="utf-8") as snapshot_file:
+        for line in snapshot_file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            key = _record_key(record)
+            if previous is not None and key < previous:
+                raise ValueError("Snapshot {0} is not sorted, save it with registry_plan.save_snapshot()".format(path))
+            previous = key
+            yield key, line, record
+
+
+def iter_changes(old_path, new_path):
+    """
+    Diff two sorted snapshot files by a single streaming merge, memory use does not depend on their size
+    :param old_path: earlier snapshot file
+    :param new_path: later snapshot file
+    :return: generator of SnapshotChange in snapshot order
+    """
+    old_records = _iter_sorted_records(old_path)
+    new_records = _iter_sorted_records(new_path)
+    old = next(old_records, None)
+    new = next(new_records, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield SnapshotChange(CHANGE_REMOVED, registry_plan.entry_from_dict(old[2]), None)
+            old = next(old_records, None)
+        elif old is None or new[0] < old[0]:
+            yield SnapshotChange(CHANGE_ADDED, None, registry_plan.entry_from_dict(new[2]))
+            new = next(new_records, None)
+        else:
+            # Identical lines are equal entries, only differing ones are decoded and compared
+            if old[1] != new[1]:
+                old_entry = registry_plan.entry_from_dict(old[2])
+                new_entry = registry_plan.entry_from_dict(new[2])
+                if (old_entry.value_type, old_entry.key_value) != (new_entry.value_type, new_entry.key_value):
+                    if not old_entry.exists:
+                        yield SnapshotChange(CHANGE_ADDED, None, new_entry)
+                    elif not new_entry.exists:
+                        yield SnapshotChange(CHANGE_REMOVED, old_entry, None)
+                    else:
+                        yield SnapshotChange(CHANGE_CHANGED, old_entry, new_entry)
+            old = next(old_records, None)
+            new = next(new_records, None)
+
+
+def normalize_identifier(value):
+    """
+    Identifiers are compared case-insensitively, without GUID brackets and MAC address separators
+    :return: normalized string of the registry value data
+    """
+    if isinstance(value, bytes):
+        return value.hex().upper()
+    text = str(value).strip().strip("{}").upper()
+    compact = text.replace("-", "").replace(":", "")
+    if len(compact) == 12 and all(character in "0123456789ABCDEF" for character in compact):
+        return compact
+    return text
+
+
+class DuplicateIndex:
+    """
+    Hashes of identifier values of many machines. Every snapshot is streamed once; for every identifier value only
+    its hash, the value of the first machine and the names of machines are kept
+    """
+    def __init__(self, identity_values=IDENTITY_VALUES):
+        """
+        :param identity_values: iterable of IdentityValue
+        """
+        self.identity_values = tuple(identity_values)
+        self.machines = 0
+        self._values = {}
+        # Value names as they appear in JSON lines, lines without any of them are not decoded
+        self._markers = tuple(set(json.dumps(identity.value_name)[1:-1].upper()
+                                  for identity in self.identity_values))
+
+    def _identity(self, key_path, value_name):
+        for identity in self.identity_values:
+            if identity.matches(key_path, value_name):
+                return identity
+        return None
+
+    def add_snapshot(self, path, machine=None):
+        """
+        :param path: snapshot file
+        :param machine: machine name, snapshot file name by default
+        :return: number of identifier values found in the snapshot
+        """
+        machine = machine_name(path) if machine is None else machine
+        self.machines += 1
+        # The same value is stored in both registry views and e.g. in IE registration, so it is counted once
+        seen = set()
+        with open(path, encoding="utf-8") as snapshot_file:
+            for line in snapshot_file:
+                upper_line = line.upper()
+                if not any(marker in upper_line for marker in self._markers):
+                    continue
+                record = json.loads(line)
+                if record.get("type") is None:
+                    continue
+                identity = self._identity(record["path"], record["name"])
+                if identity is None:
+                    continue
+                value = normalize_identifier(registry_plan.decode_value(record["value"]))
+                digest = hashlib.blake2b("{0}\0{1}".format(identity.identifier, value).encode("utf-8"),
+                                         digest_size=DIGEST_SIZE).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                stored = self._values.get(digest)
+                if stored is None:
+                    self._values[digest] = (identity.identifier, value, [machine])
+                else:
+                    stored[2].append(machine)
+        return len(seen)
+
+    def duplicates(self):
+        """
+        :return: list of Duplicate, sorted by identifier and value
+        """
+        return sorted(Duplicate(identifier, value, sorted(machines))
+                      for identifier, value, machines in self._values.values() if len(machines) > 1)
+
+
+def find_duplicates(paths, identity_values=IDENTITY_VALUES):
+    """
+    :param paths: snapshot files of machines
+    :param identity_values: iterable of IdentityValue
+    :return: list of Duplicate
+    """
+    index = DuplicateIndex(identity_values)
+    for path in paths:
+        index.add_snapshot(path)
+    return index.duplicates()
+
+
+def main(argv=None):
+    """
+    Diff two snapshots or find duplicate identifiers among snapshots of many machines
+    :return: Exec return code
+    """
+    parser = argparse.ArgumentParser(description='Diff snapshots and find duplicate identifiers across machines')
+
+    parser.add_argument('snapshots',
+                        help='OLD NEW snapshot files to diff, or snapshot files and directories with --duplicates',
+                        nargs='+')
+
+    parser.add_argument('--duplicates',
+                        help='Report MachineGuid, SusClientId, ProductId and MAC address values found on '
+                             'more than one machine',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    parser.add_argument('--identity-only',
+                        help='Diff identifier values only',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    args = parser.parse_args(argv)
+
+    if args.duplicates:
+        paths = snapshot_paths(args.snapshots)
+        duplicates = find_duplicates(paths)
+        for duplicate in duplicates:
+            print(json.dumps(duplicate.to_dict(), sort_keys=True))
+        logger.info("{0} snapshots compared, {1} duplicate identifier values".format(len(paths), len(duplicates)))
+        return 1 if duplicates else 0
+
+    if len(args.snapshots) != 2:
+        parser.error("Diff needs exactly two snapshot files")
+    changes = 0
+    for change in iter_changes(*args.snapshots):
+        entry = change.entry
+        if args.identity_only and not any(identity.matches(entry.key_path, entry.value_name)
+                                          for identity in IDENTITY_VALUES):
+            continue
+        print(json.dumps(change.to_dict(), sort_keys=True))
+        changes += 1
+    logger.info("{0} values differ between {1} and {2}".format(changes, *args.snapshots))
+    return 1 if changes else 0
+
+
+###########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,9 @@
-import os
+import sys
 import logging
 import log_helper
-import random
-import uuid
 import string
+import entropy
+import collections
 import random_utils
 
 logger = log_helper.setup_logger(name="system_fingerpring", level=logging.INFO, log_to_file=False)
@@ -63,14 +63,15 @@ class WinFingerprint:
                           "KB3160005", "KB3154070", "KB3148198"]
 
     def __init__(self):
-        self.windows_version = random.choice([7, 8, 10])
-        self.oem_version = random.randint(0, 1)
+        source = entropy.get_source()
+        self.windows_version = source.choice([7, 8, 10])
+        self.oem_version = source.randint(0, 1)
         self.product_name = WinFingerprint.BUILDS[self.windows_version][WinFingerprint.PRODUCT_NAME]
         self.current_version = WinFingerprint.BUILDS[self.windows_version][WinFingerprint.CURRENT_VERSION]
         self.current_build = WinFingerprint.BUILDS[self.windows_version][WinFingerprint.CURRENT_BUILD]
         self.build_lab = WinFingerprint.BUILDS[self.windows_version][WinFingerprint.BUILD_LAB]
         self.build_lab_ex = WinFingerprint.BUILDS[self.windows_version][WinFingerprint.BUILD_LAB_EX]
-        random_edition = random.choice(WinFingerprint.EDITIONS[self.windows_version])
+        random_edition = source.choice(WinFingerprint.EDITIONS[self.windows_version])
         self.edition_id = random_edition[WinFingerprint.EDITION_ID]
         if self.edition_id == "OEM":
             self.oem_version = 1
@@ -81,10 +82,10 @@ class WinFingerprint:
         self.pid3 = random_utils.random_digit_string(7)
         self.pid4 = random_utils.random_digit_string(5)
         self.retail_oem = "OEM" if self.oem_version else "Retail"
-        self.build_guid = str(uuid.uuid4()) if self.windows_version == 7 else "ffffffff-ffff-ffff-ffff-ffffffffffff"
-        self.uuid_id4 = str(uuid.uuid4())
-        self.ie_service_update = random.choice(WinFingerprint.IE_SERVICE_UPDATES)
-        self.ie_install_date = bytearray(os.urandom(8))
+        self.build_guid = source.guid() if self.windows_version == 7 else "ffffffff-ffff-ffff-ffff-ffffffffffff"
+        self.uuid_id4 = source.guid()
+        self.ie_service_update = source.choice(WinFingerprint.IE_SERVICE_UPDATES)
+        self.ie_install_date = bytearray(source.read(8))
         self.digital_product_id = []
         self.digital_product_id4 = []
         self.product_id = self.__random_product_id()
@@ -181,7 +182,7 @@ class WinFingerprint:
         return "{0}-{1}-{2}-{3}".format(self.pid1, self.pid2, self.pid3, self.pid4)
 
     def __random_digital_product_id(self):
-        random_digital_id = random.sample(range(0, 255), k=164)
+        random_digital_id = entropy.get_source().sample(range(0, 255), k=164)
         random_digital_id[0x00:0x07] = [0xA4, 0, 0, 0, 0x3, 0, 0, 0]
         random_digital_id[0x08:0x19] = list(self.product_id)
         random_digital_id[0xA0:0xA3] = [0xB9, 0xEC, 0x21, 0x73]
@@ -200,8 +201,8 @@ class WinFingerprint:
             random_utils.random_digit_string(4)
         )
         dispersed_list = random_utils.disperse_string(normal_string)
-        dispersed_list[70] = random.randint(0, 0xFF)
-        dispersed_list[-2] = ['5', '6', '7', '8'][random.randint(0, 3)]
+        dispersed_list[70] = entropy.get_source().randint(0, 0xFF)
+        dispersed_list[-2] = entropy.get_source().choice(['5', '6', '7', '8'])
         return dispersed_list
 
     def __random_digital_product_id4(self):
@@ -218,11 +219,11 @@ class WinFingerprint:
         product_edition = random_utils.disperse_string(self.edition_id)
         random_digital_id4[0x0118:0x0118 + len(product_edition) + 1] = product_edition
         # 0x0328 - random length 80
-        random_block = random.sample(range(0, 0xFF), 80)
+        random_block = entropy.get_source().sample(range(0, 0xFF), 80)
         random_digital_id4[0x0328:0x0328 + len(random_block) + 1] = random_block
         # 0x0378 - XNN-NNNNN
         random_id2_string = "{0}{1}-{2}".format(
-            ''.join(random.sample(string.ascii_uppercase, 1)),
+            entropy.get_source().choice(string.ascii_uppercase),
             random_utils.random_digit_string(2),
             random_utils.random_digit_string(5)
         )
@@ -234,3 +235,43 @@ class WinFingerprint:
         random_digital_id4[0x03F8:0x03F8 + len(retail_oem) + 1] = retail_oem
         random_digital_id4[0x0478:0x0478 + len(retail_oem) + 1] = retail_oem
         return random_digital_id4
+
+
+class WindowsProfile(collections.namedtuple("WindowsProfile", [
+        "windows_version", "build_guid", "build_lab", "build_lab_ex", "current_build", "current_version",
+        "edition_id", "install_date", "product_id", "product_name", "ie_service_update", "ie_install_date",
+        "digital_product_id", "digital_product_id4"])):
+    """
+    Immutable Windows identifiers of the single generated profile.
+    Binary values are bytes, ready to be written as REG_BINARY, strings are interned, so many profiles
+    kept in memory share their edition, build and version strings
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_fingerprint(cls, system_fp):
+        """
+        :param system_fp: WinFingerprint object
+        :return: WindowsProfile object
+        """
+        return cls(windows_version=system_fp.windows_version,
+                   build_guid=sys.intern(system_fp.random_build_guid()),
+                   build_lab=sys.intern(system_fp.random_build_lab()),
+                   build_lab_ex=sys.intern(system_fp.random_build_lab_ex()),
+                   current_build=sys.intern(system_fp.random_current_build()),
+                   current_version=sys.intern(system_fp.random_current_version()),
+                   edition_id=sys.intern(system_fp.random_edition_id()),
+                   install_date=system_fp.random_install_date(),
+                   product_id=sys.intern(system_fp.random_product_id()),
+                   product_name=sys.intern(system_fp.random_product_name()),
+                   ie_service_update=sys.intern(system_fp.random_ie_service_update()),
+                   ie_install_date=bytes(system_fp.random_ie_install_date()),
+                   digital_product_id=random_utils.bytes_list_to_array(system_fp.random_digital_product_id()),
+                   digital_product_id4=random_utils.bytes_list_to_array(system_fp.random_digital_product_id4()))
+
+    @classmethod
+    def generate(cls):
+        """
+        :return: new random WindowsProfile object
+        """
+        return cls.from_fingerprint(WinFingerprint())
@@ -1,18 +1,204 @@
+import os
+import re
+import sys
+import json
+import time
 import platform
+import threading
+import contextlib
+import collections
 
 
-__doc__ = """Module contains general system-related functions"""
+__doc__ = """Module contains general system-related functions.
+Platform probing is done once per process and memoized in a SystemInfo record, optionally persisted to a small
+on-disk cache which stays valid until the next reboot. The record can be replaced with set_system_info(),
+e.g. to pretend to be Windows 10 x64 on a non-Windows host
+"""
+
+
+def user_cache_dir():
+    """
+    :return: per-user cache directory, %LOCALAPPDATA% on Windows, $XDG_CACHE_HOME or ~/.cache elsewhere
+    """
+    if sys.platform == "win32":
+        return os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    return os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+
+# Default location of the on-disk system info cache, per user so other users can not plant or read it
+SYSTEM_INFO_CACHE = os.path.join(user_cache_dir(), "antios_system_info.json")
+
+# Boot time is derived from the uptime counter, so it may drift slightly between probes
+BOOT_TIME_TOLERANCE = 5
+
+
+class SystemInfo(collections.namedtuple("SystemInfo", ["architecture", "os_major", "os_build", "platform"])):
+    """
+    Probed system properties
+    architecture - machine type, e.g. "AMD64", "x86", "x86_64"
+    os_major - OS major version number, e.g. 7, 8, 10; 0 if unknown
+    os_build - OS build number, e.g. 16299; 0 if unknown
+    platform - full platform string as returned by platform.platform(), e.g. "Windows-10-10.0.16299-SP0"
+    """
+    __slots__ = ()
+
+    @property
+    def is_x64(self):
+        """
+        :return: True if system is 64-bit, False otherwise
+        """
+        return self.architecture.endswith('64')
+
+    @classmethod
+    def windows(cls, os_major=10, os_build=16299, architecture="AMD64"):
+        """
+        Build a Windows system description without probing, e.g. to pretend to be Windows 10 x64
+        :param os_major: Windows major version, 7, 8 or 10
+        :param os_build: Windows build number
+        :param architecture: machine type
+        :return: SystemInfo object
+        """
+        release = {7: "6.1", 8: "6.2"}.get(os_major, "{0}.0".format(os_major))
+        return cls(architecture=architecture,
+                   os_major=os_major,
+                   os_build=os_build,
+                   platform="Windows-{0}-{1}.{2}-SP0".format(os_major, release, os_build))
+
+
+_system_info = None
+
+# Per-thread overrides of use_system_info()
+_thread_system_info = threading.local()
+
+
+def _leading_int(value):
+    match = re.match(r"\d+", value or "")
+    return int(match.group(0)) if match else 0
+
+
+def _probe_system_info():
+    """
+    Query the platform module, which may be slow on Windows
+    :return: SystemInfo object
+    """
+    version = platform.version()
+    build = version.split(".")[-1] if version.count(".") >= 2 else ""
+    return SystemInfo(architecture=platform.machine(),
+                      os_major=_leading_int(platform.release()),
+                      os_build=_leading_int(build),
+                      platform=platform.platform())
+
+
+def boot_time():
+    """
+    :return: System boot time as Unix time, None if unable to determine
+    """
+    try:
+        if sys.platform == "win32":
+            import ctypes
+            ctypes.windll.kernel32.GetTickCount64.restype = ctypes.c_ulonglong
+            return int(time.time() - ctypes.windll.kernel32.GetTickCount64() / 1000.0)
+        with open("/proc/stat") as stat_file:
+            for line in stat_file:
+                if line.startswith("btime"):
+                    return int(line.split()[1])
+    except (OSError, AttributeError, ValueError):
+        pass
+    return None
+
+
+def _owned_by_current_user(file_object):
+    """
+    :return: True if the open file belongs to the current user or ownership can not be told, e.g. on Windows
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    return os.fstat(file_object.fileno()).st_uid == os.getuid()
+
+
+def load_system_info(cache_path=SYSTEM_INFO_CACHE):
+    """
+    Load system info from the on-disk cache if it was written by the current user during the current boot,
+    probe and rewrite it otherwise. The result is memoized for the rest of the process
+    :param cache_path: cache file path, None to skip the on-disk cache
+    :return: SystemInfo object
+    """
+    global _system_info
+    if _system_info is not None:
+        return _system_info
+
+    current_boot = boot_time() if cache_path else None
+    if current_boot is not None:
+        try:
+            with open(cache_path) as cache_file:
+                if not _owned_by_current_user(cache_file):
+                    raise ValueError("Cache file {0} belongs to another user".format(cache_path))
+                cached = json.load(cache_file)
+            if abs(cached["boot_time"] - current_boot) <= BOOT_TIME_TOLERANCE:
+                _system_info = SystemInfo(**cached["system_info"])
+                return _system_info
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    _system_info = _probe_system_info()
+    if current_boot is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            with open(cache_path, "w") as cache_file:
+                json.dump({"boot_time": current_boot, "system_info": _system_info._asdict()}, cache_file)
+        except OSError:
+            pass
+    return _system_info
+
+
+def get_system_info():
+    """
+    :return: SystemInfo object of use_system_info() if the current thread is inside it,
+    memoized SystemInfo object otherwise, probed on first use
+    """
+    system_info = getattr(_thread_system_info, "system_info", None)
+    if system_info is not None:
+        return system_info
+    if _system_info is None:
+        return load_system_info(cache_path=None)
+    return _system_info
+
+
+def set_system_info(system_info):
+    """
+    Replace memoized system info, e.g. with SystemInfo.windows(10) to pretend to be Windows 10 x64
+    :param system_info: SystemInfo object, None to probe again on next use
+    :return: previous SystemInfo object
+    """
+    global _system_info
+    previous = _system_info
+    _system_info = system_info
+    return previous
+
+
+@contextlib.contextmanager
+def use_system_info(system_info):
+    """
+    Use the system description in the current thread only, e.g. for the offline image handled by a worker thread
+    :param system_info: SystemInfo object, None to keep the process-wide one
+    """
+    previous = getattr(_thread_system_info, "system_info", None)
+    _thread_system_info.system_info = system_info
+    try:
+        yield system_info
+    finally:
+        _thread_system_info.system_info = previous
 
 
 def is_x64os():
     """
     :return: True if system is 64-bit, False otherwise
     """
-    return platform.machine().endswith('64')
+    return get_system_info().is_x64
 
 
 def platform_version():
     """
-    :return: True if hardware platform is 64-bit, False otherwise
+    :return: Platform string, like "Windows-10-10.0.16299-SP0"
     """
-    return platform.platform()
+    return get_system_info().platform
@@ -1,4 +1,6 @@
-import uuid
+import sys
+import entropy
+import collections
 
 
 class TelemetryFingerprint:
@@ -6,10 +8,31 @@ class TelemetryFingerprint:
     Windows 10 telemetry IDs
     """
     def __init__(self):
-        self.device_id_guid = str(uuid.uuid4()).upper()
+        self.device_id_guid = entropy.get_source().guid().upper()
 
     def random_device_id_guid(self):
         """
         :return: Telemetry Device ID GUID
         """
         return self.device_id_guid
+
+
+class TelemetryProfile(collections.namedtuple("TelemetryProfile", ["device_id_guid"])):
+    """
+    Immutable telemetry IDs of the single generated profile
+    """
+    __slots__ = ()
+
+    @property
+    def device_id_brackets(self):
+        """
+        :return: Device ID GUID in curly brackets, as SQMClient MachineId stores it
+        """
+        return "{%s}" % self.device_id_guid
+
+    @classmethod
+    def generate(cls):
+        """
+        :return: new random TelemetryProfile object
+        """
+        return cls(device_id_guid=sys.intern(TelemetryFingerprint().random_device_id_guid()))
@@ -0,0 +1,20 @@
+import unittest
+import identity_store
+
+
+class SampleUniqueTest(unittest.TestCase):
+    def test_hostnames_suffixed_beyond_table(self):
+        population = len(identity_store.get_table(identity_store.HOSTNAMES))
+        values = identity_store.sample_unique(identity_store.HOSTNAMES, population * 2 + 1)
+        self.assertEqual(len(set(value.lower() for value in values)), population * 2 + 1)
+
+    def test_mac_addresses_never_suffixed(self):
+        population = len(identity_store.get_table(identity_store.MAC_ADDRESSES))
+        values = identity_store.sample_unique(identity_store.MAC_ADDRESSES, 100)
+        self.assertTrue(all(len(value) == 6 and int(value, 16) >= 0 for value in values))
+        with self.assertRaises(ValueError):
+            identity_store.sample_unique(identity_store.MAC_ADDRESSES, population + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
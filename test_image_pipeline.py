@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+import regf_hive
+import registry_plan
+import registry_journal
+import registry_backend
+import volume_serial
+import image_pipeline
+
+from registry_plan import RegistryOperation
+from test_volume_serial import ntfs_boot_sector
+
+HKLM = registry_backend.HKEY_LOCAL_MACHINE
+CRYPTOGRAPHY = "SOFTWARE\\Microsoft\\Cryptography"
+
+
+def create_image_hives(hive_dir):
+    regf_hive.create_hive(os.path.join(hive_dir, "SYSTEM"), "SYSTEM")
+    regf_hive.create_hive(os.path.join(hive_dir, "SOFTWARE"), "SOFTWARE")
+    with regf_hive.OfflineRegistry.open_directory(hive_dir) as registry:
+        key = registry.CreateKeyEx(HKLM, "SYSTEM\\Select")
+        registry.SetValueEx(key, "Current", 0, registry_backend.REG_DWORD, 1)
+        key = registry.CreateKeyEx(HKLM, "SYSTEM\\CurrentControlSet\\Control\\Session Manager\\Environment")
+        registry.SetValueEx(key, "PROCESSOR_ARCHITECTURE", 0, registry_backend.REG_SZ, "AMD64")
+        key = registry.CreateKeyEx(HKLM, "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion")
+        registry.SetValueEx(key, "CurrentMajorVersionNumber", 0, registry_backend.REG_DWORD, 10)
+        registry.SetValueEx(key, "CurrentBuild", 0, registry_backend.REG_SZ, "19045")
+        key = registry.CreateKeyEx(HKLM, CRYPTOGRAPHY)
+        registry.SetValueEx(key, "MachineGuid", 0, registry_backend.REG_SZ, "original")
+
+
+def read_file(path):
+    with open(path, "rb") as data_file:
+        return data_file.read()
+
+
+class ProcessImageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="antios-pipeline-")
+        self.hive_dir = os.path.join(self.directory, "config")
+        os.makedirs(self.hive_dir)
+        create_image_hives(self.hive_dir)
+        self.volume_image = os.path.join(self.directory, "system.img")
+        with open(self.volume_image, "wb") as image_file:
+            image_file.write(ntfs_boot_sector(2047))
+            image_file.truncate(2048 * 512)
+        self.journal_dir = os.path.join(self.directory, "journal")
+        self.options = image_pipeline.PipelineOptions(telemetry=False, network=False, system=False, hardware=True,
+                                                      plan_dir=self.directory, journal_dir=self.journal_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def process(self, plan):
+        plan_path = os.path.join(self.directory, "vm01.plan")
+        registry_plan.save_plan(plan, plan_path)
+        task = image_pipeline.ImageTask("vm01", self.hive_dir, plan_path, self.volume_image)
+        return image_pipeline.process_image(task, self.options)
+
+    def journal_events(self):
+        journal_path, = [os.path.join(self.journal_dir, "vm01", name)
+                         for name in os.listdir(os.path.join(self.journal_dir, "vm01"))]
+        return registry_journal.load_journal(journal_path)
+
+    def hive_files(self):
+        return dict((name, read_file(os.path.join(self.hive_dir, name))) for name in os.listdir(self.hive_dir))
+
+    def test_partial_failure_keeps_image(self):
+        hives = self.hive_files()
+        volume = read_file(self.volume_image)
+        # The second write fails, registry_helper.write_value() does not create missing keys
+        result = self.process([
+            RegistryOperation("HKEY_LOCAL_MACHINE", CRYPTOGRAPHY, "MachineGuid", registry_backend.REG_SZ, "changed"),
+            RegistryOperation("HKEY_LOCAL_MACHINE", "SOFTWARE\\Missing", "Value", registry_backend.REG_SZ, "x"),
+        ])
+        self.assertEqual((result.written, result.failed), (1, 1))
+        self.assertIsNotNone(result.error)
+        self.assertFalse(result.ok)
+        self.assertFalse(result.needs_restore)
+        self.assertEqual(self.hive_files(), hives)
+        self.assertEqual(read_file(self.volume_image), volume)
+        self.assertTrue(self.journal_events().complete)
+
+    def test_success_swaps_hives(self):
+        result = self.process([
+            RegistryOperation("HKEY_LOCAL_MACHINE", CRYPTOGRAPHY, "MachineGuid", registry_backend.REG_SZ, "changed"),
+        ])
+        self.assertTrue(result.ok)
+        self.assertEqual(sorted(self.hive_files()), ["SOFTWARE", "SYSTEM"])
+        with regf_hive.OfflineRegistry.open_directory(self.hive_dir, writable=False) as registry:
+            key = registry.OpenKey(HKLM, CRYPTOGRAPHY)
+            self.assertEqual(registry.QueryValueEx(key, "MachineGuid")[0], "changed")
+        self.assertNotEqual(volume_serial.read_volume_serial(self.volume_image), "0000-0000")
+        self.assertTrue(self.journal_events().complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+import reg_file
+import system_utils
+import registry_helper
+import registry_journal
+import registry_verify
+import registry_backend
+
+HKLM = registry_backend.HKEY_LOCAL_MACHINE
+
+
+class ImportRegFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="antios-reg-")
+        self.registry = registry_backend.MemoryRegistry()
+        key = self.registry.CreateKeyEx(HKLM, "SOFTWARE\\Test")
+        self.registry.SetValueEx(key, "Old", 0, registry_backend.REG_SZ, "old")
+        self.previous_backend = registry_helper.set_backend(self.registry)
+        self.previous_info = system_utils.set_system_info(system_utils.SystemInfo.windows(10))
+
+    def tearDown(self):
+        system_utils.set_system_info(self.previous_info)
+        registry_helper.set_backend(self.previous_backend)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def import_lines(self, lines, journal=None):
+        path = os.path.join(self.directory, "import.reg")
+        with open(path, "w", encoding="utf-16") as reg_file_object:
+            reg_file_object.write("\n".join([reg_file.HEADER_V5, ""] + lines) + "\n")
+        return path, reg_file.apply_reg_file(path, journal, chunk_size=2)
+
+    def read(self, key_path, value_name):
+        return registry_helper.read_value("HKEY_LOCAL_MACHINE", key_path, value_name, missing_ok=True)
+
+    def test_file_order_and_missing_keys(self):
+        journal = registry_journal.WriteAheadJournal.create(self.directory)
+        path, result = self.import_lines([
+            "[HKEY_LOCAL_MACHINE\\SOFTWARE\\Test]",
+            "\"Old\"=-",
+            "\"Value\"=\"first\"",
+            "\"Value\"=-",
+            "\"Value\"=\"second\"",
+            "[HKEY_LOCAL_MACHINE\\SOFTWARE\\New\\Key]",
+            "\"Created\"=dword:00000001",
+        ], journal)
+        journal.close(None)
+        self.assertEqual((result.written, result.failed), (5, 0))
+        self.assertIsNone(self.read("SOFTWARE\\Test", "Old"))
+        self.assertEqual(self.read("SOFTWARE\\Test", "Value"), ("second", registry_backend.REG_SZ))
+        self.assertEqual(self.read("SOFTWARE\\New\\Key", "Created"), (1, registry_backend.REG_DWORD))
+        self.assertTrue(registry_verify.verify_plan(reg_file.iter_reg_operations(path), workers=1).ok)
+
+        registry_journal.recover(journal.path, registry_journal.RECOVER_BACK)
+        self.assertEqual(self.read("SOFTWARE\\Test", "Old"), ("old", registry_backend.REG_SZ))
+        self.assertIsNone(self.read("SOFTWARE\\Test", "Value"))
+        self.assertIsNone(self.read("SOFTWARE\\New\\Key", "Created"))
+
+
+if __name__ == '__main__':
+    unittest.main()
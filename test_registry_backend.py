@@ -0,0 +1,38 @@
+import unittest
+import registry_backend
+
+HKLM = registry_backend.HKEY_LOCAL_MACHINE
+
+
+def enum_all(enum, key):
+    items = []
+    while True:
+        try:
+            items.append(enum(key, len(items)))
+        except OSError:
+            return items
+
+
+class MemoryRegistryEnumTest(unittest.TestCase):
+    def test_enumeration_follows_writes(self):
+        registry = registry_backend.MemoryRegistry()
+        key = registry.CreateKeyEx(HKLM, "SOFTWARE\\Test")
+        registry.SetValueEx(key, "First", 0, registry_backend.REG_SZ, "1")
+        registry.CreateKeyEx(key, "A")
+        self.assertEqual(enum_all(registry.EnumKey, key), ["A"])
+        self.assertEqual(enum_all(registry.EnumValue, key), [("First", "1", registry_backend.REG_SZ)])
+
+        registry.SetValueEx(key, "First", 0, registry_backend.REG_SZ, "2")
+        registry.SetValueEx(key, "Second", 0, registry_backend.REG_DWORD, 2)
+        registry.CreateKeyEx(key, "B")
+        registry.DeleteKeyEx(key, "A")
+        self.assertEqual(enum_all(registry.EnumKey, key), ["B"])
+        self.assertEqual(enum_all(registry.EnumValue, key), [("First", "2", registry_backend.REG_SZ),
+                                                              ("Second", 2, registry_backend.REG_DWORD)])
+
+        registry.DeleteValue(key, "First")
+        self.assertEqual(enum_all(registry.EnumValue, key), [("Second", 2, registry_backend.REG_DWORD)])
+
+
+if __name__ == '__main__':
+    unittest.main()
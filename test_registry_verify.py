@@ -0,0 +1,47 @@
+import unittest
+import system_utils
+import registry_helper
+import registry_verify
+import registry_backend
+
+from registry_plan import RegistryOperation
+
+HKLM = registry_backend.HKEY_LOCAL_MACHINE
+KEY_PATH = "SOFTWARE\\Test"
+
+
+def deletion(value_name, key_path=KEY_PATH):
+    return RegistryOperation("HKEY_LOCAL_MACHINE", key_path, value_name, None, None)
+
+
+class VerifyDeletionTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = registry_backend.MemoryRegistry()
+        key = self.registry.CreateKeyEx(HKLM, KEY_PATH)
+        self.registry.SetValueEx(key, "Kept", 0, registry_backend.REG_SZ, "value")
+        self.previous_backend = registry_helper.set_backend(self.registry)
+        self.previous_info = system_utils.set_system_info(system_utils.SystemInfo.windows(10))
+
+    def tearDown(self):
+        system_utils.set_system_info(self.previous_info)
+        registry_helper.set_backend(self.previous_backend)
+
+    def test_absent_value_passes(self):
+        report = registry_verify.verify_plan([deletion("Deleted"), deletion("Value", "SOFTWARE\\Missing")], workers=1)
+        self.assertEqual((report.passed, report.failed), (2, 0))
+
+    def test_present_value_fails(self):
+        report = registry_verify.verify_plan([deletion("Kept")], workers=1)
+        self.assertEqual((report.passed, report.failed), (0, 1))
+        self.assertEqual(report.mismatches[0].status, registry_verify.STATUS_PRESENT)
+
+    def test_written_value_still_verified(self):
+        report = registry_verify.verify_plan([
+            RegistryOperation("HKEY_LOCAL_MACHINE", KEY_PATH, "Kept", registry_backend.REG_SZ, "value"),
+            RegistryOperation("HKEY_LOCAL_MACHINE", KEY_PATH, "Absent", registry_backend.REG_SZ, "value"),
+        ], workers=1)
+        self.assertEqual([result.status for result in report.mismatches], [registry_verify.STATUS_MISSING])
+
+
+if __name__ == '__main__':
+    unittest.main()
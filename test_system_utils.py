@@ -0,0 +1,50 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import system_utils
+
+
+class SystemInfoTest(unittest.TestCase):
+    def test_windows_releases(self):
+        self.assertEqual(system_utils.SystemInfo.windows(7, 7601).platform, "Windows-7-6.1.7601-SP0")
+        self.assertEqual(system_utils.SystemInfo.windows(8, 9200).platform, "Windows-8-6.2.9200-SP0")
+        self.assertEqual(system_utils.SystemInfo.windows(10).platform, "Windows-10-10.0.16299-SP0")
+
+
+@unittest.skipIf(system_utils.boot_time() is None, "boot time is not available")
+class SystemInfoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="antios-cache-")
+        self.cache_path = os.path.join(self.directory, "cache", "system_info.json")
+        self.previous_info = system_utils.set_system_info(None)
+
+    def tearDown(self):
+        system_utils.set_system_info(self.previous_info)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def plant(self, system_info):
+        with open(self.cache_path, "w") as cache_file:
+            json.dump({"boot_time": system_utils.boot_time(), "system_info": system_info._asdict()}, cache_file)
+
+    def test_cache_written_and_read(self):
+        probed = system_utils.load_system_info(self.cache_path)
+        self.assertTrue(os.path.isfile(self.cache_path))
+        planted = system_utils.SystemInfo.windows(7, 7601)
+        self.plant(planted)
+        system_utils.set_system_info(None)
+        self.assertEqual(system_utils.load_system_info(self.cache_path), planted)
+        self.assertNotEqual(probed, planted)
+
+    @unittest.skipUnless(hasattr(os, "getuid") and os.getuid() == 0, "changing file owner requires root")
+    def test_foreign_cache_ignored(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        planted = system_utils.SystemInfo.windows(7, 7601)
+        self.plant(planted)
+        os.chown(self.cache_path, 12345, 12345)
+        self.assertNotEqual(system_utils.load_system_info(self.cache_path), planted)
+
+
+if __name__ == '__main__':
+    unittest.main()
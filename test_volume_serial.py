@@ -0,0 +1,147 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import volume_serial
+
+MIB = 1024 * 1024
+
+
+def ntfs_boot_sector(total_sectors, sector_size=512):
+    sector = bytearray(512)
+    sector[3:11] = b"NTFS    "
+    struct.pack_into("<H", sector, 0x0B, sector_size)
+    struct.pack_into("<Q", sector, 0x28, total_sectors)
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def fat32_boot_sector(total_sectors, backup_sector=6, sector_size=512):
+    sector = bytearray(512)
+    struct.pack_into("<H", sector, 0x0B, sector_size)
+    struct.pack_into("<I", sector, 0x20, total_sectors)
+    struct.pack_into("<H", sector, 0x32, backup_sector)
+    sector[0x42] = 0x29
+    sector[0x52:0x5A] = b"FAT32   "
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def mbr_sector(entries):
+    """
+    :param entries: list of (partition type, start LBA, number of sectors) tuples
+    """
+    sector = bytearray(512)
+    for index, (partition_type, start, sectors) in enumerate(entries):
+        struct.pack_into("<4xB3xII", sector, 446 + index * 16, partition_type, start, sectors)
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+class ImageBuilder:
+    def __init__(self, path, size):
+        self.path = path
+        with open(path, "wb") as image_file:
+            image_file.truncate(size)
+
+    def write(self, offset, data):
+        with open(self.path, "r+b") as image_file:
+            image_file.seek(offset)
+            image_file.write(data)
+
+    def volume(self, offset, boot_sector):
+        self.write(offset, boot_sector)
+
+    def gpt(self, partitions, sector_size=512):
+        """
+        :param partitions: list of (first LBA, last LBA) tuples
+        """
+        self.write(0, mbr_sector([(0xEE, 1, 0xFFFFFFFF)]))
+        header = bytearray(92)
+        header[:8] = b"EFI PART"
+        struct.pack_into("<QII", header, 0x48, 2, 128, 128)
+        self.write(sector_size, bytes(header))
+        table = bytearray(128 * 128)
+        for index, (first_lba, last_lba) in enumerate(partitions):
+            table[index * 128:index * 128 + 16] = os.urandom(16)
+            struct.pack_into("<QQ", table, index * 128 + 0x20, first_lba, last_lba)
+        self.write(2 * sector_size, bytes(table))
+
+
+class VolumeSerialTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="antios-volume-")
+        self.path = os.path.join(self.directory, "disk.img")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def serials(self):
+        with open(self.path, "rb") as image_file:
+            volumes = volume_serial.find_volumes(image_file)
+        return [volume_serial.read_volume_serial(self.path, index) for index in range(len(volumes))]
+
+    def gpt_windows_image(self, sector_size=512):
+        # EFI system partition, Windows C: and recovery partition
+        image = ImageBuilder(self.path, 12 * MIB)
+        lba = MIB // sector_size
+        image.gpt([(lba, 2 * lba - 1), (2 * lba, 8 * lba - 1), (8 * lba, 9 * lba - 1)], sector_size)
+        image.volume(MIB, fat32_boot_sector(MIB // sector_size, sector_size=sector_size))
+        image.volume(2 * MIB, ntfs_boot_sector(6 * MIB // sector_size - 1, sector_size))
+        image.volume(8 * MIB, ntfs_boot_sector(MIB // sector_size - 1, sector_size))
+        return image
+
+    def test_gpt_patches_system_volume(self):
+        self.gpt_windows_image()
+        previous = volume_serial.write_volume_serial(self.path, "ABCD-1234")
+        self.assertEqual(previous, "0000-0000")
+        self.assertEqual(self.serials(), ["0000-0000", "ABCD-1234", "0000-0000"])
+        # Backup boot sector of NTFS follows the last sector of the volume
+        with open(self.path, "rb") as image_file:
+            image_file.seek(8 * MIB - 512 + 0x48)
+            self.assertEqual(struct.unpack("<I", image_file.read(4))[0], 0xABCD1234)
+
+    def test_gpt_explicit_index(self):
+        self.gpt_windows_image()
+        volume_serial.write_volume_serial(self.path, "ABCD-1234", volume_index=0)
+        self.assertEqual(self.serials(), ["ABCD-1234", "0000-0000", "0000-0000"])
+        with self.assertRaises(ValueError):
+            volume_serial.write_volume_serial(self.path, "ABCD-1234", volume_index=3)
+
+    def test_gpt_4k_sectors(self):
+        self.gpt_windows_image(sector_size=4096)
+        volume_serial.write_volume_serial(self.path, "ABCD-1234")
+        self.assertEqual(self.serials(), ["0000-0000", "ABCD-1234", "0000-0000"])
+
+    def test_mbr_logical_partition(self):
+        # System Reserved primary partition, extended partition with a data and the Windows logical partition
+        image = ImageBuilder(self.path, 16 * MIB)
+        image.write(0, mbr_sector([(0x07, 2048, 2048), (0x0F, 4096, 24576)]))
+        image.volume(MIB, ntfs_boot_sector(2047))
+        image.write(2 * MIB, mbr_sector([(0x0B, 2048, 2048), (0x05, 4096, 12288)]))
+        image.volume(3 * MIB, fat32_boot_sector(2048))
+        image.write(4 * MIB, mbr_sector([(0x07, 2048, 10240)]))
+        image.volume(5 * MIB, ntfs_boot_sector(10239))
+        volume_serial.write_volume_serial(self.path, "ABCD-1234")
+        self.assertEqual(self.serials(), ["0000-0000", "0000-0000", "ABCD-1234"])
+
+    def test_ambiguous_system_volume(self):
+        image = ImageBuilder(self.path, 8 * MIB)
+        image.write(0, mbr_sector([(0x07, 2048, 4096), (0x07, 6144, 4096)]))
+        image.volume(MIB, ntfs_boot_sector(4095))
+        image.volume(3 * MIB, ntfs_boot_sector(4095))
+        with self.assertRaises(ValueError):
+            volume_serial.write_volume_serial(self.path, "ABCD-1234")
+        volume_serial.write_volume_serial(self.path, "ABCD-1234", volume_index=1)
+        self.assertEqual(self.serials(), ["0000-0000", "ABCD-1234"])
+
+    def test_partition_file(self):
+        image = ImageBuilder(self.path, MIB)
+        image.volume(0, fat32_boot_sector(2048))
+        self.assertEqual(volume_serial.write_volume_serial(self.path, "ABCD-1234"), "0000-0000")
+        self.assertEqual(self.serials(), ["ABCD-1234"])
+
+
+if __name__ == '__main__':
+    unittest.main()
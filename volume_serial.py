@@ -0,0 +1,288 @@
+import mmap
+import struct
+import logging
+import log_helper
+
+logger = log_helper.setup_logger(name="volume_serial", level=logging.INFO, log_to_file=False)
+
+
+__doc__ = """Volume serial number (Volume ID) rewrite in raw disk images and partition files, without VolumeID.exe.
+The serial number is stored in the volume boot sector: at 0x48 for NTFS and at 0x43 for FAT32 (0x27 for FAT12/16).
+NTFS keeps the backup boot sector in the last sector of the volume, FAT32 in the sector pointed by the boot sector.
+Every copy is patched through a memory map of the single page containing it, so nothing else of the image is read
+or written. Raw disk images are searched for volumes through MBR partition tables, including logical partitions
+of extended partitions, and GPT partition tables of disks with 512 and 4096 byte sectors. Unless the volume is given
+by its index, the Windows system volume is patched: the only NTFS volume, or the largest one if there are several,
+so EFI system, System Reserved and recovery partitions keep their serial numbers
+"""
+
+SECTOR_SIZE = 512
+
+# Logical sector sizes of disks whose partition tables are recognized
+DISK_SECTOR_SIZES = (512, 4096)
+
+# Maximum number of logical partitions followed in the extended partition chain
+MAX_LOGICAL_PARTITIONS = 128
+
+FS_NTFS = "NTFS"
+FS_FAT32 = "FAT32"
+FS_FAT = "FAT"
+
+_GPT_SIGNATURE = b"EFI PART"
+_MBR_PROTECTIVE = 0xEE
+_MBR_EXTENDED = (0x05, 0x0F, 0x85)
+
+
+def parse_volume_id(volume_id):
+    """
+    :param volume_id: Volume ID as shown by "vol" command, XXXX-XXXX
+    :return: serial number as 32-bit integer
+    """
+    high, low = volume_id.split("-")
+    return (int(high, 16) << 16) | int(low, 16)
+
+
+def format_volume_id(serial):
+    """
+    :return: Volume ID XXXX-XXXX of the 32-bit serial number
+    """
+    return "{0:04X}-{1:04X}".format(serial >> 16, serial & 0xFFFF)
+
+
+class BootSector:
+    """
+    Location of the serial number copies of a single volume
+    file_system - FS_NTFS, FS_FAT32 or FS_FAT
+    offset - volume offset in the image file, bytes
+    size - volume size counted in the boot sector, bytes
+    serial_offsets - absolute offsets of the 32-bit serial number, primary first
+    sector_size - bytes per sector declared in the boot sector
+    """
+    def __init__(self, file_system, offset, size, serial_offsets, sector_size=SECTOR_SIZE):
+        self.file_system = file_system
+        self.offset = offset
+        self.size = size
+        self.serial_offsets = serial_offsets
+        self.sector_size = sector_size
+
+    def __repr__(self):
+        return "BootSector({0}, offset=0x{1:X}, size={2})".format(self.file_system, self.offset, self.size)
+
+    @classmethod
+    def parse(cls, sector, offset):
+        """
+        :param sector: volume boot sector bytes
+        :param offset: volume offset in the image file
+        :return: BootSector object, None if the sector is not NTFS or FAT boot sector
+        """
+        if len(sector) < SECTOR_SIZE or sector[510:512] != b"\x55\xaa":
+            return None
+        bytes_per_sector, = struct.unpack_from("<H", sector, 0x0B)
+        if bytes_per_sector not in (512, 1024, 2048, 4096):
+            return None
+        if sector[3:11] == b"NTFS    ":
+            total_sectors, = struct.unpack_from("<Q", sector, 0x28)
+            # Backup boot sector follows the last sector counted in the boot sector
+            return cls(FS_NTFS, offset, total_sectors * bytes_per_sector,
+                       [offset + 0x48, offset + total_sectors * bytes_per_sector + 0x48], bytes_per_sector)
+        total_sectors, = struct.unpack_from("<H", sector, 0x13)
+        if not total_sectors:
+            total_sectors, = struct.unpack_from("<I", sector, 0x20)
+        if sector[0x52:0x5A] == b"FAT32   " and sector[0x42] == 0x29:
+            backup_sector, = struct.unpack_from("<H", sector, 0x32)
+            serial_offsets = [offset + 0x43]
+            if backup_sector not in (0, 0xFFFF):
+                serial_offsets.append(offset + backup_sector * bytes_per_sector + 0x43)
+            return cls(FS_FAT32, offset, total_sectors * bytes_per_sector, serial_offsets, bytes_per_sector)
+        if sector[0x36:0x39] == b"FAT" and sector[0x26] == 0x29:
+            return cls(FS_FAT, offset, total_sectors * bytes_per_sector, [offset + 0x27], bytes_per_sector)
+        return None
+
+
+def _read(image_file, offset, size):
+    image_file.seek(offset)
+    return image_file.read(size)
+
+
+def _mbr_entries(sector):
+    """
+    :return: list of (partition type, start LBA, number of sectors) tuples of the MBR or EBR, empty if there is no
+             partition table signature
+    """
+    if len(sector) < SECTOR_SIZE or sector[510:512] != b"\x55\xaa":
+        return []
+    entries = [struct.unpack_from("<4xB3xII", sector, 446 + index * 16) for index in range(4)]
+    return [entry for entry in entries if entry[0]]
+
+
+def _gpt_partition_offsets(image_file):
+    """
+    :return: list of partition offsets from the GPT, None if the image has no GPT header.
+    The GPT header is in the second logical sector, so where it is found gives the sector size
+    """
+    for sector_size in DISK_SECTOR_SIZES:
+        header = _read(image_file, sector_size, 92)
+        if header[:8] != _GPT_SIGNATURE:
+            continue
+        entries_lba, entries_count, entry_size = struct.unpack_from("<QII", header, 0x48)
+        if entry_size < 0x28:
+            raise ValueError("Bad GPT partition entry size {0}".format(entry_size))
+        table = _read(image_file, entries_lba * sector_size, entries_count * entry_size)
+        result = []
+        for index in range(len(table) // entry_size):
+            entry = table[index * entry_size:(index + 1) * entry_size]
+            if entry[:16] != b"\0" * 16:
+                result.append(struct.unpack_from("<Q", entry, 0x20)[0] * sector_size)
+        return result
+    return None
+
+
+def _mbr_partition_lbas(image_file, entries, sector_size):
+    """
+    :return: list of start LBAs of primary partitions and logical partitions of the extended partition chain
+    """
+    result = []
+    for partition_type, start, sectors in entries:
+        if partition_type not in _MBR_EXTENDED:
+            if sectors:
+                result.append(start)
+            continue
+        # Every EBR holds a logical partition relative to itself and a link to the next EBR relative to the
+        # extended partition
+        ebr_lba = start
+        for _ in range(MAX_LOGICAL_PARTITIONS):
+            ebr_entries = _mbr_entries(_read(image_file, ebr_lba * sector_size, SECTOR_SIZE))
+            link = None
+            for ebr_type, ebr_start, ebr_sectors in ebr_entries:
+                if ebr_type in _MBR_EXTENDED:
+                    link = start + ebr_start
+                elif ebr_sectors:
+                    result.append(ebr_lba + ebr_start)
+            if link is None or link == ebr_lba:
+                break
+            ebr_lba = link
+        else:
+            raise ValueError("Extended partition chain is longer than {0} partitions".format(MAX_LOGICAL_PARTITIONS))
+    return result
+
+
+def _find_partition_volumes(image_file):
+    """
+    :return: list of BootSector of partitions of the raw disk image, in partition table order
+    """
+    entries = _mbr_entries(_read(image_file, 0, SECTOR_SIZE))
+    if not entries:
+        return []
+    if any(entry[0] == _MBR_PROTECTIVE for entry in entries):
+        offsets = _gpt_partition_offsets(image_file)
+        if offsets is None:
+            raise ValueError("Protective MBR without GPT header")
+        return _parse_volumes(image_file, offsets)
+
+    # MBR does not store the sector size: the right one is where boot sectors of partitions declare the same size
+    fallback = []
+    for sector_size in DISK_SECTOR_SIZES:
+        offsets = [lba * sector_size for lba in _mbr_partition_lbas(image_file, entries, sector_size)]
+        volumes = _parse_volumes(image_file, offsets)
+        if any(volume.sector_size == sector_size for volume in volumes):
+            return volumes
+        fallback = fallback or volumes
+    return fallback
+
+
+def _parse_volumes(image_file, offsets):
+    result = []
+    for offset in offsets:
+        volume = BootSector.parse(_read(image_file, offset, SECTOR_SIZE), offset)
+        if volume is not None:
+            result.append(volume)
+    return result
+
+
+def find_volumes(image_file):
+    """
+    Find NTFS and FAT volumes of the partition file or raw disk image
+    :param image_file: image file opened in binary mode
+    :return: list of BootSector, in partition table order
+    """
+    volume = BootSector.parse(_read(image_file, 0, SECTOR_SIZE), 0)
+    if volume is not None:
+        return [volume]
+    return _find_partition_volumes(image_file)
+
+
+def select_volume(volumes, volume_index=None, path=None):
+    """
+    :param volumes: find_volumes() result
+    :param volume_index: index of the volume in find_volumes() order, None to select the Windows system volume:
+                         the only volume, the only NTFS volume or the largest NTFS volume
+    :param path: image path for error messages
+    :return: BootSector
+    :raises ValueError: if there is no such volume or the system volume is ambiguous
+    """
+    if volume_index is not None:
+        if not 0 <= volume_index < len(volumes):
+            raise ValueError("No NTFS or FAT volume #{0} found in {1}, found {2}".format(volume_index, path,
+                                                                                     volumes))
+        return volumes[volume_index]
+    if not volumes:
+        raise ValueError("No NTFS or FAT volume found in {0}".format(path))
+    if len(volumes) == 1:
+        return volumes[0]
+    ntfs_volumes = sorted((volume for volume in volumes if volume.file_system == FS_NTFS),
+                          key=lambda volume: volume.size, reverse=True)
+    if not ntfs_volumes or (len(ntfs_volumes) > 1 and ntfs_volumes[0].size == ntfs_volumes[1].size):
+        raise ValueError("Unable to tell the system volume of {0} among {1}, give the volume index".format(
+            path, volumes))
+    return ntfs_volumes[0]
+
+
+def _patch_page(image_file, offset, data):
+    """
+    Write data through the memory map of the single page which contains it
+    """
+    page_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+    length = offset - page_offset + len(data)
+    page = mmap.mmap(image_file.fileno(), length, offset=page_offset, access=mmap.ACCESS_WRITE)
+    try:
+        page[offset - page_offset:length] = data
+        page.flush()
+    finally:
+        page.close()
+
+
+def read_volume_serial(path, volume_index=None):
+    """
+    :param path: partition file or raw disk image
+    :param volume_index: index of the volume in find_volumes() order, None for the system volume
+    :return: Volume ID XXXX-XXXX
+    """
+    with open(path, "rb") as image_file:
+        volume = select_volume(find_volumes(image_file), volume_index, path)
+        serial, = struct.unpack("<I", _read(image_file, volume.serial_offsets[0], 4))
+    return format_volume_id(serial)
+
+
+def write_volume_serial(path, volume_id, volume_index=None):
+    """
+    Change serial number of the volume in the boot sector and its backup copy
+    :param path: partition file or raw disk image
+    :param volume_id: new Volume ID, XXXX-XXXX, e.g. from random_utils.random_volume_id()
+    :param volume_index: index of the volume in find_volumes() order, None for the system volume
+    :return: previous Volume ID XXXX-XXXX
+    """
+    new_serial = parse_volume_id(volume_id)
+    serial = struct.pack("<I", new_serial)
+    with open(path, "r+b") as image_file:
+        volume = select_volume(find_volumes(image_file), volume_index, path)
+        previous, = struct.unpack("<I", _read(image_file, volume.serial_offsets[0], 4))
+        image_size = image_file.seek(0, 2)
+        for serial_offset in volume.serial_offsets:
+            if serial_offset + 4 > image_size:
+                logger.warning("Backup boot sector of {0} volume at 0x{1:X} is out of {2}".format(
+                    volume.file_system, volume.offset, path))
+                continue
+            _patch_page(image_file, serial_offset, serial)
+    logger.info("{0} volume at 0x{1:X} of {2}: Volume ID {3} -> {4}".format(
+        volume.file_system, volume.offset, path, format_volume_id(previous), format_volume_id(new_serial)))
+    return format_volume_id(previous)